@@ -27,6 +27,30 @@ std::vector<Atom> read_xyz_from_file(const string &path_xyz) {
   return libint2::read_dotxyz(input_file);
 }
 
+/**
+ * \brief Create the atoms from an array of (n_atoms, 3) coordinates in
+ * Angstrom and the atomic numbers, converting the coordinates to atomic units
+ * like `read_xyz_from_file` does.
+ */
+std::vector<Atom>
+atoms_from_coordinates(const Eigen::Ref<const Matrix> &coordinates,
+                       const std::vector<int> &atomic_numbers) {
+  if (coordinates.cols() != 3 ||
+      coordinates.rows() != static_cast<long>(atomic_numbers.size()))
+    throw std::invalid_argument(
+        "coordinates must have shape (n_atoms, 3) matching the atomic numbers");
+
+  using namd::angstrom_to_bohr;
+  std::vector<Atom> atoms(atomic_numbers.size());
+  for (int i = 0; i != static_cast<int>(atoms.size()); ++i) {
+    atoms[i].atomic_number = atomic_numbers[i];
+    atoms[i].x = coordinates(i, 0) * angstrom_to_bohr;
+    atoms[i].y = coordinates(i, 1) * angstrom_to_bohr;
+    atoms[i].z = coordinates(i, 2) * angstrom_to_bohr;
+  }
+  return atoms;
+}
+
 /**
  * \brief Compute the coupling integrals for the 2 given molecular geometries
  * and basis_name.
@@ -34,7 +58,8 @@ std::vector<Atom> read_xyz_from_file(const string &path_xyz) {
 Matrix compute_integrals_couplings(const string &path_xyz_1,
                                    const string &path_xyz_2,
                                    const string &path_hdf5,
-                                   const string &basis_name);
+                                   const string &basis_name,
+                                   double threshold);
 
 int main() {
 
@@ -44,26 +69,25 @@ int main() {
   string dataset_name = "ethylene/point_n";
 
   auto xs =
-      compute_integrals_couplings(path_xyz, path_xyz, path_hdf5, basis_name);
+      compute_integrals_couplings(path_xyz, path_xyz, path_hdf5, basis_name, 0);
 }
 
 // OpenMP or multithread computations
 namespace libint2 {
-int nthreads = 1;
 
 /**
  * \brief fires off \c nthreads instances of lambda in parallel
  */
-template <typename Lambda> void parallel_do(Lambda &lambda) {
+template <typename Lambda> void parallel_do(Lambda &lambda, int nthreads) {
 #ifdef _OPENMP
-#pragma omp parallel
+#pragma omp parallel num_threads(nthreads)
   {
     int thread_id = omp_get_thread_num();
     lambda(thread_id);
   }
 #else // use C++11 threads
   std::vector<std::thread> threads;
-  for (int thread_id = 0; thread_id != libint2::nthreads; ++thread_id) {
+  for (int thread_id = 0; thread_id != nthreads; ++thread_id) {
     if (thread_id != nthreads - 1)
       threads.push_back(std::thread(lambda, thread_id));
     else
@@ -76,23 +100,13 @@ template <typename Lambda> void parallel_do(Lambda &lambda) {
 } // namespace libint2
 
 /**
- * \brief Set the number of thread to use
+ * \brief Number of threads to use, all the available cores
+ * are used if `requested` is not positive
  */
-void set_nthread() {
-
-  using libint2::nthreads;
-  nthreads = std::thread::hardware_concurrency();
-
-#if defined(_OPENMP)
-  omp_set_num_threads(nthreads);
-#endif
-  std::cout << "Will scale over " << nthreads
-#if defined(_OPENMP)
-            << " OpenMP"
-#else
-            << " C++11"
-#endif
-            << " threads" << std::endl;
+int number_of_threads(int requested) {
+  if (requested > 0)
+    return requested;
+  return std::max(1, static_cast<int>(std::thread::hardware_concurrency()));
 }
 
 /**
@@ -126,6 +140,293 @@ int max_l(const std::vector<libint2::Shell> &shells) {
   return l;
 }
 
+/**
+ * \brief Squared distance between the centers of two shells.
+ */
+double distance2(const Shell &sh1, const Shell &sh2) {
+  const double dx = sh1.O[0] - sh2.O[0];
+  const double dy = sh1.O[1] - sh2.O[1];
+  const double dz = sh1.O[2] - sh2.O[2];
+  return dx * dx + dy * dy + dz * dz;
+}
+
+/**
+ * \brief Bound of the overlap between the functions of a shell and any other
+ * shell, see `shell_pair_cutoff`.
+ *
+ * The overlap between two primitives with exponents a and b, contraction
+ * coefficients c1 and c2 and total angular momentum L = l1 + l2 is bounded by
+ * |c1 c2| (pi / (a + b))^1.5 exp(-ab / (a + b) R^2) (R + sqrt(L / 2(a + b)))^L,
+ * where the last factor bounds the polynomial of (P - A) and (P - B). Using
+ * (pi / (a + b))^1.5 <= (pi / 2)^1.5 (ab)^-0.75 the sum over the primitive
+ * pairs factorizes, and the bound of the shell pair only depends on the
+ * `weight` of each shell, its most diffuse exponent and its angular momentum.
+ */
+namd::ShellBound shell_bound(const Shell &shell) {
+  namd::ShellBound bound;
+  bound.min_alpha = *std::min_element(shell.alpha.cbegin(), shell.alpha.cend());
+  for (const auto &c : shell.contr)
+    bound.l = std::max(bound.l, c.l);
+  for (size_t p = 0; p != shell.nprim(); ++p) {
+    double c = 0;
+    for (const auto &contraction : shell.contr)
+      c = std::max(c, std::abs(contraction.coeff[p]));
+    bound.weight += c * std::pow(shell.alpha[p], -0.75);
+  }
+  // The functions of the shell are combinations of at most (l + 1)(l + 2) / 2
+  // cartesian functions with coefficients smaller than sqrt((2l - 1)!!)
+  const int l = bound.l;
+  double double_factorial = 1;
+  for (int k = 2 * l - 1; k > 1; k -= 2)
+    double_factorial *= k;
+  bound.weight *= (l + 1) * (l + 2) / 2 * std::sqrt(double_factorial);
+  return bound;
+}
+
+/**
+ * \brief Distance beyond which the overlap between the functions of two
+ * shells is smaller than `threshold`. The logarithm of the bound is a concave
+ * function of the distance, hence it is smaller than the threshold for all
+ * the distances beyond the cutoff, which is found by bisection.
+ */
+double shell_pair_cutoff(const namd::ShellBound &b1, const namd::ShellBound &b2,
+                         double threshold) {
+  const double gamma = b1.min_alpha + b2.min_alpha;
+  const double mu = b1.min_alpha * b2.min_alpha / gamma;
+  const int L = b1.l + b2.l;
+  const double s = std::sqrt(L / (2 * gamma));
+  const double log_prefactor =
+      std::log(b1.weight * b2.weight * std::pow(M_PI / 2, 1.5) / threshold);
+  auto log_bound = [&](double r) {
+    return log_prefactor - mu * r * r + (L > 0 ? L * std::log(r + s) : 0);
+  };
+
+  // Distance where the bound is largest
+  double lower = L > 0 ? (std::sqrt(s * s + 2 * L / mu) - s) / 2 : 0;
+  if (log_bound(lower) < 0)
+    return lower;
+  double upper = lower + 1;
+  while (log_bound(upper) >= 0)
+    upper *= 2;
+  for (int i = 0; i != 60; ++i) {
+    const double middle = (lower + upper) / 2;
+    (log_bound(middle) >= 0 ? lower : upper) = middle;
+  }
+  return upper;
+}
+
+/**
+ * \brief Index of the first shell of each atom, followed by the total number
+ * of shells. The shells of an atom are consecutive and share the same center.
+ */
+std::vector<size_t> map_atom_to_shell(const std::vector<Shell> &shells) {
+  std::vector<size_t> result;
+  for (size_t s = 0; s != shells.size(); ++s)
+    if (s == 0 || shells[s].O != shells[s - 1].O)
+      result.push_back(s);
+  result.push_back(shells.size());
+  return result;
+}
+
+/**
+ * \brief Select the shell pairs whose overlap may be larger than a threshold.
+ *
+ * The shells with the same bound share the cutoff distance of each pair of
+ * kinds, which is computed once, so that checking a shell pair only requires
+ * its distance. The pairs of atoms closer than the largest cutoff of their
+ * shells are found using a cell list, therefore the number of shell pairs
+ * visited grows linearly with the number of atoms. All the geometries passed
+ * to the methods must use the basis set of `shells`.
+ */
+class ShellScreening {
+public:
+  ShellScreening(const std::vector<Shell> &shells, double threshold)
+      : threshold(threshold), atom2shell(map_atom_to_shell(shells)) {
+    if (!enabled())
+      return;
+    // Kinds of shells with the same bound
+    std::map<std::tuple<int, double, double>, size_t> kinds;
+    std::vector<namd::ShellBound> bounds;
+    kind.reserve(shells.size());
+    for (const auto &shell : shells) {
+      auto bound = shell_bound(shell);
+      auto key = std::make_tuple(bound.l, bound.min_alpha, bound.weight);
+      auto it = kinds.emplace(key, bounds.size()).first;
+      if (it->second == bounds.size())
+        bounds.push_back(bound);
+      kind.push_back(it->second);
+    }
+    nkinds = bounds.size();
+    cutoff2.resize(nkinds * nkinds);
+    for (size_t k1 = 0; k1 != nkinds; ++k1)
+      for (size_t k2 = 0; k2 != nkinds; ++k2) {
+        const double r = shell_pair_cutoff(bounds[k1], bounds[k2], threshold);
+        cutoff2[k1 * nkinds + k2] = r * r;
+      }
+
+    // Kinds of atoms with the same kinds of shells and the largest cutoff
+    // between the shells of each pair of them
+    std::map<std::vector<size_t>, size_t> atom_kinds;
+    std::vector<size_t> first_shell;
+    const size_t natoms = atom2shell.size() - 1;
+    for (size_t i = 0; i != natoms; ++i) {
+      std::vector<size_t> key(kind.begin() + atom2shell[i],
+                              kind.begin() + atom2shell[i + 1]);
+      auto it = atom_kinds.emplace(key, first_shell.size()).first;
+      if (it->second == first_shell.size())
+        first_shell.push_back(i);
+      atom_kind.push_back(it->second);
+    }
+    natom_kinds = first_shell.size();
+    atom_cutoff2.assign(natom_kinds * natom_kinds, 0);
+    for (size_t a = 0; a != natom_kinds; ++a)
+      for (size_t b = 0; b != natom_kinds; ++b) {
+        const size_t i = first_shell[a], j = first_shell[b];
+        double &cutoff = atom_cutoff2[a * natom_kinds + b];
+        for (size_t s1 = atom2shell[i]; s1 != atom2shell[i + 1]; ++s1)
+          for (size_t s2 = atom2shell[j]; s2 != atom2shell[j + 1]; ++s2)
+            cutoff = std::max(cutoff, cutoff2[kind[s1] * nkinds + kind[s2]]);
+      }
+  }
+
+  bool enabled() const { return threshold > 0; }
+
+  /**
+   * \brief Check whether the overlap between the shells `s1` and `s2`, with
+   * the given centers, is smaller than the threshold.
+   */
+  bool is_screened(size_t s1, size_t s2, const Shell &sh1,
+                   const Shell &sh2) const {
+    return enabled() &&
+           distance2(sh1, sh2) > cutoff2[kind[s1] * nkinds + kind[s2]];
+  }
+
+  /**
+   * \brief Ranges [begin, end) of consecutive atoms of the second geometry
+   * that may overlap with each atom of the first one, or all the atoms if
+   * the screening is disabled.
+   */
+  std::vector<std::vector<std::pair<size_t, size_t>>>
+  atom_ranges(const std::vector<Shell> &shells_1,
+              const std::vector<Shell> &shells_2) const {
+    const size_t natoms = atom2shell.size() - 1;
+    std::vector<std::vector<std::pair<size_t, size_t>>> ranges(natoms);
+    if (!enabled()) {
+      for (auto &range : ranges)
+        range.emplace_back(0, natoms);
+      return ranges;
+    }
+    auto neighbours = neighbour_atoms(shells_1, shells_2);
+    for (size_t i = 0; i != natoms; ++i) {
+      for (size_t j : neighbours[i]) {
+        if (!ranges[i].empty() && ranges[i].back().second == j)
+          ranges[i].back().second = j + 1;
+        else
+          ranges[i].emplace_back(j, j + 1);
+      }
+    }
+    return ranges;
+  }
+
+  /**
+   * \brief Ranges of the shells of the second geometry that may overlap with
+   * each shell of the first one. Only the shells s2 <= s1 are included if
+   * `triangular` is true.
+   */
+  namd::ShellRanges shell_ranges(const std::vector<Shell> &shells_1,
+                                 const std::vector<Shell> &shells_2,
+                                 bool triangular) const {
+    namd::ShellRanges result(shells_1.size());
+    auto ranges = atom_ranges(shells_1, shells_2);
+    for (size_t i = 0; i != ranges.size(); ++i) {
+      for (size_t s1 = atom2shell[i]; s1 != atom2shell[i + 1]; ++s1) {
+        for (const auto &range : ranges[i]) {
+          const size_t begin = atom2shell[range.first];
+          size_t end = atom2shell[range.second];
+          if (triangular)
+            end = std::min(end, s1 + 1);
+          if (begin < end)
+            result[s1].emplace_back(begin, end);
+        }
+      }
+    }
+    return result;
+  }
+
+private:
+  double threshold;
+  std::vector<size_t> atom2shell;
+  //! Kind of each shell and squared cutoff of each pair of kinds
+  std::vector<size_t> kind;
+  size_t nkinds = 0;
+  std::vector<double> cutoff2;
+  //! Kind of each atom and largest squared cutoff of each pair of kinds
+  std::vector<size_t> atom_kind;
+  size_t natom_kinds = 0;
+  std::vector<double> atom_cutoff2;
+
+  /**
+   * \brief Atoms of the second geometry closer to each atom of the first one
+   * than the cutoff of their kinds, sorted by index. The atoms of the second
+   * geometry are put in cells at least as large as the largest cutoff, so
+   * only the neighbouring cells of each atom are searched.
+   */
+  std::vector<std::vector<size_t>>
+  neighbour_atoms(const std::vector<Shell> &shells_1,
+                  const std::vector<Shell> &shells_2) const {
+    const size_t natoms = atom2shell.size() - 1;
+    const double cutoff = std::sqrt(
+        *std::max_element(atom_cutoff2.cbegin(), atom_cutoff2.cend()));
+
+    std::array<double, 3> lower, width;
+    std::array<int, 3> dims;
+    // At most about one cell per atom
+    const int max_dim = 1 + static_cast<int>(std::cbrt(natoms));
+    for (int d = 0; d != 3; ++d) {
+      auto compare = [&](size_t i, size_t j) {
+        return shells_2[atom2shell[i]].O[d] < shells_2[atom2shell[j]].O[d];
+      };
+      std::vector<size_t> atoms(natoms);
+      std::iota(atoms.begin(), atoms.end(), 0);
+      auto range = std::minmax_element(atoms.cbegin(), atoms.cend(), compare);
+      lower[d] = shells_2[atom2shell[*range.first]].O[d];
+      const double extent = shells_2[atom2shell[*range.second]].O[d] - lower[d];
+      const double ncells = cutoff > 0 ? extent / cutoff : max_dim;
+      dims[d] = std::max(1, static_cast<int>(std::min<double>(ncells, max_dim)));
+      width[d] = extent > 0 ? extent / dims[d] : 1;
+    }
+    auto cell_of = [&](const Shell &shell, int d) {
+      const int c = static_cast<int>(std::floor((shell.O[d] - lower[d]) / width[d]));
+      return std::max(0, std::min(c, dims[d] - 1));
+    };
+
+    std::vector<std::vector<size_t>> cells(dims[0] * dims[1] * dims[2]);
+    for (size_t j = 0; j != natoms; ++j) {
+      const auto &shell = shells_2[atom2shell[j]];
+      cells[(cell_of(shell, 0) * dims[1] + cell_of(shell, 1)) * dims[2] +
+            cell_of(shell, 2)]
+          .push_back(j);
+    }
+
+    std::vector<std::vector<size_t>> neighbours(natoms);
+    for (size_t i = 0; i != natoms; ++i) {
+      const auto &shell_i = shells_1[atom2shell[i]];
+      std::array<int, 3> c{cell_of(shell_i, 0), cell_of(shell_i, 1),
+                           cell_of(shell_i, 2)};
+      for (int x = std::max(0, c[0] - 1); x <= std::min(dims[0] - 1, c[0] + 1); ++x)
+        for (int y = std::max(0, c[1] - 1); y <= std::min(dims[1] - 1, c[1] + 1); ++y)
+          for (int z = std::max(0, c[2] - 1); z <= std::min(dims[2] - 1, c[2] + 1); ++z)
+            for (size_t j : cells[(x * dims[1] + y) * dims[2] + z]) {
+              const double r2 = distance2(shell_i, shells_2[atom2shell[j]]);
+              if (r2 <= atom_cutoff2[atom_kind[i] * natom_kinds + atom_kind[j]])
+                neighbours[i].push_back(j);
+            }
+      std::sort(neighbours[i].begin(), neighbours[i].end());
+    }
+    return neighbours;
+  }
+};
+
 /**
  * \brief Count the number of basis functions per shell.
  */
@@ -143,74 +444,422 @@ map_shell_to_basis_function(const std::vector<Shell> &shells) {
   return result;
 }
 /**
- * \brief Compute the overlap integrals between two set of shells at different
- * atomic positions
+ * \brief Construct one integrals engine per thread for the given operator
  */
-Matrix compute_overlaps_for_couplings(const std::vector<Shell> &shells_1,
-                                      const std::vector<Shell> &shells_2) {
-  // Distribute the computations among the available threads
-  using libint2::nthreads;
-
-  const auto n = nbasis(shells_1);
-  Matrix result(n, n);
-
-  // construct the overlap integrals engine
+std::vector<libint2::Engine> make_engines(Operator op, size_t max_nprim,
+                                          int max_l, int nthreads) {
   std::vector<libint2::Engine> engines(nthreads);
-  engines[0] = libint2::Engine(Operator::overlap, max_nprim(shells_1),
-                               max_l(shells_1), 0);
-
+  engines[0] = libint2::Engine(op, max_nprim, max_l, 0);
   for (int i = 1; i != nthreads; ++i) {
     engines[i] = engines[0];
   }
+  return engines;
+}
 
-  auto shell2bf = map_shell_to_basis_function(shells_1);
+/**
+ * \brief Estimate the cost of computing the integrals of a shell with any
+ * other shell, which grows with the number of functions and primitives.
+ */
+double shell_cost(const Shell &shell) {
+  return static_cast<double>(shell.size() * shell.nprim());
+}
 
-  // Function to compute the integrals in parallel
+/**
+ * \brief Append the shell `s` to the sorted `ranges` of shells, extending the
+ * last range if it ends at `s`.
+ */
+void append_shell(std::vector<std::pair<size_t, size_t>> &ranges, size_t s) {
+  if (!ranges.empty() && ranges.back().second == s)
+    ranges.back().second = s + 1;
+  else
+    ranges.emplace_back(s, s + 1);
+}
+
+/**
+ * \brief Split the shell pairs of several pairs of geometries into blocks
+ * {s1, [begin, end)} sorted by decreasing cost. `ranges[p][s1]` contains the
+ * ranges of shells s2 computed with the shell s1 for the pair of geometries
+ * `p`. The ranges are split in several blocks when there are not enough of
+ * them to balance the work among `nthreads`.
+ */
+std::vector<namd::ShellBlock>
+make_shell_blocks(const std::vector<Shell> &shells,
+                  const std::vector<namd::ShellRanges> &ranges, int nthreads) {
+  const size_t nshells = shells.size();
+  // Cumulative cost of the shells, the cost of a pair is the product of the
+  // costs of each shell
+  std::vector<double> cumulative(nshells + 1, 0);
+  for (size_t s = 0; s != nshells; ++s)
+    cumulative[s + 1] = cumulative[s] + shell_cost(shells[s]);
+
+  size_t nranges = 0;
+  for (const auto &pair_ranges : ranges)
+    for (const auto &row : pair_ranges)
+      nranges += row.size();
+
+  // Blocks per range to have several blocks per thread
+  const size_t target = 8 * static_cast<size_t>(nthreads);
+  const size_t nsplit = nranges == 0 ? 1 : std::max(size_t(1), target / nranges);
+
+  std::vector<namd::ShellBlock> blocks;
+  blocks.reserve(nranges * nsplit);
+  for (size_t p = 0; p != ranges.size(); ++p) {
+    for (size_t s1 = 0; s1 != ranges[p].size(); ++s1) {
+      for (const auto &range : ranges[p][s1]) {
+        const size_t width = (range.second - range.first + nsplit - 1) / nsplit;
+        for (size_t begin = range.first; begin < range.second; begin += width) {
+          const size_t end = std::min(begin + width, range.second);
+          const double cost = shell_cost(shells[s1]) *
+                              (cumulative[end] - cumulative[begin]);
+          blocks.push_back({p, s1, begin, end, cost});
+        }
+      }
+    }
+  }
+  // Largest blocks first, so that the cheap ones fill the gaps at the end
+  std::stable_sort(blocks.begin(), blocks.end(),
+                   [](const namd::ShellBlock &a, const namd::ShellBlock &b) {
+                     return a.cost > b.cost;
+                   });
+  return blocks;
+}
+
+/**
+ * \brief Call `kernel(thread_id, block)` for every block using `nthreads`
+ * threads. The threads take the next block from a shared atomic counter, so
+ * that the expensive blocks do not accumulate in a few threads. The fraction
+ * of the time that the threads spent computing is stored in `balance`.
+ */
+template <typename Kernel>
+void run_shell_blocks(const std::vector<namd::ShellBlock> &blocks,
+                      Kernel &kernel, int nthreads,
+                      namd::LoadBalance &balance) {
+  using clock = std::chrono::steady_clock;
+
+  std::atomic<size_t> next(0);
+  std::vector<double> busy(nthreads, 0);
+
+  auto start = clock::now();
   auto compute = [&](int thread_id) {
+    auto begin = clock::now();
+    for (size_t i = next++; i < blocks.size(); i = next++)
+      kernel(thread_id, blocks[i]);
+    busy[thread_id] =
+        std::chrono::duration<double>(clock::now() - begin).count();
+  };
+  libint2::parallel_do(compute, nthreads);
+  double wall = std::chrono::duration<double>(clock::now() - start).count();
+
+  double total = std::accumulate(busy.cbegin(), busy.cend(), 0.0);
+  balance = {
+      wall > 0 ? std::min(1.0, total / (wall * nthreads)) : 1.0,
+      blocks.size(), nthreads};
+}
+
+/**
+ * \brief Recompute the overlap integrals between two set of shells at
+ * different atomic positions only for the shell pairs where either shell is
+ * `stale`, keeping the other blocks of `result`. `stored` contains the ranges
+ * of the blocks of `result` that may be non zero. The stale blocks in those
+ * ranges are set to zero and only the stale pairs of neighbouring shells at
+ * the new positions are computed, therefore the number of shell pairs visited
+ * grows linearly with the number of atoms when the screening is enabled.
+ * `stored` is updated with the blocks of the new `result`. Returns the number
+ * of shell pairs that have been reused.
+ */
+size_t update_overlaps_for_couplings(std::vector<libint2::Engine> &engines,
+                                     namd::IntegralStats &stats,
+                                     const std::vector<Shell> &shells_1,
+                                     const std::vector<Shell> &shells_2,
+                                     const std::vector<bool> &stale_1,
+                                     const std::vector<bool> &stale_2,
+                                     double threshold, Matrix &result,
+                                     namd::ShellRanges &stored) {
+  // Distribute the computations among the threads, one engine per thread
+  const int nthreads = static_cast<int>(engines.size());
+  const size_t nshells = shells_1.size();
+
+  // Number of shell pairs computed by each thread
+  std::vector<size_t> computed(nthreads, 0);
+
+  ShellScreening screening(shells_1, threshold);
+  auto shell2bf = map_shell_to_basis_function(shells_1);
+  shell2bf.push_back(nbasis(shells_1));
+  auto neighbours = screening.shell_ranges(shells_1, shells_2, false);
+  if (stored.size() != nshells)
+    stored = namd::ShellRanges(nshells);
+
+  // Zero the stale blocks of the previous positions and collect the stale
+  // pairs of neighbouring shells at the new positions
+  namd::ShellRanges stale_pairs(nshells);
+  std::vector<size_t> kept;
+  for (size_t s1 = 0; s1 != nshells; ++s1) {
+    const int bf1 = shell2bf[s1];
+    const int n1 = shells_1[s1].size();
+    kept.clear();
+    for (const auto &range : stored[s1]) {
+      for (size_t s2 = range.first; s2 != range.second; ++s2) {
+        if (stale_1[s1] || stale_2[s2])
+          result.block(bf1, shell2bf[s2], n1, shell2bf[s2 + 1] - shell2bf[s2])
+              .setZero();
+        else
+          kept.push_back(s2);
+      }
+    }
+    for (const auto &range : neighbours[s1]) {
+      for (size_t s2 = range.first; s2 != range.second; ++s2) {
+        if (stale_1[s1] || stale_2[s2]) {
+          append_shell(stale_pairs[s1], s2);
+          kept.push_back(s2);
+        }
+      }
+    }
+    std::sort(kept.begin(), kept.end());
+    stored[s1].clear();
+    for (size_t s2 : kept)
+      append_shell(stored[s1], s2);
+  }
+
+  // Function to compute a block of shell pairs {s1, s2}
+  auto compute = [&](int thread_id, const namd::ShellBlock &block) {
     // buf[0] points to the target shell set after every call  to
     // engine.compute()
     const auto &buf = engines[thread_id].results();
 
-    // loop over unique shell pairs, {s1,s2}
-    for (int s1 = 0; s1 != static_cast<int>(shells_1.size()); ++s1) {
+    const auto s1 = block.s1;
+    int bf1 = shell2bf[s1]; // first basis function in this shell
+    int n1 = shells_1[s1].size();
 
-      int bf1 = shell2bf[s1]; // first basis function in this shell
-      int n1 = shells_1[s1].size();
+    for (size_t s2 = block.begin; s2 != block.end; ++s2) {
+      // the blocks of the pairs of shells that are too far apart are zero
+      if (screening.is_screened(s1, s2, shells_1[s1], shells_2[s2]))
+        continue;
+      computed[thread_id] += 1;
 
-      for (int s2 = 0; s2 != static_cast<int>(shells_2.size()); ++s2) {
-        int acc = s2 + s1 * shells_1.size();
-        if (acc % nthreads != thread_id)
-          continue;
+      // extract basis
+      int bf2 = shell2bf[s2];
+      int n2 = shells_2[s2].size();
 
-        // extract basis
-        int bf2 = shell2bf[s2];
-        int n2 = shells_2[s2].size();
+      // compute shell pair and return pointer to the buffer
+      engines[thread_id].compute(shells_1[s1], shells_2[s2]);
 
-        // compute shell pair and return pointer to the buffer
-        engines[thread_id].compute(shells_1[s1], shells_2[s2]);
+      // "map" buffer to a const Eigen Matrix, and copy it to the
+      // corresponding blocks of the result
+      Eigen::Map<const Matrix> buf_mat(buf[0], n1, n2);
+      result.block(bf1, bf2, n1, n2) = buf_mat;
+    }
+  }; // compute lambda
 
-        // "map" buffer to a const Eigen Matrix, and copy it to the
-        // corresponding blocks of the result
-        Eigen::Map<const Matrix> buf_mat(buf[0], n1, n2);
-        result.block(bf1, bf2, n1, n2) = buf_mat;
-      }
+  run_shell_blocks(make_shell_blocks(shells_1, {stale_pairs}, nthreads),
+                   compute, nthreads, stats.load_balance);
+
+  // The pairs of shells that have not moved are reused, the other pairs are
+  // either computed or skipped
+  const size_t reused =
+      static_cast<size_t>(std::count(stale_1.cbegin(), stale_1.cend(), false)) *
+      static_cast<size_t>(std::count(stale_2.cbegin(), stale_2.cend(), false));
+  const size_t total = nshells * shells_2.size();
+  stats.screening = {
+      total - reused -
+          std::accumulate(computed.cbegin(), computed.cend(), size_t(0)),
+      total};
+
+  return reused;
+}
+
+/**
+ * \brief Compute the overlap integrals between several pairs of geometries
+ * of a trajectory. The work is distributed over both the pairs of geometries
+ * and the shell pairs, so that small molecules also keep all the threads
+ * busy. `result` must point to a zero initialized (n_pairs, n, n) buffer.
+ */
+void compute_overlaps_for_trajectory(
+    std::vector<libint2::Engine> &engines, namd::IntegralStats &stats,
+    const std::vector<std::vector<Shell>> &frames,
+    const std::vector<std::pair<int, int>> &pairs, double threshold,
+    double *result) {
+  // One engine per thread
+  const int nthreads = static_cast<int>(engines.size());
+
+  // All the geometries share the same basis set
+  const auto &shells = frames[0];
+  const size_t nshells = shells.size();
+  const auto n = nbasis(shells);
+
+  // Number of shell pairs computed by each thread, only the pairs of
+  // neighbouring atoms are visited
+  std::vector<size_t> computed(nthreads, 0);
+  ShellScreening screening(shells, threshold);
+  std::vector<namd::ShellRanges> ranges;
+  ranges.reserve(pairs.size());
+  for (const auto &pair : pairs)
+    ranges.push_back(screening.shell_ranges(frames[pair.first],
+                                            frames[pair.second], false));
+
+  auto shell2bf = map_shell_to_basis_function(shells);
+
+  auto compute = [&](int thread_id, const namd::ShellBlock &block) {
+    const auto &buf = engines[thread_id].results();
+
+    const auto &shells_1 = frames[pairs[block.pair].first];
+    const auto &shells_2 = frames[pairs[block.pair].second];
+    Eigen::Map<Matrix> overlap(result + block.pair * n * n, n, n);
+
+    const auto s1 = block.s1;
+    int bf1 = shell2bf[s1];
+    int n1 = shells_1[s1].size();
+
+    for (size_t s2 = block.begin; s2 != block.end; ++s2) {
+      if (screening.is_screened(s1, s2, shells_1[s1], shells_2[s2]))
+        continue;
+      computed[thread_id] += 1;
+
+      int bf2 = shell2bf[s2];
+      int n2 = shells_2[s2].size();
+
+      engines[thread_id].compute(shells_1[s1], shells_2[s2]);
+      Eigen::Map<const Matrix> buf_mat(buf[0], n1, n2);
+      overlap.block(bf1, bf2, n1, n2) = buf_mat;
     }
   }; // compute lambda
 
-  libint2::parallel_do(compute);
+  run_shell_blocks(make_shell_blocks(shells, ranges, nthreads), compute,
+                   nthreads, stats.load_balance);
 
+  const size_t total = pairs.size() * nshells * nshells;
+  stats.screening = {
+      total - std::accumulate(computed.cbegin(), computed.cend(), size_t(0)),
+      total};
+}
+
+/**
+ * \brief Compute the overlap integrals between two set of shells at different
+ * atomic positions
+ */
+Matrix compute_overlaps_for_couplings(std::vector<libint2::Engine> &engines,
+                                      namd::IntegralStats &stats,
+                                      const std::vector<Shell> &shells_1,
+                                      const std::vector<Shell> &shells_2,
+                                      double threshold) {
+  const auto n = nbasis(shells_1);
+  Matrix result = Matrix::Zero(n, n);
+  compute_overlaps_for_trajectory(engines, stats, {shells_1, shells_2},
+                                  {{0, 1}}, threshold, result.data());
   return result;
 }
 
+/**
+ * \brief Compute the overlap between the molecular orbitals of several pairs
+ * of geometries, C1^T S(R1, R2) C2, without building the atomic orbitals
+ * overlap. For each block of shell pairs only the corresponding rows of S are
+ * computed and contracted with the coefficients, therefore each thread holds
+ * a single (shell size, n) block. Each thread accumulates its own molecular
+ * orbitals overlaps, which are added together once all the blocks are done.
+ * `coefficients_1` and `coefficients_2` point to (n_pairs, n, m1) and
+ * (n_pairs, n, m2) arrays, and `result` to a zero initialized
+ * (n_pairs, m1, m2) buffer.
+ */
+void compute_mo_overlaps_for_trajectory(
+    std::vector<libint2::Engine> &engines, namd::IntegralStats &stats,
+    const std::vector<std::vector<Shell>> &frames,
+    const std::vector<std::pair<int, int>> &pairs,
+    const double *coefficients_1, const double *coefficients_2, size_t m1,
+    size_t m2, double threshold, double *result) {
+  // One engine per thread
+  const int nthreads = static_cast<int>(engines.size());
+
+  const auto &shells = frames[0];
+  const size_t nshells = shells.size();
+  const auto n = nbasis(shells);
+  size_t max_size = 0;
+  for (const auto &shell : shells)
+    max_size = std::max(max_size, shell.size());
+
+  std::vector<size_t> computed(nthreads, 0);
+  ShellScreening screening(shells, threshold);
+  std::vector<namd::ShellRanges> ranges;
+  ranges.reserve(pairs.size());
+  for (const auto &pair : pairs)
+    ranges.push_back(screening.shell_ranges(frames[pair.first],
+                                            frames[pair.second], false));
+
+  auto shell2bf = map_shell_to_basis_function(shells);
+  shell2bf.push_back(n);
+
+  // Rows of the atomic overlap for the current block of each thread, their
+  // product with the coefficients of the columns and the (m1, m2) overlaps
+  // of every pair accumulated by the thread, which are reduced at the end
+  std::vector<Matrix> rows(nthreads, Matrix(max_size, n));
+  std::vector<Matrix> contracted(nthreads, Matrix(max_size, m2));
+  std::vector<Matrix> accumulated(nthreads,
+                                  Matrix::Zero(m1, m2 * pairs.size()));
+
+  auto compute = [&](int thread_id, const namd::ShellBlock &block) {
+    const auto &buf = engines[thread_id].results();
+
+    const auto p = block.pair;
+    const auto &shells_1 = frames[pairs[p].first];
+    const auto &shells_2 = frames[pairs[p].second];
+    Eigen::Map<const Matrix> css1(coefficients_1 + p * n * m1, n, m1);
+    Eigen::Map<const Matrix> css2(coefficients_2 + p * n * m2, n, m2);
+
+    const auto s1 = block.s1;
+    int bf1 = shell2bf[s1];
+    int n1 = shells_1[s1].size();
+    // basis functions of the columns in this block
+    int first = shell2bf[block.begin];
+    int width = shell2bf[block.end] - first;
+    auto block_rows = rows[thread_id].block(0, first, n1, width);
+    block_rows.setZero();
+
+    for (size_t s2 = block.begin; s2 != block.end; ++s2) {
+      if (screening.is_screened(s1, s2, shells_1[s1], shells_2[s2]))
+        continue;
+      computed[thread_id] += 1;
+      int bf2 = shell2bf[s2];
+      int n2 = shells_2[s2].size();
+
+      engines[thread_id].compute(shells_1[s1], shells_2[s2]);
+      Eigen::Map<const Matrix> buf_mat(buf[0], n1, n2);
+      rows[thread_id].block(0, bf2, n1, n2) = buf_mat;
+    }
+    auto block_contracted = contracted[thread_id].topRows(n1);
+    block_contracted.noalias() = block_rows * css2.middleRows(first, width);
+    accumulated[thread_id].middleCols(p * m2, m2).noalias() +=
+        css1.middleRows(bf1, n1).transpose() * block_contracted;
+  }; // compute lambda
+
+  run_shell_blocks(make_shell_blocks(shells, ranges, nthreads), compute,
+                   nthreads, stats.load_balance);
+
+  for (size_t p = 0; p != pairs.size(); ++p) {
+    Eigen::Map<Matrix> overlap(result + p * m1 * m2, m1, m2);
+    for (const auto &thread_overlaps : accumulated)
+      overlap += thread_overlaps.middleCols(p * m2, m2);
+  }
+
+  const size_t total = pairs.size() * nshells * nshells;
+  stats.screening = {
+      total - std::accumulate(computed.cbegin(), computed.cend(), size_t(0)),
+      total};
+}
+
+/**
+ * \brief Compute the multipole integrals writing the matrix of each operator
+ * component into `buffer`, which must point to a zero initialized C ordered
+ * (nopers, n, n) array.
+ */
 template <Operator operator_type,
           typename OperatorParams = typename libint2::operator_traits<
               operator_type>::oper_params_type>
-std::vector<Matrix> compute_multipoles(
-    const std::vector<libint2::Shell> &shells,
-    OperatorParams oparams =
-        OperatorParams()) { // Compute different type of multipole integrals in
+void compute_multipoles(
+    std::vector<libint2::Engine> &engines, namd::IntegralStats &stats,
+    const std::vector<libint2::Shell> &shells, double *buffer,
+    OperatorParams oparams = OperatorParams(),
+    double threshold = 0) { // Compute different type of multipole integrals in
                             // different threads
-  using libint2::nthreads;
+  // One engine per thread
+  const int nthreads = static_cast<int>(engines.size());
 
   constexpr unsigned int nopers =
       libint2::operator_traits<operator_type>::nopers;
@@ -218,66 +867,210 @@ std::vector<Matrix> compute_multipoles(
   // number of shells
   const auto n = nbasis(shells);
 
-  std::vector<Matrix> result(nopers);
-  for (auto &r : result)
-    r = Matrix::Zero(n, n);
-
-  // construct the multipole engine integrals engine
-  std::vector<libint2::Engine> engines(nthreads);
-  engines[0] =
-      libint2::Engine(operator_type, max_nprim(shells), max_l(shells), 0);
+  std::vector<Eigen::Map<Matrix>> result;
+  result.reserve(nopers);
+  for (unsigned int op = 0; op != nopers; ++op)
+    result.emplace_back(buffer + op * n * n, n, n);
 
   // pass operator params to the engines
-  engines[0].set_params(oparams);
-  for (int i = 1; i != nthreads; ++i) {
-    engines[i] = engines[0];
-  }
+  for (auto &engine : engines)
+    engine.set_params(oparams);
 
   auto shell2bf = map_shell_to_basis_function(shells);
 
-  // Function to compute the integrals in parallel
-  auto compute = [&](int thread_id) {
+  // Number of shell pairs computed by each thread, only the pairs of
+  // neighbouring atoms are visited
+  std::vector<size_t> computed(nthreads, 0);
+  ShellScreening screening(shells, threshold);
+
+  // Function to compute a block of shell pairs
+  auto compute = [&](int thread_id, const namd::ShellBlock &block) {
     // buf[0] points to the target shell set after every call  to
     // engines.compute()
     const auto &buf = engines[thread_id].results();
 
-    // loop over unique shell pairs, {s1,s2} such that s1 >= s2
-    // this is due to the permutational symmetry of the real integrals over
-    // Hermitian operators: (1|2) = (2|1)
-    for (int s1 = 0; s1 != static_cast<int>(shells.size()); ++s1) {
+    // the blocks only contain the unique shell pairs, {s1,s2} such that
+    // s1 >= s2 this is due to the permutational symmetry of the real
+    // integrals over Hermitian operators: (1|2) = (2|1)
+    const auto s1 = block.s1;
+    int bf1 = shell2bf[s1]; // first basis function in this shell
+    int n1 = shells[s1].size();
 
-      int bf1 = shell2bf[s1]; // first basis function in this shell
-      int n1 = shells[s1].size();
+    for (size_t s2 = block.begin; s2 != block.end; ++s2) {
+      // skip the pairs of shells that are too far apart
+      if (screening.is_screened(s1, s2, shells[s1], shells[s2]))
+        continue;
+      computed[thread_id] += 1;
 
-      for (int s2 = 0; s2 <= s1; ++s2) {
-        // Select integrals for current thread
-        int acc = s2 + s1 * shells.size();
-        if (acc % nthreads != thread_id)
-          continue;
+      int bf2 = shell2bf[s2];
+      int n2 = shells[s2].size();
 
-        int bf2 = shell2bf[s2];
-        int n2 = shells[s2].size();
+      // compute shell pair
+      engines[thread_id].compute(shells[s1], shells[s2]);
 
-        // compute shell pair
-        engines[thread_id].compute(shells[s1], shells[s2]);
+      for (unsigned int op = 0; op != nopers; ++op) {
+        // "map" buffer to a const Eigen Matrix, and copy it to the
+        // corresponding blocks of the result
+        Eigen::Map<const Matrix> buf_mat(buf[op], n1, n2);
+        result[op].block(bf1, bf2, n1, n2) = buf_mat;
+        if (s1 != s2) // if s1 >= s2, copy {s1,s2} to the corresponding
+                      // {s2,s1} block, note the transpose!
+          result[op].block(bf2, bf1, n2, n1) = buf_mat.transpose();
+      }
+    }
+  }; // compute lambda
+  run_shell_blocks(
+      make_shell_blocks(shells, {screening.shell_ranges(shells, shells, true)},
+                        nthreads),
+      compute, nthreads, stats.load_balance);
+
+  const size_t total = shells.size() * (shells.size() + 1) / 2;
+  stats.screening = {
+      total - std::accumulate(computed.cbegin(), computed.cend(), size_t(0)),
+      total};
+}
 
-        for (int op = 0; op != nopers; ++op) {
-          // "map" buffer to a const Eigen Matrix, and copy it to the
-          // corresponding blocks of the result
-          Eigen::Map<const Matrix> buf_mat(buf[op], n1, n2);
-          result[op].block(bf1, bf2, n1, n2) = buf_mat;
-          if (s1 != s2) // if s1 >= s2, copy {s1,s2} to the corresponding
-                        // {s2,s1} block, note the transpose!
-            result[op].block(bf2, bf1, n2, n1) = buf_mat.transpose();
+/**
+ * \brief Compute the multipole integrals as atom-block sparse matrices.
+ * The blocks between two atoms where all the integrals are smaller than
+ * `drop_tolerance` are not stored.
+ */
+template <Operator operator_type,
+          typename OperatorParams = typename libint2::operator_traits<
+              operator_type>::oper_params_type>
+std::vector<namd::SparseMatrix>
+compute_sparse_multipoles(std::vector<libint2::Engine> &engines,
+                          namd::IntegralStats &stats,
+                          const std::vector<libint2::Shell> &shells,
+                          OperatorParams oparams = OperatorParams(),
+                          double threshold = 0, double drop_tolerance = 0) {
+  // One engine per thread
+  const int nthreads = static_cast<int>(engines.size());
+  using Triplet = Eigen::Triplet<namd::real_t>;
+
+  constexpr unsigned int nopers =
+      libint2::operator_traits<operator_type>::nopers;
+
+  const auto n = nbasis(shells);
+
+  for (auto &engine : engines)
+    engine.set_params(oparams);
+
+  auto shell2bf = map_shell_to_basis_function(shells);
+  shell2bf.push_back(n);
+  auto atom2shell = map_atom_to_shell(shells);
+  const size_t natoms = atom2shell.size() - 1;
+  ShellScreening screening(shells, threshold);
+
+  // One block per atom i and range of neighbouring atoms j <= i, the largest
+  // first
+  std::vector<double> cost(natoms + 1, 0);
+  for (size_t i = 0; i != natoms; ++i) {
+    double atom_cost = 0;
+    for (size_t s = atom2shell[i]; s != atom2shell[i + 1]; ++s)
+      atom_cost += shell_cost(shells[s]);
+    cost[i + 1] = cost[i] + atom_cost;
+  }
+  auto ranges = screening.atom_ranges(shells, shells);
+  std::vector<namd::ShellBlock> blocks;
+  blocks.reserve(natoms);
+  for (size_t i = 0; i != natoms; ++i) {
+    for (const auto &range : ranges[i]) {
+      const size_t end = std::min(range.second, i + 1);
+      if (range.first < end)
+        blocks.push_back({0, i, range.first, end,
+                          (cost[i + 1] - cost[i]) * (cost[end] - cost[range.first])});
+    }
+  }
+  std::stable_sort(blocks.begin(), blocks.end(),
+                   [](const namd::ShellBlock &a, const namd::ShellBlock &b) {
+                     return a.cost > b.cost;
+                   });
+
+  // Non-zero entries found by each thread for each operator
+  std::vector<std::vector<std::vector<Triplet>>> triplets(
+      nthreads, std::vector<std::vector<Triplet>>(nopers));
+  std::vector<size_t> computed(nthreads, 0);
+
+  auto compute = [&](int thread_id, const namd::ShellBlock &block) {
+    const auto &buf = engines[thread_id].results();
+
+    const size_t i = block.s1;
+    const int row = shell2bf[atom2shell[i]];
+    const int nrows = shell2bf[atom2shell[i + 1]] - row;
+
+    for (size_t j = block.begin; j != block.end; ++j) {
+      const int col = shell2bf[atom2shell[j]];
+      const int ncols = shell2bf[atom2shell[j + 1]] - col;
+      std::vector<Matrix> local(nopers, Matrix::Zero(nrows, ncols));
+
+      for (size_t s1 = atom2shell[i]; s1 != atom2shell[i + 1]; ++s1) {
+        for (size_t s2 = atom2shell[j]; s2 != atom2shell[j + 1]; ++s2) {
+          if (screening.is_screened(s1, s2, shells[s1], shells[s2]))
+            continue;
+          // the diagonal blocks are computed in full, count the pairs once
+          if (s2 <= s1)
+            computed[thread_id] += 1;
+          int n1 = shells[s1].size();
+          int n2 = shells[s2].size();
+          engines[thread_id].compute(shells[s1], shells[s2]);
+          for (unsigned int op = 0; op != nopers; ++op) {
+            Eigen::Map<const Matrix> buf_mat(buf[op], n1, n2);
+            local[op].block(shell2bf[s1] - row, shell2bf[s2] - col, n1, n2) =
+                buf_mat;
+          }
+        }
+      }
+
+      for (unsigned int op = 0; op != nopers; ++op) {
+        if (local[op].cwiseAbs().maxCoeff() < drop_tolerance)
+          continue;
+        auto &entries = triplets[thread_id][op];
+        for (int r = 0; r != nrows; ++r) {
+          for (int c = 0; c != ncols; ++c) {
+            entries.emplace_back(row + r, col + c, local[op](r, c));
+            if (i != j) // copy the {j, i} block, note the transpose!
+              entries.emplace_back(col + c, row + r, local[op](r, c));
+          }
         }
       }
     }
   }; // compute lambda
-  libint2::parallel_do(compute);
 
+  run_shell_blocks(blocks, compute, nthreads, stats.load_balance);
+
+  const size_t nshells = shells.size();
+  const size_t total = nshells * (nshells + 1) / 2;
+  stats.screening = {
+      total - std::accumulate(computed.cbegin(), computed.cend(), size_t(0)),
+      total};
+
+  std::vector<namd::SparseMatrix> result(nopers,
+                                         namd::SparseMatrix(n, n));
+  for (unsigned int op = 0; op != nopers; ++op) {
+    std::vector<Triplet> entries;
+    for (auto &thread_entries : triplets)
+      entries.insert(entries.end(), thread_entries[op].cbegin(),
+                     thread_entries[op].cend());
+    result[op].setFromTriplets(entries.cbegin(), entries.cend());
+  }
   return result;
 }
 
+/**
+ * \brief Number of operator components of the given multipole.
+ */
+size_t multipole_components(const string &multipole) {
+  if (multipole == "overlap")
+    return libint2::operator_traits<Operator::overlap>::nopers;
+  else if (multipole == "dipole")
+    return libint2::operator_traits<Operator::emultipole1>::nopers;
+  else if (multipole == "quadrupole")
+    return libint2::operator_traits<Operator::emultipole2>::nopers;
+  else
+    throw std::runtime_error("Unkown multipole");
+}
+
 libint2::svector<int> read_basisFormat(const string &basisFormat) {
   // Transform the string containing the basis format for CP2K, into a vector of
   // strings
@@ -358,21 +1151,6 @@ std::vector<string> get_unique_symbols(const std::vector<Atom> &atoms) {
   return symbols;
 }
 
-std::unordered_map<string, CP2K_Basis_Atom>
-create_map_symbols_basis(const string &path_hdf5,
-                         const std::vector<Atom> &atoms, const string &basis) {
-  // Function to generate a map from symbols to basis specification
-
-  std::unordered_map<string, CP2K_Basis_Atom> dict;
-
-  // Select the unique atomic symbols
-  std::vector<string> symbols = get_unique_symbols(atoms);
-  for (const auto &at : symbols)
-    dict[at] = read_basis_from_hdf5(path_hdf5, at, basis);
-
-  return dict;
-}
-
 /**
  * \brief Create the shell specification for a given atom.
  */
@@ -410,52 +1188,22 @@ libint2::svector<Shell> create_shells_for_atom(const CP2K_Basis_Atom &data,
 }
 
 /**
- * \brief Make the shell for a CP2K specific basis
+ * \brief Make the shell for a CP2K specific basis using the basis set
+ * specification of each element
  */
-std::vector<Shell> make_cp2k_basis(const std::vector<Atom> &atoms,
-                                   const string &path_hdf5,
-                                   const string &basis) {
+std::vector<Shell>
+make_cp2k_basis(const std::vector<Atom> &atoms,
+                const std::unordered_map<string, CP2K_Basis_Atom> &dict) {
   std::vector<Shell> shells;
 
-  // set of symbols
-  std::vector<string> symbols = get_unique_symbols(atoms);
-
-  // Read basis set data from the HDF5
-  std::unordered_map<string, CP2K_Basis_Atom> dict =
-      create_map_symbols_basis(path_hdf5, atoms, basis);
-
   for (const auto &atom : atoms) {
-
-    CP2K_Basis_Atom data = dict[map_elements[atom.atomic_number]];
+    const CP2K_Basis_Atom &data = dict.at(map_elements[atom.atomic_number]);
     auto xs = create_shells_for_atom(data, atom);
     shells.insert(shells.end(), xs.begin(), xs.end());
   }
 
   return shells;
 }
-Matrix compute_integrals_couplings(const string &path_xyz_1,
-                                   const string &path_xyz_2,
-                                   const string &path_hdf5,
-                                   const string &basis_name) {
-
-  set_nthread();
-  std::vector<Atom> mol_1 = read_xyz_from_file(path_xyz_1);
-  std::vector<Atom> mol_2 = read_xyz_from_file(path_xyz_2);
-
-  auto shells_1 = make_cp2k_basis(mol_1, path_hdf5, basis_name);
-  auto shells_2 = make_cp2k_basis(mol_2, path_hdf5, basis_name);
-
-  // safe to use libint now
-  libint2::initialize();
-
-  // compute Overlap integrals
-  auto S = compute_overlaps_for_couplings(shells_1, shells_2);
-
-  // stop using libint2
-  libint2::finalize();
-
-  return S;
-}
 
 /**
  * \brief Compute the center of mass for atoms
@@ -479,54 +1227,589 @@ std::array<double, 3> calculate_center_of_mass(const std::vector<Atom> &atoms) {
 }
 
 /**
- * \brief compute the given multipole.
+ * \brief Keep libint, the basis set and the integral engines alive between
+ * calls, so that the whole trajectory is computed with a single setup.
  */
-std::vector<Matrix> select_multipole(const std::vector<Atom> &atoms,
-                                     const std::vector<Shell> &shells,
-                                     const string &multipole) {
-  // Compute multipole at the center of mass
-  std::array<double, 3> center = calculate_center_of_mass(atoms);
+class IntegralSession {
+public:
+  IntegralSession(const string &path_hdf5, const string &basis_name,
+                  int nthreads)
+      : path_hdf5(path_hdf5), basis_name(basis_name),
+        nthreads(number_of_threads(nthreads)) {
+    // safe to use libint now
+    std::lock_guard<std::mutex> lock(libint_mutex);
+    if (active_sessions++ == 0)
+      libint2::initialize();
+  }
 
-  if (multipole == "overlap")
-    return compute_multipoles<Operator::overlap>(shells);
-  else if (multipole == "dipole")
-    return compute_multipoles<Operator::emultipole1>(shells, center);
-  else if (multipole == "quadrupole")
-    return compute_multipoles<Operator::emultipole2>(shells, center);
-  else
-    throw std::runtime_error("Unkown multipole");
-}
+  ~IntegralSession() {
+    // stop using libint2 when the last session is gone
+    std::lock_guard<std::mutex> lock(libint_mutex);
+    if (--active_sessions == 0)
+      libint2::finalize();
+  }
 
-/**
- * \brief   Compute the overlap integrals for the molecule define in `path_xyz`
- * using the `basis_name`
- */
-Matrix compute_integrals_multipole(const string &path_xyz,
-                                   const string &path_hdf5,
-                                   const string &basis_name,
-                                   const string &multipole) {
-  set_nthread();
-  std::vector<Atom> mol = read_xyz_from_file(path_xyz);
+  IntegralSession(const IntegralSession &) = delete;
+  IntegralSession &operator=(const IntegralSession &) = delete;
+
+  /**
+   * \brief Number of threads used by this session
+   */
+  int get_nthreads() const { return nthreads; }
+
+  /**
+   * \brief Number of skipped and total shell pairs in the last computation
+   * of this session.
+   */
+  std::tuple<size_t, size_t> screening_stats() {
+    std::lock_guard<std::mutex> lock(mutex);
+    return std::make_tuple(stats.screening.skipped, stats.screening.total);
+  }
+
+  /**
+   * \brief Thread utilisation, number of blocks of shell pairs and number of
+   * threads in the last computation of this session.
+   */
+  std::tuple<double, size_t, int> load_balance() {
+    std::lock_guard<std::mutex> lock(mutex);
+    return std::make_tuple(stats.load_balance.utilisation,
+                           stats.load_balance.blocks,
+                           stats.load_balance.nthreads);
+  }
+
+  /**
+   * \brief Number of reused and total shell pairs in the last incremental
+   * overlap of this session.
+   */
+  std::tuple<size_t, size_t> reuse_stats() {
+    std::lock_guard<std::mutex> lock(mutex);
+    return std::make_tuple(stats.reuse.reused, stats.reuse.total);
+  }
+
+  /**
+   * \brief Compute the overlap integrals between the molecules
+   * defined in `path_xyz_1` and `path_xyz_2`.
+   */
+  Matrix cross_overlap(const string &path_xyz_1, const string &path_xyz_2,
+                       double threshold) {
+    return cross_overlap(read_xyz_from_file(path_xyz_1),
+                         read_xyz_from_file(path_xyz_2), threshold);
+  }
+
+  /**
+   * \brief Compute the overlap integrals between two geometries given as
+   * (n_atoms, 3) arrays in Angstrom sharing the same atomic numbers.
+   */
+  Matrix cross_overlap(const Eigen::Ref<const Matrix> &coordinates_1,
+                       const Eigen::Ref<const Matrix> &coordinates_2,
+                       const std::vector<int> &atomic_numbers,
+                       double threshold) {
+    return cross_overlap(atoms_from_coordinates(coordinates_1, atomic_numbers),
+                         atoms_from_coordinates(coordinates_2, atomic_numbers),
+                         threshold);
+  }
+
+  /**
+   * \brief Compute the overlap integrals between two geometries given as
+   * (n_atoms, 3) arrays in Angstrom reusing the blocks of the previous call.
+   * Only the shell pairs of the atoms that moved more than `tolerance`
+   * Angstrom from the geometry where their blocks were last computed are
+   * recomputed.
+   */
+  Matrix cross_overlap_incremental(const Eigen::Ref<const Matrix> &coordinates_1,
+                                   const Eigen::Ref<const Matrix> &coordinates_2,
+                                   const std::vector<int> &atomic_numbers,
+                                   double tolerance, double threshold) {
+    auto mol_1 = atoms_from_coordinates(coordinates_1, atomic_numbers);
+    auto mol_2 = atoms_from_coordinates(coordinates_2, atomic_numbers);
+
+    std::lock_guard<std::mutex> lock(mutex);
+    auto shells_1 = make_shells(mol_1);
+    auto shells_2 = make_shells(mol_2);
+    auto &engines = get_engines(
+        Operator::overlap, std::max(max_nprim(shells_1), max_nprim(shells_2)),
+        std::max(max_l(shells_1), max_l(shells_2)));
+
+    // Start from scratch if the cached blocks were computed for another
+    // molecule, basis set or screening threshold
+    auto &cache = incremental;
+    if (cache.atomic_numbers != atomic_numbers ||
+        cache.basis_name != basis_name || cache.threshold != threshold) {
+      const auto n = nbasis(shells_1);
+      cache.overlap = Matrix::Zero(n, n);
+      cache.atomic_numbers = atomic_numbers;
+      cache.basis_name = basis_name;
+      cache.threshold = threshold;
+      cache.reference_1.clear();
+      cache.reference_2.clear();
+      cache.ranges.clear();
+    }
+    auto stale_1 = find_stale_shells(mol_1, shells_1, cache.reference_1,
+                                     tolerance * namd::angstrom_to_bohr);
+    auto stale_2 = find_stale_shells(mol_2, shells_2, cache.reference_2,
+                                     tolerance * namd::angstrom_to_bohr);
+
+    auto reused = update_overlaps_for_couplings(
+        engines, stats, shells_1, shells_2, stale_1, stale_2, threshold,
+        cache.overlap, cache.ranges);
+    stats.reuse = {reused, shells_1.size() * shells_2.size()};
+
+    return cache.overlap;
+  }
+
+  /**
+   * \brief Forget the overlap cached by the incremental cross overlaps,
+   * releasing its memory.
+   */
+  void reset_incremental() {
+    std::lock_guard<std::mutex> lock(mutex);
+    incremental = IncrementalCache();
+  }
+
+  /**
+   * \brief Compute the overlap integrals between the pairs of geometries
+   * `pairs` of a trajectory given as an (n_frames, n_atoms, 3) array in
+   * Angstrom. Returns an (n_pairs, n, n) array.
+   */
+  py::array_t<double> cross_overlaps(
+      py::array_t<double, py::array::c_style | py::array::forcecast>
+          coordinates,
+      const std::vector<int> &atomic_numbers,
+      const std::vector<std::pair<int, int>> &pairs, double threshold) {
+    auto molecules = read_frames(coordinates, atomic_numbers, pairs);
+
+    size_t n = 0;
+    {
+      py::gil_scoped_release release;
+      std::lock_guard<std::mutex> lock(mutex);
+      n = nbasis(make_shells(molecules.at(0)));
+    }
+    py::array_t<double> result({pairs.size(), n, n});
+    double *buffer = result.mutable_data();
+    std::fill(buffer, buffer + result.size(), 0.0);
+
+    {
+      py::gil_scoped_release release;
+      std::lock_guard<std::mutex> lock(mutex);
+      std::vector<std::vector<Shell>> frames;
+      frames.reserve(molecules.size());
+      for (const auto &atoms : molecules)
+        frames.push_back(make_shells(atoms));
+      auto &engines = get_engines(Operator::overlap, max_nprim(frames[0]),
+                                  max_l(frames[0]));
+      compute_overlaps_for_trajectory(engines, stats, frames, pairs,
+                                      threshold, buffer);
+    }
+    return result;
+  }
+
+  /**
+   * \brief Compute the overlap between the molecular orbitals of two
+   * geometries, C1^T S C2, without building the atomic orbitals overlap.
+   * `coefficients_1` and `coefficients_2` contain only the active space.
+   */
+  Matrix cross_overlap_mo(const Eigen::Ref<const Matrix> &coordinates_1,
+                          const Eigen::Ref<const Matrix> &coordinates_2,
+                          const std::vector<int> &atomic_numbers,
+                          const Matrix &coefficients_1,
+                          const Matrix &coefficients_2, double threshold) {
+    auto mol_1 = atoms_from_coordinates(coordinates_1, atomic_numbers);
+    auto mol_2 = atoms_from_coordinates(coordinates_2, atomic_numbers);
+
+    std::lock_guard<std::mutex> lock(mutex);
+    std::vector<std::vector<Shell>> frames{make_shells(mol_1),
+                                           make_shells(mol_2)};
+    check_coefficients(frames[0], coefficients_1.rows(),
+                       coefficients_2.rows());
+    auto &engines = get_engines(Operator::overlap, max_nprim(frames[0]),
+                                max_l(frames[0]));
+
+    Matrix result = Matrix::Zero(coefficients_1.cols(), coefficients_2.cols());
+    compute_mo_overlaps_for_trajectory(
+        engines, stats, frames, {{0, 1}}, coefficients_1.data(),
+        coefficients_2.data(), coefficients_1.cols(), coefficients_2.cols(),
+        threshold, result.data());
+    return result;
+  }
+
+  /**
+   * \brief Compute the overlap between the molecular orbitals of the pairs
+   * of geometries `pairs` of a trajectory given as an (n_frames, n_atoms, 3)
+   * array in Angstrom. The active space coefficients of each pair are given
+   * as (n_pairs, n, m1) and (n_pairs, n, m2) arrays. Returns an
+   * (n_pairs, m1, m2) array.
+   */
+  py::array_t<double> cross_overlaps_mo(
+      py::array_t<double, py::array::c_style | py::array::forcecast>
+          coordinates,
+      const std::vector<int> &atomic_numbers,
+      const std::vector<std::pair<int, int>> &pairs,
+      py::array_t<double, py::array::c_style | py::array::forcecast>
+          coefficients_1,
+      py::array_t<double, py::array::c_style | py::array::forcecast>
+          coefficients_2,
+      double threshold) {
+    auto molecules = read_frames(coordinates, atomic_numbers, pairs);
+    for (const auto *coefficients : {&coefficients_1, &coefficients_2})
+      if (coefficients->ndim() != 3 ||
+          static_cast<size_t>(coefficients->shape(0)) != pairs.size())
+        throw std::invalid_argument(
+            "coefficients must be an (n_pairs, n, m) array");
+    const size_t m1 = coefficients_1.shape(2);
+    const size_t m2 = coefficients_2.shape(2);
+
+    py::array_t<double> result({pairs.size(), m1, m2});
+    double *buffer = result.mutable_data();
+    std::fill(buffer, buffer + result.size(), 0.0);
+
+    {
+      py::gil_scoped_release release;
+      std::lock_guard<std::mutex> lock(mutex);
+      std::vector<std::vector<Shell>> frames;
+      frames.reserve(molecules.size());
+      for (const auto &atoms : molecules)
+        frames.push_back(make_shells(atoms));
+      check_coefficients(frames[0], coefficients_1.shape(1),
+                         coefficients_2.shape(1));
+      auto &engines = get_engines(Operator::overlap, max_nprim(frames[0]),
+                                  max_l(frames[0]));
+      compute_mo_overlaps_for_trajectory(
+          engines, stats, frames, pairs, coefficients_1.data(),
+          coefficients_2.data(), m1, m2, threshold, buffer);
+    }
+    return result;
+  }
+
+  /**
+   * \brief Compute the overlap integrals for the molecule in `path_xyz`
+   * as an (n, n) array.
+   */
+  py::array_t<double> overlap(const string &path_xyz, double threshold,
+                              py::object out) {
+    return multipole(read_xyz_from_file(path_xyz), "overlap", threshold, out,
+                     false);
+  }
+
+  /**
+   * \brief Compute the overlap integrals for the geometry given as an
+   * (n_atoms, 3) array in Angstrom.
+   */
+  py::array_t<double> overlap(const Eigen::Ref<const Matrix> &coordinates,
+                              const std::vector<int> &atomic_numbers,
+                              double threshold, py::object out) {
+    return multipole(atoms_from_coordinates(coordinates, atomic_numbers),
+                     "overlap", threshold, out, false);
+  }
+
+  /**
+   * \brief Compute the given multipole for the molecule in `path_xyz`
+   * as an (nopers, n, n) array. The integrals are written into `out`
+   * if it is not None.
+   */
+  py::array_t<double> multipole(const string &path_xyz,
+                                const string &multipole, double threshold,
+                                py::object out) {
+    return this->multipole(read_xyz_from_file(path_xyz), multipole, threshold,
+                           out, true);
+  }
+
+  /**
+   * \brief Compute the given multipole for the geometry given as an
+   * (n_atoms, 3) array in Angstrom.
+   */
+  py::array_t<double> multipole(const Eigen::Ref<const Matrix> &coordinates,
+                                const std::vector<int> &atomic_numbers,
+                                const string &multipole, double threshold,
+                                py::object out) {
+    return this->multipole(atoms_from_coordinates(coordinates, atomic_numbers),
+                           multipole, threshold, out, true);
+  }
 
-  auto shells = make_cp2k_basis(mol, path_hdf5, basis_name);
+  /**
+   * \brief Compute the given multipole for the geometry given as an
+   * (n_atoms, 3) array in Angstrom as atom-block sparse matrices, one for each
+   * operator component. The blocks between two atoms whose integrals are all
+   * smaller than `drop_tolerance` are dropped.
+   */
+  std::vector<namd::SparseMatrix>
+  sparse_multipole(const Eigen::Ref<const Matrix> &coordinates,
+                   const std::vector<int> &atomic_numbers,
+                   const string &multipole, double threshold,
+                   double drop_tolerance) {
+    auto atoms = atoms_from_coordinates(coordinates, atomic_numbers);
+
+    std::lock_guard<std::mutex> lock(mutex);
+    auto shells = make_shells(atoms);
+    std::array<double, 3> center = calculate_center_of_mass(atoms);
+    size_t nprim = max_nprim(shells);
+    int l = max_l(shells);
+
+    if (multipole == "overlap")
+      return compute_sparse_multipoles<Operator::overlap>(
+          get_engines(Operator::overlap, nprim, l), stats, shells, {}, threshold,
+          drop_tolerance);
+    else if (multipole == "dipole")
+      return compute_sparse_multipoles<Operator::emultipole1>(
+          get_engines(Operator::emultipole1, nprim, l), stats, shells, center,
+          threshold, drop_tolerance);
+    else if (multipole == "quadrupole")
+      return compute_sparse_multipoles<Operator::emultipole2>(
+          get_engines(Operator::emultipole2, nprim, l), stats, shells, center,
+          threshold, drop_tolerance);
+    else
+      throw std::runtime_error("Unkown multipole");
+  }
+
+private:
+  //! Number of sessions sharing the libint2 global state, which is
+  //! initialized and finalized holding `libint_mutex`
+  static int active_sessions;
+  static std::mutex libint_mutex;
+
+  string path_hdf5;
+  string basis_name;
+  int nthreads;
+
+  //! Basis set specification for each element already read from the HDF5
+  std::unordered_map<string, CP2K_Basis_Atom> basis;
+
+  //! Engines for each operator and the basis size they were built for
+  struct Engines {
+    size_t max_nprim = 0;
+    int max_l = -1;
+    std::vector<libint2::Engine> engines;
+  };
+  std::map<Operator, Engines> engines;
+
+  //! Sessions may be shared between Python threads
+  std::mutex mutex;
+
+  //! Statistics of the last computation, written holding `mutex`
+  namd::IntegralStats stats;
+
+  //! Overlap of the last incremental cross overlap, the molecule, basis set
+  //! and screening threshold it was computed for, the positions of the
+  //! atoms of each geometry when their blocks were computed and the ranges
+  //! of the blocks that may be non zero
+  struct IncrementalCache {
+    Matrix overlap;
+    std::vector<int> atomic_numbers;
+    string basis_name;
+    double threshold = 0;
+    std::vector<Atom> reference_1;
+    std::vector<Atom> reference_2;
+    namd::ShellRanges ranges;
+  };
+  IncrementalCache incremental;
+
+  /**
+   * \brief Mark the shells of the atoms that moved more than `tolerance`
+   * bohr from their `reference` position, which is updated for those atoms.
+   */
+  static std::vector<bool> find_stale_shells(const std::vector<Atom> &atoms,
+                                             const std::vector<Shell> &shells,
+                                             std::vector<Atom> &reference,
+                                             double tolerance) {
+    if (reference.size() != atoms.size()) {
+      reference = atoms;
+      return std::vector<bool>(shells.size(), true);
+    }
+    auto atom2shell = map_atom_to_shell(shells);
+    std::vector<bool> stale(shells.size(), false);
+    for (size_t i = 0; i != atoms.size(); ++i) {
+      const double dx = atoms[i].x - reference[i].x;
+      const double dy = atoms[i].y - reference[i].y;
+      const double dz = atoms[i].z - reference[i].z;
+      if (dx * dx + dy * dy + dz * dz > tolerance * tolerance) {
+        reference[i] = atoms[i];
+        std::fill(stale.begin() + atom2shell[i],
+                  stale.begin() + atom2shell[i + 1], true);
+      }
+    }
+    return stale;
+  }
 
-  // safe to use libint now
-  libint2::initialize();
+  /**
+   * \brief Convert the (n_frames, n_atoms, 3) coordinates into molecules,
+   * checking that `pairs` only refers to existing frames.
+   */
+  std::vector<std::vector<Atom>> read_frames(
+      const py::array_t<double, py::array::c_style | py::array::forcecast>
+          &coordinates,
+      const std::vector<int> &atomic_numbers,
+      const std::vector<std::pair<int, int>> &pairs) const {
+    if (coordinates.ndim() != 3 || coordinates.shape(2) != 3)
+      throw std::invalid_argument(
+          "coordinates must be an (n_frames, n_atoms, 3) array");
+    const size_t n_frames = coordinates.shape(0);
+    const size_t n_atoms = coordinates.shape(1);
+    for (const auto &pair : pairs)
+      if (pair.first < 0 || pair.second < 0 ||
+          static_cast<size_t>(std::max(pair.first, pair.second)) >= n_frames)
+        throw std::out_of_range("frame index out of range");
+
+    std::vector<std::vector<Atom>> molecules;
+    molecules.reserve(n_frames);
+    for (size_t i = 0; i != n_frames; ++i) {
+      Eigen::Map<const Matrix> xyz(coordinates.data(i, 0, 0), n_atoms, 3);
+      molecules.push_back(atoms_from_coordinates(xyz, atomic_numbers));
+    }
+    return molecules;
+  }
 
-  // compute Overlap integrals
-  auto matrices = select_multipole(mol, shells, multipole);
+  /**
+   * \brief Check that the coefficients are expanded in the basis `shells`.
+   */
+  static void check_coefficients(const std::vector<Shell> &shells,
+                                 size_t rows_1, size_t rows_2) {
+    const size_t n = nbasis(shells);
+    if (rows_1 != n || rows_2 != n)
+      throw std::invalid_argument(
+          "the coefficients rows must be equal to the number of basis "
+          "functions");
+  }
+
+  Matrix cross_overlap(const std::vector<Atom> &mol_1,
+                       const std::vector<Atom> &mol_2, double threshold) {
+    std::lock_guard<std::mutex> lock(mutex);
+    auto shells_1 = make_shells(mol_1);
+    auto shells_2 = make_shells(mol_2);
+    auto &engines = get_engines(
+        Operator::overlap, std::max(max_nprim(shells_1), max_nprim(shells_2)),
+        std::max(max_l(shells_1), max_l(shells_2)));
+
+    return compute_overlaps_for_couplings(engines, stats, shells_1, shells_2,
+                                          threshold);
+  }
+
+  /**
+   * \brief Compute the multipole directly into a NumPy array, either `out`
+   * or a new one, with shape (nopers, n, n) or (n, n) if `stacked` is false.
+   */
+  py::array_t<double> multipole(const std::vector<Atom> &atoms,
+                                const string &multipole, double threshold,
+                                py::object out, bool stacked) {
+    const size_t nopers = multipole_components(multipole);
+    size_t n = 0;
+    {
+      py::gil_scoped_release release;
+      std::lock_guard<std::mutex> lock(mutex);
+      n = nbasis(make_shells(atoms));
+    }
+    std::vector<size_t> shape{nopers, n, n};
+    if (!stacked)
+      shape.erase(shape.begin());
+
+    auto result = out.is_none() ? py::array_t<double>(shape)
+                                : check_buffer(out, shape);
+    double *buffer = result.mutable_data();
+    std::fill(buffer, buffer + result.size(), 0.0);
+
+    {
+      py::gil_scoped_release release;
+      std::lock_guard<std::mutex> lock(mutex);
+      auto shells = make_shells(atoms);
+      select_multipole(atoms, shells, multipole, threshold, buffer);
+    }
+    return result;
+  }
+
+  /**
+   * \brief Check that `out` can hold the integrals without any copy.
+   */
+  static py::array_t<double> check_buffer(const py::object &out,
+                                          const std::vector<size_t> &shape) {
+    if (!py::isinstance<py::array>(out))
+      throw std::invalid_argument("out must be a NumPy array");
+    auto array = py::reinterpret_borrow<py::array>(out);
+    if (!array.dtype().is(py::dtype::of<double>()) ||
+        !(array.flags() & py::array::c_style) || !array.writeable())
+      throw std::invalid_argument(
+          "out must be a writeable C contiguous float64 array");
+    if (static_cast<size_t>(array.ndim()) != shape.size() ||
+        !std::equal(shape.cbegin(), shape.cend(), array.shape()))
+      throw std::invalid_argument("out does not have the shape of the result");
+    return py::reinterpret_borrow<py::array_t<double>>(array);
+  }
 
-  // stop using libint2
-  libint2::finalize();
+  /**
+   * \brief Create the shells reading from the HDF5 only the elements
+   * that are not cached yet.
+   */
+  std::vector<Shell> make_shells(const std::vector<Atom> &atoms) {
+    for (const auto &symbol : get_unique_symbols(atoms))
+      if (basis.find(symbol) == basis.end())
+        basis[symbol] = read_basis_from_hdf5(path_hdf5, symbol, basis_name);
 
-  Matrix super_matrix(matrices[0].rows() * matrices.size(), matrices[0].cols());
-  for (int op = 0; op != static_cast<int>(matrices.size()); ++op) {
-    int i = op * matrices[0].rows();
-    super_matrix.block(i, 0, matrices[op].rows(), matrices[op].cols()) =
-        matrices[op];
+    return make_cp2k_basis(atoms, basis);
   }
 
-  return super_matrix;
+  /**
+   * \brief Return the engines for `op`, rebuilding them only if they
+   * cannot handle the requested number of primitives or angular momentum.
+   */
+  std::vector<libint2::Engine> &get_engines(Operator op, size_t nprim, int l) {
+    auto &cache = engines[op];
+    if (nprim > cache.max_nprim || l > cache.max_l) {
+      cache.max_nprim = std::max(nprim, cache.max_nprim);
+      cache.max_l = std::max(l, cache.max_l);
+      cache.engines = make_engines(op, cache.max_nprim, cache.max_l, nthreads);
+    }
+    return cache.engines;
+  }
+
+  /**
+   * \brief compute the given multipole.
+   */
+  void select_multipole(const std::vector<Atom> &atoms,
+                        const std::vector<Shell> &shells,
+                        const string &multipole, double threshold,
+                        double *buffer) {
+    // Compute multipole at the center of mass
+    std::array<double, 3> center = calculate_center_of_mass(atoms);
+    size_t nprim = max_nprim(shells);
+    int l = max_l(shells);
+
+    if (multipole == "overlap")
+      compute_multipoles<Operator::overlap>(
+          get_engines(Operator::overlap, nprim, l), stats, shells, buffer, {},
+          threshold);
+    else if (multipole == "dipole")
+      compute_multipoles<Operator::emultipole1>(
+          get_engines(Operator::emultipole1, nprim, l), stats, shells, buffer,
+          center, threshold);
+    else if (multipole == "quadrupole")
+      compute_multipoles<Operator::emultipole2>(
+          get_engines(Operator::emultipole2, nprim, l), stats, shells, buffer,
+          center, threshold);
+    else
+      throw std::runtime_error("Unkown multipole");
+  }
+};
+
+int IntegralSession::active_sessions = 0;
+std::mutex IntegralSession::libint_mutex;
+
+Matrix compute_integrals_couplings(const string &path_xyz_1,
+                                   const string &path_xyz_2,
+                                   const string &path_hdf5,
+                                   const string &basis_name,
+                                   double threshold) {
+  IntegralSession session(path_hdf5, basis_name, 0);
+  return session.cross_overlap(path_xyz_1, path_xyz_2, threshold);
+}
+
+/**
+ * \brief   Compute the overlap integrals for the molecule define in `path_xyz`
+ * using the `basis_name`
+ */
+py::array_t<double> compute_integrals_multipole(const string &path_xyz,
+                                                const string &path_hdf5,
+                                                const string &basis_name,
+                                                const string &multipole,
+                                                double threshold) {
+  IntegralSession session(path_hdf5, basis_name, 0);
+  return session.multipole(path_xyz, multipole, threshold, py::none());
 }
 
 PYBIND11_MODULE(compute_integrals, m) {
@@ -534,8 +1817,90 @@ PYBIND11_MODULE(compute_integrals, m) {
             "https://github.com/evaleev/libint/wiki";
 
   m.def("compute_integrals_couplings", &compute_integrals_couplings,
+        py::arg("path_xyz_1"), py::arg("path_xyz_2"), py::arg("path_hdf5"),
+        py::arg("basis_name"), py::arg("threshold") = 0.0,
         py::return_value_policy::reference_internal);
 
   m.def("compute_integrals_multipole", &compute_integrals_multipole,
-        py::return_value_policy::reference_internal);
+        py::arg("path_xyz"), py::arg("path_hdf5"), py::arg("basis_name"),
+        py::arg("multipole"), py::arg("threshold") = 0.0);
+
+  py::class_<IntegralSession>(m, "IntegralSession")
+      .def(py::init<const string &, const string &, int>(),
+           py::arg("path_hdf5"), py::arg("basis_name"),
+           py::arg("nthreads") = 0)
+      .def_property_readonly("nthreads", &IntegralSession::get_nthreads)
+      .def("screening_stats", &IntegralSession::screening_stats,
+           "Number of skipped and total shell pairs in the last computation",
+           py::call_guard<py::gil_scoped_release>())
+      .def("load_balance", &IntegralSession::load_balance,
+           "Thread utilisation, number of blocks of shell pairs and number "
+           "of threads in the last computation",
+           py::call_guard<py::gil_scoped_release>())
+      .def("reuse_stats", &IntegralSession::reuse_stats,
+           "Number of reused and total shell pairs in the last incremental "
+           "overlap",
+           py::call_guard<py::gil_scoped_release>())
+      .def("overlap",
+           py::overload_cast<const string &, double, py::object>(
+               &IntegralSession::overlap),
+           py::arg("path_xyz"), py::arg("threshold") = 0.0,
+           py::arg("out") = py::none())
+      .def("overlap",
+           py::overload_cast<const Eigen::Ref<const Matrix> &,
+                             const std::vector<int> &, double, py::object>(
+               &IntegralSession::overlap),
+           py::arg("coordinates"), py::arg("atomic_numbers"),
+           py::arg("threshold") = 0.0, py::arg("out") = py::none())
+      .def("cross_overlap",
+           py::overload_cast<const string &, const string &, double>(
+               &IntegralSession::cross_overlap),
+           py::arg("path_xyz_1"), py::arg("path_xyz_2"),
+           py::arg("threshold") = 0.0,
+           py::call_guard<py::gil_scoped_release>())
+      .def("cross_overlap",
+           py::overload_cast<const Eigen::Ref<const Matrix> &,
+                             const Eigen::Ref<const Matrix> &,
+                             const std::vector<int> &, double>(
+               &IntegralSession::cross_overlap),
+           py::arg("coordinates_1"), py::arg("coordinates_2"),
+           py::arg("atomic_numbers"), py::arg("threshold") = 0.0,
+           py::call_guard<py::gil_scoped_release>())
+      .def("cross_overlap_incremental",
+           &IntegralSession::cross_overlap_incremental,
+           py::arg("coordinates_1"), py::arg("coordinates_2"),
+           py::arg("atomic_numbers"), py::arg("tolerance"),
+           py::arg("threshold") = 0.0,
+           py::call_guard<py::gil_scoped_release>())
+      .def("reset_incremental", &IntegralSession::reset_incremental,
+           py::call_guard<py::gil_scoped_release>())
+      .def("cross_overlaps", &IntegralSession::cross_overlaps,
+           py::arg("coordinates"), py::arg("atomic_numbers"), py::arg("pairs"),
+           py::arg("threshold") = 0.0)
+      .def("cross_overlap_mo", &IntegralSession::cross_overlap_mo,
+           py::arg("coordinates_1"), py::arg("coordinates_2"),
+           py::arg("atomic_numbers"), py::arg("coefficients_1"),
+           py::arg("coefficients_2"), py::arg("threshold") = 0.0,
+           py::call_guard<py::gil_scoped_release>())
+      .def("cross_overlaps_mo", &IntegralSession::cross_overlaps_mo,
+           py::arg("coordinates"), py::arg("atomic_numbers"), py::arg("pairs"),
+           py::arg("coefficients_1"), py::arg("coefficients_2"),
+           py::arg("threshold") = 0.0)
+      .def("multipole",
+           py::overload_cast<const string &, const string &, double,
+                             py::object>(&IntegralSession::multipole),
+           py::arg("path_xyz"), py::arg("multipole"),
+           py::arg("threshold") = 0.0, py::arg("out") = py::none())
+      .def("multipole",
+           py::overload_cast<const Eigen::Ref<const Matrix> &,
+                             const std::vector<int> &, const string &, double,
+                             py::object>(&IntegralSession::multipole),
+           py::arg("coordinates"), py::arg("atomic_numbers"),
+           py::arg("multipole"), py::arg("threshold") = 0.0,
+           py::arg("out") = py::none())
+      .def("sparse_multipole", &IntegralSession::sparse_multipole,
+           py::arg("coordinates"), py::arg("atomic_numbers"),
+           py::arg("multipole"), py::arg("threshold") = 0.0,
+           py::arg("drop_tolerance") = 0.0,
+           py::call_guard<py::gil_scoped_release>());
 }
@@ -11,8 +11,14 @@
 #define NAMD_H_
 
 #include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cmath>
 #include <fstream>
 #include <iostream>
+#include <map>
+#include <mutex>
+#include <numeric>
 #include <string>
 #include <thread>
 #include <tuple>
@@ -24,10 +30,13 @@
 #include <libint2.hpp>
 
 #include <pybind11/eigen.h>
+#include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 
 // Eigen matrix algebra library
 #include <Eigen/Dense>
+#include <Eigen/Sparse>
 
 // HDF5 funcionality
 #include <highfive/H5DataSet.hpp>
@@ -48,6 +57,12 @@ using real_t = libint2::scalar_type;
 using Matrix =
     Eigen::Matrix<real_t, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
 
+// Compressed sparse row matrix, which is converted to scipy.sparse.csr_matrix
+using SparseMatrix = Eigen::SparseMatrix<real_t, Eigen::RowMajor>;
+
+// Conversion factor used by libint2::read_dotxyz (2010 CODATA value)
+constexpr double angstrom_to_bohr = 1 / 0.52917721092;
+
 struct CP2K_Basis_Atom {
   // Contains the basis specificationf for a given atom
   std::string symbol;
@@ -56,6 +71,58 @@ struct CP2K_Basis_Atom {
   libint2::svector<int> basis_format;
 };
 
+struct ScreeningStats {
+  // Number of shell pairs skipped by the distance-based screening
+  // and the total number of shell pairs in the last computation
+  size_t skipped = 0;
+  size_t total = 0;
+};
+
+struct ShellBound {
+  // Sum over the primitives of the largest contraction coefficient times
+  // alpha^-3/4, the most diffuse exponent and the angular momentum of a shell
+  double weight = 0;
+  double min_alpha = 0;
+  int l = 0;
+};
+
+// Ranges [begin, end) of the shells computed with each shell
+using ShellRanges = std::vector<std::vector<std::pair<size_t, size_t>>>;
+
+struct ShellBlock {
+  // Shell pairs {s1, s2} with s2 in [begin, end) for the `pair` geometries
+  // and their estimated cost
+  size_t pair;
+  size_t s1;
+  size_t begin;
+  size_t end;
+  double cost;
+};
+
+struct LoadBalance {
+  // Fraction of the time that the threads spent computing integrals,
+  // the number of blocks of shell pairs and the number of threads
+  // in the last computation
+  double utilisation = 1;
+  size_t blocks = 0;
+  int nthreads = 1;
+};
+
+struct ReuseStats {
+  // Number of shell pairs reused from the previous incremental overlap
+  // and the total number of shell pairs
+  size_t reused = 0;
+  size_t total = 0;
+};
+
+struct IntegralStats {
+  // Statistics of the last computation of an integral session, each kernel
+  // accumulates them per thread and stores the totals at the end of the call
+  ScreeningStats screening;
+  LoadBalance load_balance;
+  ReuseStats reuse;
+};
+
 // Map from atomic_number to symbol
 std::unordered_map<int, std::string> map_elements = {
     {1, "h"},   {2, "he"},  {3, "li"},  {4, "be"},  {5, "b"},   {6, "c"},
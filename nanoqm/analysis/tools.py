@@ -11,13 +11,15 @@ API
 """
 
 import os
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
 import pyparsing as pa
+from qmflows.type_hints import PathLike
 from scipy.optimize import curve_fit
 
 from ..common import fs_to_cm, h2ev, hbar, r2meV
+from ..hdf5_store import HDF5Follower
 
 """ Functions to fit data """
 
@@ -177,6 +179,18 @@ def read_energies(path_hams, ts):
     return xs * r2meV / 1000  # return energies in eV
 
 
+def follow_hdf5(
+        path_hdf5: PathLike, stage: str, prefix: str = "", interval: float = 1.0,
+        timeout: Optional[float] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """Yield the frames computed by ``stage`` while the workflow writes the HDF5.
+
+    See :class:`nanoqm.hdf5_store.HDF5Follower`, the iteration finishes after
+    ``timeout`` seconds without new frames.
+    """
+    with HDF5Follower(path_hdf5, stage, prefix) as follower:
+        yield from follower.follow(interval, timeout)
+
+
 def read_energies_pyxaid(path, fn, nstates, nconds):
     """Read the molecular orbital energies of each state from the output files generated by PYXAID."""
     inpfile = os.path.join(path, fn)
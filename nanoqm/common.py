@@ -5,6 +5,7 @@ Index
 .. currentmodule:: nanoqm.common
 .. autosummary::
     DictConfig
+    blas_threads
     change_mol_units
     getmass
     number_spherical_functions_per_atom
@@ -15,6 +16,7 @@ Index
 API
 ---
 .. autoclass:: DictConfig
+.. autofunction:: blas_threads
 .. autofunction:: is_data_in_hdf5
 .. autofunction:: retrieve_hdf5_data
 .. autofunction:: number_spherical_functions_per_atom
@@ -23,24 +25,25 @@ API
 """
 
 __all__ = ['DictConfig', 'Matrix', 'Tensor3D', 'Vector',
-           'change_mol_units', 'getmass', 'h2ev', 'hardness',
-           'number_spherical_functions_per_atom', 'retrieve_hdf5_data',
+           'blas_threads', 'change_mol_units', 'getmass', 'h2ev', 'hardness',
+           'molecule_to_arrays', 'number_spherical_functions_per_atom', 'retrieve_hdf5_data',
            'is_data_in_hdf5', 'store_arrays_in_hdf5']
 
 
-import os
 from itertools import chain, repeat
 from pathlib import Path
-from typing import (Any, Dict, Iterable, List, Mapping, NamedTuple, Tuple,
-                    Union, overload)
+from typing import (Any, ContextManager, Dict, Iterable, List, Mapping,
+                    NamedTuple, Optional, Tuple, Union, overload)
 
-import h5py
 import mendeleev
 import numpy as np
 from scipy.constants import physical_constants
 from qmflows.common import AtomXYZ
 from qmflows.type_hints import PathLike
-from scm.plams import Atom, Molecule
+from scm.plams import Atom, Molecule, PeriodicTable
+from threadpoolctl import threadpool_limits
+
+from .hdf5_store import get_store
 
 
 class DictConfig(dict):
@@ -187,13 +190,8 @@ def retrieve_hdf5_data(path_hdf5, paths_to_prop):
         The property has not been found
 
     """
-    path_hdf5 = path_to_posix(path_hdf5)
     try:
-        with h5py.File(path_hdf5, 'r') as f5:
-            if isinstance(paths_to_prop, list):
-                return [f5[path][()] for path in paths_to_prop]
-            else:
-                return f5[paths_to_prop][()]
+        return get_store(path_to_posix(path_hdf5)).read(paths_to_prop)
     except KeyError:
         msg = f"There is not {paths_to_prop} stored in the HDF5\n"
         raise KeyError(msg)
@@ -218,15 +216,7 @@ def is_data_in_hdf5(path_hdf5: Union[str, Path], xs: Union[str, List[str]]) -> b
         Whether the data is stored
 
     """
-    path_hdf5 = path_to_posix(path_hdf5)
-    if os.path.exists(path_hdf5):
-        with h5py.File(path_hdf5, 'r+') as f5:
-            if isinstance(xs, list):
-                return all(path in f5 for path in xs)
-            else:
-                return xs in f5
-    else:
-        return False
+    return get_store(path_to_posix(path_hdf5)).contains(xs)
 
 
 @overload
@@ -261,23 +251,17 @@ def store_arrays_in_hdf5(
         Attribute associated with the tensor
 
     """
-    path_hdf5 = path_to_posix(path_hdf5)
+    store = get_store(path_to_posix(path_hdf5))
 
-    def add_attribute(data_set, k: int = 0):
-        if attribute is not None:
-            data_set.attrs[attribute.name] = attribute.value[k]
+    def get_attribute(k: int = 0) -> Dict[str, Any]:
+        return {} if attribute is None else {attribute.name: attribute.value[k]}
 
-    with h5py.File(path_hdf5, 'r+') as f5:
+    with store:
         if isinstance(paths, list):
             for k, path in enumerate(paths):
-                data = tensor[k]
-                dset = f5.require_dataset(path, shape=np.shape(data),
-                                          data=data, dtype=dtype)
-                add_attribute(dset, k)
+                store.write(path, tensor[k], dtype=dtype, attrs=get_attribute(k))
         else:
-            dset = f5.require_dataset(paths, shape=np.shape(
-                tensor), data=tensor, dtype=dtype)
-            add_attribute(dset)
+            store.write(paths, tensor, dtype=dtype, attrs=get_attribute())
 
 
 def change_mol_units(mol: List[AtomXYZ], factor: float = angs2au) -> List[AtomXYZ]:
@@ -300,14 +284,33 @@ def tuplesXYZ_to_plams(xs: List[AtomXYZ]) -> Molecule:
     return plams_mol
 
 
+def molecule_to_arrays(mol: List[AtomXYZ]) -> Tuple[np.ndarray, np.ndarray]:
+    """Split a molecule into its (n_atoms, 3) coordinates and its atomic numbers."""
+    coordinates = np.array([at.xyz for at in mol], dtype=np.float64)
+    atomic_numbers = np.array(
+        [PeriodicTable.get_atomic_number(at.symbol) for at in mol], dtype=np.int32)
+
+    return coordinates, atomic_numbers
+
+
+def blas_threads(nthreads: Optional[int]) -> ContextManager:
+    """Limit the number of threads used by the BLAS library behind NumPy.
+
+    The integrals library and BLAS have their own thread pools, therefore the
+    BLAS threads are reduced while the integrals run to avoid oversubscription.
+    ``None`` leaves the current limit unchanged.
+    """
+    return threadpool_limits(limits=nthreads, user_api="blas")
+
+
 def number_spherical_functions_per_atom(
         mol: List[AtomXYZ], package_name: str, basis_name: str, path_hdf5: PathLike) -> np.ndarray:
     """Compute the number of spherical shells per atom."""
-    with h5py.File(path_hdf5, 'r') as f5:
-        xs = [f5[f'{package_name}/basis/{atom[0]}/{basis_name}/coefficients']
+    with get_store(path_hdf5) as store:
+        xs = [store.attributes(f'{package_name}/basis/{atom[0]}/{basis_name}/coefficients')
               for atom in mol]
         ys = [calc_orbital_Slabels(
-            read_basis_format(path.attrs['basisFormat'])) for path in xs]
+            read_basis_format(attrs['basisFormat'])) for attrs in xs]
 
         return np.stack([sum(len(x) for x in ys[i]) for i in range(len(mol))])
 
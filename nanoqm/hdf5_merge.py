@@ -0,0 +1,426 @@
+"""Combine the HDF5 files computed for the chunks of a trajectory.
+
+``distribute_jobs.py`` splits the trajectory in chunks and each chunk stores its
+results in its own ``chunk_{index}.hdf5``. :func:`stitch_chunks` creates a
+master HDF5 made of `virtual datasets <https://docs.h5py.org/en/stable/vds.html>`_
+pointing to the datasets of the chunks, therefore the whole trajectory can be
+read from the master file without copying any array. Where a single file is
+needed, :func:`merge_chunks` copies the chunks using several processes to read
+them and slabs of bounded size, see :func:`stream_copy`.
+
+In both cases the frames of each chunk are numbered after the last geometry of
+the previous chunk, see :func:`chunk_offsets`, so the chunks created by
+``distribute_jobs.py`` keep their numbers while chunks numbered from zero are
+renumbered in the same pass. The nodes that are not numbered by frame, like the
+basis set, are taken from the first chunk containing them. The master file
+references the chunks using paths relative to it, so it can be moved together
+with the chunks.
+
+Index
+-----
+.. currentmodule:: nanoqm.hdf5_merge
+.. autosummary::
+    chunk_offsets
+    merge_chunks
+    renumber_path
+    stitch_chunks
+    stream_copy
+
+API
+---
+.. autofunction:: chunk_offsets
+.. autofunction:: merge_chunks
+.. autofunction:: renumber_path
+.. autofunction:: stitch_chunks
+.. autofunction:: stream_copy
+
+"""
+
+__all__ = ['DatasetSpec', 'SlabCopy', 'chunk_offsets', 'merge_chunks', 'renumber_path',
+           'split_rows', 'stitch_chunks', 'stream_copy']
+
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                as_completed, wait)
+from typing import (Any, Dict, List, Mapping, NamedTuple, Optional, Sequence,
+                    Set, Tuple)
+
+import h5py
+import numpy as np
+from qmflows.type_hints import PathLike
+
+from .hdf5_store import STACKED_FRAMES, match_frame, stacked_group
+
+# Starting logger
+logger = logging.getLogger(__name__)
+
+#: Components of the nodes numbered by frame, e.g. ``point_3`` or ``overlaps_3``
+FRAME_COMPONENT = re.compile(r"(?<![^/])(point|overlaps|coupling)_(\d+)(?![^/])")
+
+#: Stages computed for every geometry of the chunk
+GEOMETRY_STAGES = ("eigenvalues", "coefficients", "energy")
+
+
+def renumber_path(path: str, offset: int) -> str:
+    """Add ``offset`` to the frame numbers in the components of ``path``."""
+    if offset == 0:
+        return path
+    return FRAME_COMPONENT.sub(lambda m: f"{m.group(1)}_{int(m.group(2)) + offset}", path)
+
+
+def read_layout(f5: h5py.File) -> str:
+    """Return the layout of the per-frame results of an open HDF5."""
+    layout = f5.attrs.get("layout", "frames")
+    return layout.decode() if isinstance(layout, bytes) else layout
+
+
+def geometry_frames(f5: h5py.File) -> Optional[Tuple[int, int]]:
+    """Return the first and last geometry stored in an open HDF5 or None."""
+    frames: List[int] = []
+    if read_layout(f5) == "stacked":
+        def visitor(name: str, obj: h5py.HLObject) -> None:
+            match = STACKED_FRAMES.match(name)
+            if match is not None and match.group(2) in GEOMETRY_STAGES:
+                frames.extend(obj[()].tolist())
+    else:
+        def visitor(name: str, obj: h5py.HLObject) -> None:
+            match = match_frame(name)
+            if match is not None and match[0] in GEOMETRY_STAGES:
+                frames.append(match[2])
+    f5.visititems(visitor)
+    return (min(frames), max(frames)) if frames else None
+
+
+def chunk_offsets(paths: Sequence[PathLike]) -> List[int]:
+    """Compute the offset added to the frames of each chunk.
+
+    The geometries of each chunk follow the last geometry of the previous one,
+    the chunks without geometries are not renumbered.
+    """
+    offsets = []
+    start: Optional[int] = None
+    for path in paths:
+        with h5py.File(path, 'r') as f5:
+            span = geometry_frames(f5)
+        if span is None:
+            offsets.append(0)
+            continue
+        first, last = span
+        start = first if start is None else start
+        offsets.append(start - first)
+        start += last - first + 1
+    return offsets
+
+
+def virtual_copy(
+        g5: h5py.File, path: str, source: h5py.Dataset, file_name: str) -> h5py.Dataset:
+    """Create a virtual dataset in ``path`` mapping the whole ``source`` dataset."""
+    layout = h5py.VirtualLayout(shape=source.shape, dtype=source.dtype)
+    layout[...] = h5py.VirtualSource(file_name, source.name, shape=source.shape)
+    dset = g5.create_virtual_dataset(path, layout)
+    for name, value in source.attrs.items():
+        dset.attrs[name] = value
+    return dset
+
+
+def stitch_stacked(
+        g5: h5py.File, group: str, sources: Sequence[Tuple[str, h5py.Group, int]]) -> None:
+    """Concatenate the rows of a stacked ``group`` of the chunks in a virtual dataset."""
+    datasets = [(name, g["data"], g["frames"][()] + offset) for name, g, offset in sources]
+    first = datasets[0][1]
+    if any(dset.shape[1:] != first.shape[1:] for _, dset, _ in datasets):
+        raise TypeError(f"The frames in {group} have different shapes in the chunks")
+    rows = sum(len(frames) for _, _, frames in datasets)
+    layout = h5py.VirtualLayout(shape=(rows, *first.shape[1:]), dtype=first.dtype)
+    start = 0
+    for file_name, dset, frames in datasets:
+        layout[start: start + len(frames)] = h5py.VirtualSource(
+            file_name, dset.name, shape=dset.shape)[:len(frames)]
+        start += len(frames)
+    data = g5.require_group(group).create_virtual_dataset("data", layout)
+    for name, value in first.attrs.items():
+        data.attrs[name] = value
+    # The frame numbers are renumbered, hence they are not virtual
+    g5[group].create_dataset("frames", data=np.concatenate([f for _, _, f in datasets]),
+                             maxshape=(None,), chunks=True)
+
+
+def relative_path(path: PathLike, folder: str) -> str:
+    """Return ``path`` relative to ``folder``."""
+    return os.path.relpath(os.path.abspath(os.fsdecode(path)), folder)
+
+
+def collect_nodes(
+        paths: Sequence[PathLike], handles: Sequence[h5py.File],
+        offsets: Sequence[int]) -> Tuple[Dict[str, Tuple[str, h5py.Dataset]],
+                                         Dict[str, List[Tuple[str, h5py.Group, int]]]]:
+    """Return the renumbered datasets and the stacked groups of the chunks.
+
+    The datasets are returned together with the path to their chunk, the first
+    chunk containing a node provides it.
+    """
+    nodes: Dict[str, Tuple[str, h5py.Dataset]] = {}
+    stacked: Dict[str, List[Tuple[str, h5py.Group, int]]] = {}
+    for path, f5, offset in zip(paths, handles, offsets):
+        def visitor(name: str, obj: h5py.HLObject) -> None:
+            if not isinstance(obj, h5py.Dataset):
+                return
+            match = STACKED_FRAMES.match(name)
+            if match is not None:
+                group = stacked_group(match.group(2), match.group(1) or "")
+                stacked.setdefault(group, []).append((os.fsdecode(path), obj.parent, offset))
+            elif STACKED_FRAMES.match(f"{name.rpartition('/')[0]}/frames") is None:
+                nodes.setdefault(renumber_path(name, offset), (os.fsdecode(path), obj))
+
+        f5.visititems(visitor)
+    return nodes, stacked
+
+
+def open_chunks(paths: Sequence[PathLike]) -> List[h5py.File]:
+    """Open the chunks read-only, checking that all of them use the same layout."""
+    handles = [h5py.File(path, 'r') for path in paths]
+    layouts = {read_layout(f5) for f5 in handles}
+    if len(layouts) > 1:
+        for f5 in handles:
+            f5.close()
+        raise RuntimeError(f"The chunks use different layouts: {layouts}")
+    return handles
+
+
+def stitch_chunks(
+        paths: Sequence[PathLike], path_master: PathLike,
+        offsets: Optional[Sequence[int]] = None) -> None:
+    """Create ``path_master`` with virtual datasets pointing to the chunks in ``paths``.
+
+    Parameters
+    ----------
+    paths
+        HDF5 files of the chunks sorted along the trajectory
+    path_master
+        HDF5 file to create
+    offsets
+        Offset added to the frames of each chunk, see :func:`chunk_offsets` for the default
+
+    """
+    offsets = chunk_offsets(paths) if offsets is None else offsets
+    folder = os.path.dirname(os.path.abspath(os.fsdecode(path_master)))
+    handles = open_chunks(paths)
+    try:
+        nodes, stacked = collect_nodes(paths, handles, offsets)
+        with h5py.File(path_master, 'w') as g5:
+            g5.attrs["layout"] = read_layout(handles[0]) if handles else "frames"
+            for group, sources in stacked.items():
+                stitch_stacked(g5, group, [(relative_path(path, folder), g, offset)
+                                           for path, g, offset in sources])
+            for node, (path, dset) in nodes.items():
+                virtual_copy(g5, node, dset, relative_path(path, folder))
+        logger.info(f"{len(nodes) + len(stacked)} virtual datasets pointing to "
+                    f"{len(paths)} chunks stored in {os.fsdecode(path_master)}")
+    finally:
+        for f5 in handles:
+            f5.close()
+
+
+class DatasetSpec(NamedTuple):
+    """Shape, data type, creation options and attributes of a dataset to create."""
+
+    shape: Tuple[int, ...]
+    dtype: np.dtype
+    options: Dict[str, Any]
+    attrs: Dict[str, Any]
+
+
+class SlabCopy(NamedTuple):
+    """Rows of a source dataset copied to the destination starting at row ``start``."""
+
+    source: str
+    name: str
+    rows: slice
+    dest: str
+    start: int = 0
+
+
+def creation_options(dset: h5py.Dataset, resizable: bool = False) -> Dict[str, Any]:
+    """Return the chunks and filters of ``dset`` to create a copy of it."""
+    options: Dict[str, Any] = {}
+    if dset.chunks is not None:
+        options["chunks"] = dset.chunks
+    if dset.compression is not None:
+        options.update(compression=dset.compression, compression_opts=dset.compression_opts)
+    if dset.shuffle:
+        options["shuffle"] = True
+    if resizable:
+        options["maxshape"] = (None, *dset.shape[1:])
+        options.setdefault("chunks", True)
+    return options
+
+
+def split_rows(dset: h5py.Dataset, slab_bytes: int) -> List[slice]:
+    """Split the rows of ``dset`` in slabs of at most ``slab_bytes``, aligned to its chunks."""
+    if dset.ndim == 0:
+        return [slice(None)]
+    if dset.nbytes <= slab_bytes:
+        return [slice(0, dset.shape[0])]
+    row_bytes = dset.nbytes // dset.shape[0]
+    rows = max(1, slab_bytes // max(1, row_bytes))
+    if dset.chunks is not None and rows > dset.chunks[0]:
+        rows -= rows % dset.chunks[0]
+    return [slice(i, min(i + rows, dset.shape[0])) for i in range(0, dset.shape[0], rows)]
+
+
+#: Chunks opened by each worker process
+_sources: Dict[str, h5py.File] = {}
+
+
+def read_slabs(path: str, slabs: Sequence[Tuple[str, slice]]) -> List[np.ndarray]:
+    """Read the ``slabs`` of the chunk in ``path``, keeping the file open."""
+    f5 = _sources.get(path)
+    if f5 is None:
+        f5 = _sources[path] = h5py.File(path, 'r')
+    return [f5[name][()] if f5[name].ndim == 0 else f5[name][rows] for name, rows in slabs]
+
+
+def group_slabs(
+        copies: Sequence[SlabCopy], specs: Mapping[str, DatasetSpec],
+        slab_bytes: int) -> List[List[SlabCopy]]:
+    """Group the copies of each source in tasks reading about ``slab_bytes``."""
+    tasks: List[List[SlabCopy]] = []
+    current: Dict[str, Tuple[List[SlabCopy], int]] = {}
+    for copy in copies:
+        shape = specs[copy.dest].shape
+        rows = 1 if not shape else copy.rows.stop - copy.rows.start
+        nbytes = specs[copy.dest].dtype.itemsize * rows * int(np.prod(shape[1:]))
+        task, size = current.get(copy.source, ([], 0))
+        if task and size + nbytes > slab_bytes:
+            tasks.append(task)
+            task, size = [], 0
+        task.append(copy)
+        current[copy.source] = (task, size + nbytes)
+    tasks.extend(task for task, _ in current.values() if task)
+    return tasks
+
+
+def stream_copy(
+        path_dest: PathLike, specs: Mapping[str, DatasetSpec], copies: Sequence[SlabCopy],
+        workers: int = 4, slab_bytes: int = 2 ** 26) -> None:
+    """Create the datasets in ``specs`` and fill them copying the slabs in ``copies``.
+
+    The slabs are read by ``workers`` processes, each one reading about
+    ``slab_bytes`` per task, while this process writes them. At most two tasks
+    per worker are in flight, which bounds the memory used by the copy.
+    The slabs are read in this process if ``workers`` is zero.
+    """
+    with h5py.File(path_dest, 'a') as g5:
+        for node, spec in specs.items():
+            dset = g5.create_dataset(node, shape=spec.shape, dtype=spec.dtype, **spec.options)
+            for name, value in spec.attrs.items():
+                dset.attrs[name] = value
+        tasks = group_slabs(copies, specs, slab_bytes)
+
+        def write(task: Sequence[SlabCopy], arrays: Sequence[np.ndarray]) -> None:
+            for copy, array in zip(task, arrays):
+                dset = g5[copy.dest]
+                if dset.ndim == 0:
+                    dset[()] = array
+                else:
+                    dset[copy.start: copy.start + len(array)] = array
+
+        def arguments(task: Sequence[SlabCopy]) -> Tuple[str, List[Tuple[str, slice]]]:
+            return task[0].source, [(copy.name, copy.rows) for copy in task]
+
+        if workers == 0:
+            for task in tasks:
+                write(task, read_slabs(*arguments(task)))
+            return
+
+        # The workers must not inherit the open destination file
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            pending: Dict[Future, Sequence[SlabCopy]] = {}
+            for task in tasks:
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(pending.pop(future), future.result())
+                pending[executor.submit(read_slabs, *arguments(task))] = task
+            for future in as_completed(pending):
+                write(pending[future], future.result())
+
+
+def merge_chunks(
+        paths: Sequence[PathLike], path_dest: PathLike,
+        offsets: Optional[Sequence[int]] = None, workers: Optional[int] = None,
+        slab_bytes: int = 2 ** 26) -> None:
+    """Copy the chunks in ``paths`` into ``path_dest``, renumbering their frames.
+
+    The stacked datasets of the chunks are concatenated. The nodes already
+    stored in ``path_dest`` are not overwritten.
+
+    Parameters
+    ----------
+    paths
+        HDF5 files of the chunks sorted along the trajectory
+    path_dest
+        HDF5 file where the chunks are copied
+    offsets
+        Offset added to the frames of each chunk, see :func:`chunk_offsets` for the default
+    workers
+        Number of processes reading the chunks, by default one per chunk up to 4
+    slab_bytes
+        Approximated size in bytes of the slabs read at once
+
+    """
+    offsets = chunk_offsets(paths) if offsets is None else offsets
+    workers = min(4, len(paths)) if workers is None else workers
+    existing: Set[str] = set()
+    if os.path.exists(path_dest) and os.path.getsize(path_dest) > 0:
+        with h5py.File(path_dest, 'r') as g5:
+            g5.visit(existing.add)
+
+    specs: Dict[str, DatasetSpec] = {}
+    copies: List[SlabCopy] = []
+    handles = open_chunks(paths)
+    try:
+        layout = read_layout(handles[0]) if handles else "frames"
+        nodes, stacked = collect_nodes(paths, handles, offsets)
+        for node, (path, dset) in nodes.items():
+            if node in existing:
+                continue
+            specs[node] = DatasetSpec(dset.shape, dset.dtype, creation_options(dset),
+                                      dict(dset.attrs))
+            copies.extend(SlabCopy(path, dset.name, rows, node, rows.start or 0)
+                          for rows in split_rows(dset, slab_bytes))
+
+        frames: Dict[str, np.ndarray] = {}
+        for group, sources in stacked.items():
+            if group in existing:
+                raise RuntimeError(
+                    f"{os.fsdecode(path_dest)} already contains the stacked group {group}")
+            datasets = [(path, g["data"], g["frames"][()] + offset)
+                        for path, g, offset in sources]
+            first = datasets[0][1]
+            if any(dset.shape[1:] != first.shape[1:] for _, dset, _ in datasets):
+                raise TypeError(f"The frames in {group} have different shapes in the chunks")
+            rows = sum(len(f) for _, _, f in datasets)
+            specs[f"{group}/data"] = DatasetSpec(
+                (rows, *first.shape[1:]), first.dtype, creation_options(first, True),
+                dict(first.attrs))
+            start = 0
+            for path, dset, f in datasets:
+                copies.extend(SlabCopy(path, dset.name, rows, f"{group}/data", start + rows.start)
+                              for rows in split_rows(dset, slab_bytes))
+                start += len(f)
+            frames[group] = np.concatenate([f for _, _, f in datasets])
+    finally:
+        for f5 in handles:
+            f5.close()
+
+    stream_copy(path_dest, specs, copies, workers, slab_bytes)
+    with h5py.File(path_dest, 'r+') as g5:
+        g5.attrs.setdefault("layout", layout)
+        for group, numbers in frames.items():
+            g5[group].create_dataset("frames", data=numbers, maxshape=(None,), chunks=(1024,))
+    logger.info(f"{len(specs)} datasets of {len(paths)} chunks copied to {os.fsdecode(path_dest)}")
@@ -0,0 +1,1187 @@
+"""Session-scoped access to the HDF5 file containing the results of the workflows.
+
+Opening the HDF5 requires reading the metadata of the file, therefore opening
+and closing it for every read or write dominates the cost of checking,
+retrieving and storing thousands of small arrays per trajectory.
+An :class:`HDF5Store` keeps a single read-only handle for the lifetime of a
+workflow stage, caches the nodes known to exist and keeps the writes in memory
+until they are flushed together.
+
+A stage is delimited using the store as a context manager:
+
+.. code-block:: python
+
+    with get_store(config.path_hdf5) as store:
+        if not store.contains(path):
+            store.write(path, array)
+
+Outside of a stage every operation opens and closes the file, like the old
+helpers in :mod:`nanoqm.common` did.
+
+With asynchronous writes (see :meth:`HDF5Store.set_async`) the flushed arrays
+are written by a background thread, which is the single writer of the file,
+so the workflow keeps computing while the arrays are written. The arrays
+waiting to be written are returned by the readers, and :meth:`HDF5Store.checkpoint`
+waits until all of them are in the file, which also happens at exit.
+
+Other processes can read the results while the workflow is running using a
+:class:`HDF5Follower`. With the ``stacked`` layout the store can write the file
+in single-writer/multiple-reader (SWMR) mode, see :meth:`HDF5Store.set_swmr`,
+so that the followers keep the file open and only read the appended frames.
+
+Inside a stage the nodes stored in the file are read in a single pass into a
+:class:`FrameIndex`, which also keeps a bitmap of the frames computed by each
+stage of the workflow, so that restarting a long trajectory does not require
+one lookup in the file per frame.
+
+Layouts
+-------
+The per-frame results (see :data:`FRAME_PATHS`) are stored using one of the
+following layouts, given by the ``layout`` attribute of the file:
+
+* ``frames`` (default): one dataset per frame, e.g. ``coefficients/point_3``.
+* ``stacked``: one resizable ``(n_frames, ...)`` dataset per quantity, chunked
+  along the time axis, in ``{prefix}/stacked/{stage}/data`` together with the
+  ``frames`` dataset mapping each row to its frame.
+
+The datasets of each quantity are created using its :class:`StoragePolicy`,
+which selects the data type, the compression filter and the chunk shape.
+
+The nodes of the ``frames`` layout are used to address the results in both
+layouts, therefore the code reading and writing single frames does not depend on
+the layout. :meth:`HDF5Store.read_frames` and :meth:`HDF5Store.write_frames` read
+and append a time series using a single I/O operation with the ``stacked`` layout.
+
+Index
+-----
+.. currentmodule:: nanoqm.hdf5_store
+.. autosummary::
+    HDF5Store
+    HDF5Follower
+    FrameIndex
+    StoragePolicy
+    frame_path
+    get_store
+
+API
+---
+.. autoclass:: HDF5Store
+    :members:
+.. autoclass:: HDF5Follower
+    :members:
+.. autoclass:: FrameIndex
+    :members:
+.. autoclass:: StoragePolicy
+    :members:
+.. autofunction:: frame_path
+.. autofunction:: get_store
+
+"""
+
+__all__ = ['FrameIndex', 'HDF5Follower', 'HDF5Store', 'StoragePolicy', 'frame_path', 'get_store']
+
+import atexit
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from itertools import chain
+from typing import (Any, DefaultDict, Deque, Dict, Iterable, Iterator, List,
+                    Mapping, NamedTuple, Optional, Sequence, Set, Tuple, Union,
+                    overload)
+
+import h5py
+import numpy as np
+from qmflows.type_hints import PathLike
+
+# Starting logger
+logger = logging.getLogger(__name__)
+
+
+class PendingWrite(NamedTuple):
+    """Array waiting to be written in the HDF5."""
+
+    data: np.ndarray
+    dtype: Any
+    attrs: Mapping[str, Any]
+    #: Replace the node if it is already stored
+    overwrite: bool = False
+
+
+#: Layouts available to store the per-frame results
+LAYOUTS = ("frames", "stacked")
+
+#: Nodes containing the results of each stage for a given frame
+FRAME_PATHS = {
+    "eigenvalues": "eigenvalues/point_{}",
+    "coefficients": "coefficients/point_{}",
+    "energy": "energy/point_{}",
+    "overlaps": "overlaps_{}/mtx_sji_t0",
+    "corrected_overlaps": "overlaps_{}/mtx_sji_t0_corrected",
+    "couplings": "coupling_{}",
+    "tracking": "overlaps_{}/tracking_state",
+}
+
+#: Stages whose arrays can be stored with a :class:`StoragePolicy`. The tracking
+#: states are permutation indices, which are always stored as integers
+POLICY_STAGES = tuple(stage for stage in FRAME_PATHS if stage != "tracking")
+
+#: Stages that can be stored with the lossy archival codec, the other
+#: results are used to compute the following stages
+LOSSY_STAGES = ("overlaps", "corrected_overlaps", "couplings")
+
+FRAME_NODES = {
+    stage: re.compile(r"^(?:(.*)/)?" + re.escape(node).replace(r"\{\}", r"(\d+)") + "$")
+    for stage, node in FRAME_PATHS.items()}
+
+STACKED_FRAMES = re.compile(r"^(?:(.*)/)?stacked/(\w+)/frames$")
+
+#: Approximated size in bytes of the chunks of the stacked datasets
+CHUNK_BYTES = 2 ** 20
+
+#: Seconds waiting for the readers of other processes to release the file lock
+LOCK_TIMEOUT = 60.0
+
+
+class StoragePolicy(NamedTuple):
+    """How the arrays of a quantity are stored in the HDF5.
+
+    ``dtype`` None keeps the data type requested by the writer, ``chunks`` is
+    the chunk shape of a single frame.
+
+    The lossy archival codec sets to zero the entries smaller than
+    ``zero_threshold`` and stores the arrays as integer multiples of
+    ``2 * error_bound``, so the absolute error of the non-zero entries is at
+    most ``error_bound``. With ``sparse`` only the non-zero entries are stored, in
+    compressed sparse row format, which is only used with the ``frames`` layout.
+    """
+
+    dtype: Any = None
+    compression: Optional[str] = None
+    compression_opts: Optional[int] = None
+    shuffle: bool = False
+    chunks: Optional[Tuple[int, ...]] = None
+    error_bound: Optional[float] = None
+    zero_threshold: Optional[float] = None
+    sparse: bool = False
+
+    @classmethod
+    def from_dict(cls, policy: Mapping[str, Any]) -> "StoragePolicy":
+        """Create the policy from the workflow input."""
+        policy = dict(policy)
+        if policy.get("dtype") is not None:
+            policy["dtype"] = np.dtype(policy["dtype"])
+        if policy.get("chunks") is not None:
+            policy["chunks"] = tuple(policy["chunks"])
+        return cls(**policy)
+
+    @property
+    def archival(self) -> bool:
+        """Check whether the policy uses any option of the lossy archival codec."""
+        return self.error_bound is not None or self.zero_threshold is not None or self.sparse
+
+    def dataset_options(self, shape: Tuple[int, ...]) -> Dict[str, Any]:
+        """Return the filters and chunks used by :meth:`h5py.Group.create_dataset`."""
+        # Scalars cannot be chunked, therefore they cannot be compressed either
+        if not shape:
+            return {}
+        options: Dict[str, Any] = {}
+        if self.compression is not None:
+            options["compression"] = self.compression
+            if self.compression_opts is not None:
+                options["compression_opts"] = self.compression_opts
+        if self.shuffle:
+            options["shuffle"] = True
+        if self.chunks is not None:
+            if len(self.chunks) != len(shape):
+                raise ValueError(f"chunks {self.chunks} do not match the shape {shape}")
+            options["chunks"] = tuple(max(1, min(c, n)) for c, n in zip(self.chunks, shape))
+        return options
+
+    def quantize(self, data: np.ndarray) -> np.ndarray:
+        """Return the values that are recovered after storing ``data`` with the codec."""
+        if self.zero_threshold is not None:
+            data = np.where(np.abs(data) < self.zero_threshold, 0, data)
+        if self.error_bound is not None:
+            data = multiples(data, self.error_bound, np.int64) * 2 * self.error_bound
+        return data
+
+    def encode(
+            self, data: np.ndarray, dtype: Any,
+            itype: Any = None) -> Tuple[np.ndarray, Any, Dict[str, Any]]:
+        """Return the values, data type and attributes used to store quantized ``data``.
+
+        The integers have type ``itype``, by default the smallest one holding all of them.
+        """
+        if self.error_bound is None:
+            return data, dtype, {}
+        values = multiples(data, self.error_bound, itype or np.int64)
+        if itype is None:
+            largest = np.abs(values).max(initial=0)
+            itype = next((t for t in (np.int8, np.int16, np.int32)
+                          if largest <= np.iinfo(t).max), np.int64)
+        attrs = {"codec": "quantized", "scale": 2 * self.error_bound,
+                 "decoded_dtype": np.dtype(dtype).str}
+        return values.astype(itype), itype, attrs
+
+
+def multiples(data: np.ndarray, error_bound: float, itype: Any) -> np.ndarray:
+    """Return the multiples of ``2 * error_bound`` closest to ``data``.
+
+    Raises
+    ------
+    ValueError
+        The data is not finite or the multiples do not fit in ``itype``
+
+    """
+    values = np.rint(np.asarray(data, dtype=np.float64) / (2 * error_bound))
+    if not np.isfinite(values).all():
+        raise ValueError("The lossy codec cannot store NaN or infinite values")
+    if np.abs(values).max(initial=0) > np.iinfo(itype).max:
+        raise ValueError(f"The quantized values do not fit in {np.dtype(itype)}, "
+                         f"increase the error bound {error_bound}")
+    return values
+
+
+def frame_path(stage: str, frame: int, prefix: Optional[str] = "") -> str:
+    """Return the node containing the result of ``stage`` for ``frame``."""
+    node = FRAME_PATHS[stage].format(frame)
+    prefix = (prefix or "").strip("/")
+    return f"{prefix}/{node}" if prefix else node
+
+
+def stacked_group(stage: str, prefix: Optional[str] = "") -> str:
+    """Return the group containing the stacked results of ``stage``."""
+    prefix = (prefix or "").strip("/")
+    return f"{prefix}/stacked/{stage}" if prefix else f"stacked/{stage}"
+
+
+def match_frame(node: str) -> Optional[Tuple[str, str, int]]:
+    """Return the stage, prefix and frame of a per-frame node or None."""
+    node = node.strip("/")
+    for stage, pattern in FRAME_NODES.items():
+        match = pattern.match(node)
+        if match is not None:
+            prefix, frame = match.groups()
+            return stage, prefix or "", int(frame)
+    return None
+
+
+class FrameIndex:
+    """Index of the nodes stored in the HDF5.
+
+    Besides the node names, the index keeps a bitmap of the frames computed by
+    each stage in :data:`FRAME_PATHS`, for every prefix (orbitals type) used
+    to store them.
+    """
+
+    def __init__(self, nodes: Iterable[str] = ()) -> None:
+        """Index the given nodes."""
+        self.nodes: Set[str] = set()
+        self._frames: Dict[Tuple[str, str], np.ndarray] = {}
+        for node in nodes:
+            self.add(node)
+
+    @classmethod
+    def from_file(cls, f5: h5py.File) -> "FrameIndex":
+        """Index all the groups and datasets in the file in a single pass."""
+        nodes: List[str] = []
+        f5.visit(nodes.append)
+        index = cls(nodes)
+        # Add the frames stored in the stacked layout
+        for node in nodes:
+            match = STACKED_FRAMES.match(node)
+            if match is not None:
+                prefix, stage = match.groups()
+                for frame in f5[node][()]:
+                    index.add(frame_path(stage, frame, prefix))
+        return index
+
+    def __contains__(self, node: str) -> bool:
+        """Check whether the node is in the index."""
+        return node.strip("/") in self.nodes
+
+    def add(self, node: str) -> None:
+        """Add the node and its parent groups to the index."""
+        node = node.strip("/")
+        self.nodes.add(node)
+        parent = node.rpartition("/")[0]
+        while parent and parent not in self.nodes:
+            self.nodes.add(parent)
+            parent = parent.rpartition("/")[0]
+        match = match_frame(node)
+        if match is not None:
+            self._set_frame(*match)
+
+    @property
+    def has_frames(self) -> bool:
+        """Check whether the results of any frame have been stored."""
+        return bool(self._frames)
+
+    def is_completed(self, stage: str, frame: int, prefix: Optional[str] = "") -> bool:
+        """Check whether ``stage`` has stored the results of ``frame``."""
+        bitmap = self._frames.get((stage, (prefix or "").strip("/")))
+        return bitmap is not None and frame < bitmap.size and bool(bitmap[frame])
+
+    def completed(self, stage: str, size: int, prefix: Optional[str] = "") -> np.ndarray:
+        """Return a boolean array with the frames below ``size`` computed by ``stage``."""
+        result = np.zeros(size, dtype=bool)
+        bitmap = self._frames.get((stage, (prefix or "").strip("/")))
+        if bitmap is not None:
+            n = min(size, bitmap.size)
+            result[:n] = bitmap[:n]
+        return result
+
+    def frames(self, stage: str, prefix: Optional[str] = "") -> np.ndarray:
+        """Return the frames computed by ``stage``."""
+        bitmap = self._frames.get((stage, (prefix or "").strip("/")))
+        return np.zeros(0, dtype=int) if bitmap is None else np.flatnonzero(bitmap)
+
+    def _set_frame(self, stage: str, prefix: str, frame: int) -> None:
+        """Mark ``frame`` as computed, growing the bitmap if necessary."""
+        key = (stage, prefix)
+        bitmap = self._frames.get(key, np.zeros(0, dtype=bool))
+        if frame >= bitmap.size:
+            grown = np.zeros(max(2 * bitmap.size, frame + 1), dtype=bool)
+            grown[:bitmap.size] = bitmap
+            bitmap = self._frames[key] = grown
+        bitmap[frame] = True
+
+
+class HDF5Store:
+    """Keep a single handle to the HDF5 for the lifetime of a workflow stage.
+
+    The file is opened read-only and the writes are kept in memory until
+    :meth:`flush` is called, the pending writes exceed ``max_pending`` bytes
+    or the stage finishes. Then the file is reopened in ``r+`` mode to write
+    all of them at once. Like :meth:`h5py.Group.require_dataset`, writing a
+    node that already exists does not overwrite it, unless it is requested. During a stage the
+    lookups use a :class:`FrameIndex` built the first time it is needed.
+
+    Parameters
+    ----------
+    path_hdf5
+        Path to the HDF5
+    max_pending
+        Maximum size in bytes of the arrays kept in memory before flushing them
+    max_queue
+        Maximum number of flushed batches waiting for the background writer
+
+    """
+
+    def __init__(
+            self, path_hdf5: PathLike, max_pending: int = 2 ** 26, max_queue: int = 4) -> None:
+        """Create the store without opening the file."""
+        self.path_hdf5 = os.path.abspath(os.fsdecode(path_hdf5))
+        self.max_pending = max_pending
+        self.max_queue = max_queue
+        self.asynchronous = False
+        self.swmr = False
+        self._handle: Optional[h5py.File] = None
+        # Handle writing the file in SWMR mode, also used to read it
+        self._swmr_handle: Optional[h5py.File] = None
+        self._pending: Dict[str, PendingWrite] = {}
+        self._pending_bytes = 0
+        # Batches handed to the background writer and the arrays they contain
+        self._batches: Deque[Dict[str, PendingWrite]] = deque()
+        self._inflight: Dict[str, PendingWrite] = {}
+        self._writer: Optional[threading.Thread] = None
+        self._writing = False
+        self._error: Optional[BaseException] = None
+        self._index: Optional[FrameIndex] = None
+        self._layout: Optional[str] = None
+        self._rows: Dict[str, Dict[int, int]] = {}
+        self.policies: Dict[str, StoragePolicy] = {}
+        self._depth = 0
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+
+    def __enter__(self) -> "HDF5Store":
+        """Start a stage keeping the file open until it finishes."""
+        with self._lock:
+            self._depth += 1
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Write the pending arrays and close the file when the outermost stage finishes."""
+        with self._lock:
+            self._depth -= 1
+            if self._depth == 0:
+                try:
+                    self.flush()
+                finally:
+                    self.close()
+
+    @property
+    def in_stage(self) -> bool:
+        """Check whether the store is being used by a stage."""
+        return self._depth > 0
+
+    @property
+    def index(self) -> FrameIndex:
+        """Return the index of the nodes stored or pending, building it if necessary."""
+        with self._lock:
+            if self._index is None:
+                index = FrameIndex.from_file(self.file) if self._on_disk() else FrameIndex()
+                for path in chain(self._inflight, self._pending):
+                    index.add(path)
+                self._index = index
+            return self._index
+
+    @property
+    def layout(self) -> str:
+        """Return the layout used to store the per-frame results, see :data:`LAYOUTS`."""
+        with self._operation():
+            return self._read_layout()
+
+    def set_layout(self, layout: str) -> None:
+        """Select the layout of the per-frame results.
+
+        The layout can only be changed before storing any frame, otherwise the
+        layout of the file is kept.
+        """
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown HDF5 layout: {layout}, available layouts: {LAYOUTS}")
+        with self._operation():
+            current = self._read_layout()
+            if layout == current:
+                return
+            if self.index.has_frames:
+                logger.warning(f"{self.path_hdf5} already contains frames using the "
+                               f"{current} layout, the {layout} layout is ignored")
+                return
+            self.checkpoint()
+            self.close()
+            with open_for_writing(self.path_hdf5) as f5:
+                f5.attrs["layout"] = layout
+            self._layout = layout
+
+    def set_async(self, enabled: bool) -> None:
+        """Write the flushed arrays in a background thread if ``enabled``."""
+        with self._lock:
+            if not enabled:
+                self.checkpoint()
+            self.asynchronous = enabled
+
+    def set_swmr(self, enabled: bool) -> None:
+        """Write the HDF5 in single-writer/multiple-reader mode if ``enabled``.
+
+        The readers cannot see the datasets created after they open the file,
+        hence SWMR mode requires the ``stacked`` layout, which appends the frames
+        to existing datasets. The file must also be created with the HDF5 1.10
+        format, i.e. ``libver='latest'``.
+        """
+        with self._lock:
+            self.checkpoint()
+            self.swmr = False
+            with self._operation():
+                if enabled and self._read_layout() != "stacked":
+                    logger.warning(f"SWMR mode requires the stacked layout, "
+                                   f"{self.path_hdf5} uses the {self._read_layout()} layout")
+                    return
+                if enabled and (not self._on_disk() or
+                                self.file.id.get_create_plist().get_version()[0] < 3):
+                    logger.warning(f"{self.path_hdf5} was not created with the HDF5 1.10 "
+                                   f"format required by SWMR mode")
+                    return
+                stored = self._on_disk() and bool(self.file.attrs.get("swmr", False))
+            if stored != enabled:
+                self.close()
+                # The followers read this attribute to decide whether to keep the file open
+                with open_for_writing(self.path_hdf5) as f5:
+                    f5.attrs["swmr"] = enabled
+            self.swmr = enabled
+
+    def set_policies(self, policies: Mapping[str, Mapping[str, Any]]) -> None:
+        """Set the :class:`StoragePolicy` of each stage in :data:`POLICY_STAGES`."""
+        unknown = set(policies).difference(POLICY_STAGES)
+        if unknown:
+            raise ValueError(f"No storage policy can be set for {sorted(unknown)}, "
+                             f"available stages: {POLICY_STAGES}")
+        new = {stage: StoragePolicy.from_dict(policy) for stage, policy in policies.items()}
+        lossy = sorted(stage for stage, policy in new.items()
+                       if policy.archival and stage not in LOSSY_STAGES)
+        if lossy:
+            raise ValueError(f"The lossy codec cannot store {lossy}, "
+                             f"only the stages {LOSSY_STAGES}")
+        with self._lock:
+            self.policies = new
+
+    def policy(self, path: str) -> StoragePolicy:
+        """Return the policy used to store the node ``path``."""
+        match = match_frame(path)
+        if match is None or match[0] not in POLICY_STAGES:
+            return StoragePolicy()
+        return self.policies.get(match[0], StoragePolicy())
+
+    def is_completed(self, stage: str, frame: int, prefix: Optional[str] = "") -> bool:
+        """Check whether ``stage`` has stored the results of ``frame``, see :class:`FrameIndex`."""
+        with self._operation():
+            return self.index.is_completed(stage, frame, prefix)
+
+    def completed(self, stage: str, size: int, prefix: Optional[str] = "") -> np.ndarray:
+        """Return the bitmap of the frames computed by ``stage``, see :class:`FrameIndex`."""
+        with self._operation():
+            return self.index.completed(stage, size, prefix)
+
+    def contains(self, paths: Union[str, List[str]]) -> bool:
+        """Check whether the node or all the nodes in ``paths`` are stored."""
+        paths = paths if isinstance(paths, list) else [paths]
+        with self._operation():
+            if not self._on_disk():
+                return False
+            return all(self._exists(path) for path in paths)
+
+    @overload
+    def read(self, paths: str) -> np.ndarray:
+        ...
+
+    @overload
+    def read(self, paths: List[str]) -> List[np.ndarray]:
+        ...
+
+    def read(self, paths):
+        """Read the array stored in ``paths`` or a list of arrays.
+
+        Raises
+        ------
+        KeyError
+            The node is not stored
+        FileNotFoundError
+            The HDF5 does not exist
+
+        """
+        with self._operation():
+            if isinstance(paths, list):
+                return [self._read(path) for path in paths]
+            return self._read(paths)
+
+    def read_slice(self, path: str, selection: Tuple[Any, ...]) -> np.ndarray:
+        """Read the hyperslab ``selection`` of the node, e.g. ``np.s_[:, 10:20]``.
+
+        Only the selected elements are read from the file.
+        """
+        with self._operation():
+            return self._read(path, selection)
+
+    def attributes(self, path: str) -> Dict[str, Any]:
+        """Return the attributes of the node.
+
+        With the ``stacked`` layout the attributes are shared by all the frames.
+        """
+        with self._operation():
+            pending = self._unwritten(path)
+            if pending is not None and self._is_pending(path):
+                return dict(pending.attrs)
+            node, _ = self._dataset(path)
+            attrs = node.attrs if isinstance(node, h5py.Dataset) else node["data"].attrs
+            return {name: value for name, value in attrs.items() if name not in CODEC_ATTRS}
+
+    def read_frames(
+            self, stage: str, frames: Sequence[int], prefix: Optional[str] = "") -> np.ndarray:
+        """Read the results of ``stage`` for the given ``frames`` as a single array.
+
+        With the ``stacked`` layout the frames are read using a single I/O operation.
+
+        Raises
+        ------
+        KeyError
+            Some of the frames are not stored
+
+        """
+        paths = [frame_path(stage, frame, prefix) for frame in frames]
+        with self._operation():
+            unwritten = any(self._unwritten(path) is not None for path in paths)
+            if unwritten and not self.asynchronous:
+                self.flush()
+            elif unwritten:
+                return np.stack([self._read(path) for path in paths])
+            if self._read_layout() != "stacked":
+                return np.stack([self._read(path) for path in paths])
+
+            group = stacked_group(stage, prefix)
+            found = [self._row(group, frame) for frame in frames]
+            missing = [path for path, row in zip(paths, found) if row is None]
+            if missing:
+                raise KeyError(f"There is not {missing} stored in the HDF5")
+            rows = [row for row in found if row is not None]
+            data = self.file[group]["data"]
+            start = rows[0]
+            if rows == list(range(start, start + len(rows))):
+                return decode(data[start: start + len(rows)], data.attrs)
+            unique, inverse = np.unique(rows, return_inverse=True)
+            return decode(data[unique.tolist()], data.attrs)[inverse]
+
+    def write(
+            self, path: str, data: np.ndarray, dtype: Any = np.float32,
+            attrs: Optional[Mapping[str, Any]] = None, overwrite: bool = False) -> None:
+        """Schedule ``data`` to be stored in ``path`` using ``dtype``.
+
+        The data type of the :class:`StoragePolicy` of the node takes precedence.
+        The array is copied, since the caller may modify it before it is written.
+        A node already stored is only replaced if ``overwrite`` is True.
+        """
+        data = np.array(data)
+        with self._lock:
+            policy = self.policy(path)
+            dtype = policy.dtype or dtype
+            # The pending arrays hold the same values that are read from the file
+            data = policy.quantize(data)
+            previous = self._pending.pop(path, None)
+            if previous is not None:
+                self._pending_bytes -= previous.data.nbytes
+            self._pending[path] = PendingWrite(data, dtype, dict(attrs or {}), overwrite)
+            self._pending_bytes += data.nbytes
+            if self._index is not None:
+                self._index.add(path)
+            if not self.in_stage or self._pending_bytes > self.max_pending:
+                self.flush()
+
+    def write_frames(
+            self, stage: str, frames: Sequence[int], data: Iterable[np.ndarray],
+            prefix: Optional[str] = "", dtype: Any = np.float32) -> None:
+        """Store the results of ``stage`` for the given ``frames``.
+
+        With the ``stacked`` layout the frames are appended using a single I/O operation.
+        """
+        with self:
+            for frame, array in zip(frames, data):
+                self.write(frame_path(stage, frame, prefix), array, dtype=dtype)
+
+    def flush(self) -> None:
+        """Write all the pending arrays in the HDF5.
+
+        With asynchronous writes the arrays are handed to the background writer,
+        waiting for it if there are already ``max_queue`` batches in the queue.
+        """
+        with self._lock:
+            self._raise_writer_error()
+            if not self._pending:
+                return
+            if not self.asynchronous:
+                # The read-only handle cannot be used to write
+                self.close()
+                self._write_batch(self._pending)
+                self._pending, self._pending_bytes = {}, 0
+                return
+            batch, self._pending, self._pending_bytes = self._pending, {}, 0
+            while len(self._batches) >= self.max_queue:
+                self._cond.wait()
+            self._batches.append(batch)
+            self._inflight.update(batch)
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(
+                    target=self._write_in_background, name="hdf5-writer", daemon=True)
+                self._writer.start()
+            self._cond.notify_all()
+
+    def checkpoint(self) -> None:
+        """Write the pending arrays and wait until all of them are in the file.
+
+        The handle writing the file in SWMR mode is also closed.
+        """
+        with self._lock:
+            self.flush()
+            while self._batches:
+                self._cond.wait()
+            if self._swmr_handle is not None:
+                self._swmr_handle.close()
+                self._swmr_handle = None
+            self._raise_writer_error()
+
+    def close(self) -> None:
+        """Close the handle to the HDF5, the pending writes are kept."""
+        with self._lock:
+            self._close_handle()
+            # The file may be modified by somebody else between stages
+            if not self.in_stage:
+                self._index = None
+                self._layout = None
+
+    @property
+    def file(self) -> h5py.File:
+        """Return the read-only handle to the HDF5, opening it if necessary.
+
+        The handle is not available while the background writer is writing,
+        which closes it even during a stage. Hence the groups and datasets
+        taken from the handle must be used while holding the lock of the store,
+        the other callers should use methods like :meth:`attributes` instead.
+        """
+        with self._lock:
+            while self._writing:
+                self._cond.wait()
+            # The file cannot be opened again while it is written in SWMR mode
+            if self._swmr_handle is not None:
+                return self._swmr_handle
+            if self._handle is None:
+                if not os.path.exists(self.path_hdf5):
+                    raise FileNotFoundError(self.path_hdf5)
+                self._handle = h5py.File(self.path_hdf5, 'r')
+            return self._handle
+
+    def _close_handle(self) -> None:
+        """Close the read-only handle and forget the rows of the stacked frames."""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        self._rows.clear()
+
+    def _write_in_background(self) -> None:
+        """Write the batches in the queue one after the other."""
+        while True:
+            with self._lock:
+                while not self._batches:
+                    self._cond.wait()
+                batch = self._batches[0]
+                # The readers wait until the file is closed by the writer
+                self._close_handle()
+                self._writing = True
+            try:
+                self._write_batch(batch)
+            except Exception as error:
+                logger.error(f"writing {len(batch)} arrays in {self.path_hdf5} failed: {error}")
+                self._error = error
+            with self._lock:
+                self._writing = False
+                self._batches.popleft()
+                for path, pending in batch.items():
+                    if self._inflight.get(path) is pending:
+                        del self._inflight[path]
+                self._cond.notify_all()
+
+    def _write_batch(self, batch: Mapping[str, PendingWrite]) -> None:
+        """Write the arrays in the HDF5, opening it in ``r+`` mode."""
+        if self.swmr:
+            self._write_swmr(batch)
+        else:
+            with open_for_writing(self.path_hdf5) as f5:
+                self._write_nodes(f5, batch)
+        logger.debug(f"{len(batch)} arrays written in {self.path_hdf5}")
+
+    def _write_swmr(self, batch: Mapping[str, PendingWrite]) -> None:
+        """Write the arrays keeping the file open in SWMR mode.
+
+        New groups and datasets cannot be created in SWMR mode, so the file is
+        reopened to create them before switching to SWMR mode again.
+        """
+        f5 = self._swmr_handle
+        # The datasets cannot be deleted in SWMR mode either
+        replaced = any(pending.overwrite and match_frame(path) is None
+                       for path, pending in batch.items())
+        if f5 is not None and (replaced or any(node not in f5 for node in self._nodes(f5, batch))):
+            f5.close()
+            f5 = self._swmr_handle = None
+        if f5 is None:
+            # The followers keep a lock on the file
+            f5 = self._swmr_handle = h5py.File(
+                self.path_hdf5, 'r+', libver='latest', locking=False)
+        self._write_nodes(f5, batch)
+        if not f5.swmr_mode:
+            f5.swmr_mode = True
+        f5.flush()
+
+    @staticmethod
+    def _nodes(f5: h5py.File, batch: Iterable[str]) -> Set[str]:
+        """Return the datasets and stacked groups where the arrays are written."""
+        stacked = f5.attrs.get("layout", "frames") in ("stacked", b"stacked")
+        nodes = set()
+        for path in batch:
+            match = match_frame(path) if stacked else None
+            nodes.add(path if match is None else stacked_group(*match[:2]))
+        return nodes
+
+    def _write_nodes(self, f5: h5py.File, batch: Mapping[str, PendingWrite]) -> None:
+        """Write the arrays in the open file, appending the frames of the stacked layout."""
+        stacked = f5.attrs.get("layout", "frames") in ("stacked", b"stacked")
+        groups: DefaultDict[str, List[Tuple[int, PendingWrite]]] = defaultdict(list)
+        for path, pending in batch.items():
+            match = match_frame(path) if stacked else None
+            if match is not None:
+                stage, prefix, frame = match
+                groups[stacked_group(stage, prefix)].append((frame, pending))
+                continue
+            if pending.overwrite and path in f5:
+                del f5[path]
+            policy = self.policy(path)
+            if policy.sparse and pending.data.ndim > 0:
+                if path not in f5:
+                    write_sparse(f5, path, pending, policy)
+                continue
+            data, dtype, attrs, _ = pending
+            data, dtype, codec = policy.encode(data, dtype)
+            options = policy.dataset_options(data.shape)
+            dset = f5.require_dataset(
+                path, shape=data.shape, data=data, dtype=dtype, **options)
+            for name, value in chain(attrs.items(), codec.items()):
+                dset.attrs[name] = value
+        for group, items in groups.items():
+            stage = group.rpartition("/")[2]
+            append_frames(f5, group, items, self.policies.get(stage, StoragePolicy()))
+
+    def _raise_writer_error(self) -> None:
+        """Raise the error of the background writer, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"The arrays could not be written in {self.path_hdf5}") from error
+
+    @contextmanager
+    def _operation(self) -> Iterator[None]:
+        """Close the file after the operation unless there is an active stage."""
+        with self._lock:
+            try:
+                yield
+            finally:
+                if not self.in_stage:
+                    self.close()
+
+    def _on_disk(self) -> bool:
+        """Check whether the HDF5 exists, the workflows start from an empty file."""
+        return os.path.exists(self.path_hdf5) and os.path.getsize(self.path_hdf5) > 0
+
+    def _read_layout(self) -> str:
+        """Read the layout from the attributes of the file."""
+        if self._layout is None:
+            layout = self.file.attrs.get("layout", "frames") if self._on_disk() else "frames"
+            self._layout = layout.decode() if isinstance(layout, bytes) else layout
+        return self._layout
+
+    def _locate(self, path: str) -> Optional[Tuple[str, int]]:
+        """Return the stacked group and frame of a per-frame node or None."""
+        if self._read_layout() != "stacked":
+            return None
+        match = match_frame(path)
+        if match is None:
+            return None
+        stage, prefix, frame = match
+        return stacked_group(stage, prefix), frame
+
+    def _row(self, group: str, frame: int) -> Optional[int]:
+        """Return the row containing ``frame`` in a stacked group or None."""
+        rows = self._rows.get(group)
+        if rows is None:
+            frames = self.file[group]["frames"][()] if group in self.file else []
+            rows = self._rows[group] = {int(f): row for row, f in enumerate(frames)}
+        return rows.get(frame)
+
+    def _stored(self, path: str) -> bool:
+        """Check if the node has been written in the file."""
+        location = self._locate(path)
+        if location is not None:
+            return self._row(*location) is not None
+        return path in self.file
+
+    def _exists(self, path: str) -> bool:
+        """Check if the node exists, using the index during a stage."""
+        if self.in_stage:
+            return path in self.index
+        return self._unwritten(path) is not None or self._stored(path)
+
+    def _unwritten(self, path: str) -> Optional[PendingWrite]:
+        """Return the array waiting to be written in the node, if any."""
+        pending = self._pending.get(path)
+        return pending if pending is not None else self._inflight.get(path)
+
+    def _is_pending(self, path: str) -> bool:
+        """Check if the node is only available in the pending writes."""
+        pending = self._unwritten(path)
+        if pending is None:
+            return False
+        return pending.overwrite or not (self._on_disk() and self._stored(path))
+
+    def _dataset(self, path: str) -> Tuple[Union[h5py.Dataset, h5py.Group], Tuple[int, ...]]:
+        """Return the dataset containing the node and the index of the node in it.
+
+        The arrays stored in sparse format are groups.
+        """
+        location = self._locate(path)
+        if location is None:
+            return self.file[path], ()
+        group, frame = location
+        row = self._row(group, frame)
+        if row is None:
+            raise KeyError(path)
+        return self.file[group]["data"], (row,)
+
+    def _read(self, path: str, selection: Tuple[Any, ...] = ()) -> np.ndarray:
+        """Read a node, or the ``selection`` of it, from the file or the pending writes."""
+        pending = self._unwritten(path)
+        if pending is not None and self._is_pending(path):
+            return pending.data.astype(pending.dtype)[selection]
+        node, index = self._dataset(path)
+        return read_node(node, index + selection)
+
+
+def open_for_writing(path_hdf5: str, timeout: float = LOCK_TIMEOUT) -> h5py.File:
+    """Open the HDF5 in ``r+`` mode, waiting while another process holds a lock on it.
+
+    The :class:`HDF5Follower` of a file written without SWMR mode keeps it
+    locked while it reads the new frames.
+
+    Raises
+    ------
+    BlockingIOError
+        The file is still locked after ``timeout`` seconds
+
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return h5py.File(path_hdf5, 'r+')
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise
+            logger.debug(f"waiting for the lock of {path_hdf5}")
+            time.sleep(0.01)
+
+
+#: Attributes describing how the arrays are encoded
+CODEC_ATTRS = ("codec", "scale", "decoded_dtype")
+
+
+def decode(values: np.ndarray, attrs: Mapping[str, Any]) -> np.ndarray:
+    """Recover the array stored using :meth:`StoragePolicy.encode`."""
+    if attrs.get("codec") != "quantized":
+        return values
+    return (values * attrs["scale"]).astype(attrs["decoded_dtype"])
+
+
+def write_sparse(f5: h5py.File, path: str, pending: PendingWrite, policy: StoragePolicy) -> None:
+    """Store the non-zero entries of the array in compressed sparse row format.
+
+    The arrays with more than two dimensions are flattened to a matrix.
+    """
+    data, dtype, attrs, _ = pending
+    matrix = data.reshape(data.shape[0], -1) if data.ndim > 1 else data.reshape(1, -1)
+    mask = matrix != 0
+    rows, indices = np.nonzero(mask)
+    indptr = np.concatenate(([0], np.cumsum(mask.sum(axis=1))))
+    values, dtype, codec = policy.encode(matrix[rows, indices], dtype)
+    g5 = f5.create_group(path)
+    dset = g5.create_dataset("data", data=values, dtype=dtype,
+                             **policy._replace(chunks=None).dataset_options(values.shape))
+    g5.create_dataset("indices", data=indices.astype(np.int32))
+    g5.create_dataset("indptr", data=indptr.astype(np.int64))
+    g5.create_dataset("shape", data=np.array(data.shape, dtype=np.int64))
+    for name, value in chain(attrs.items(), codec.items()):
+        dset.attrs[name] = value
+
+
+def read_node(node: Union[h5py.Dataset, h5py.Group], selection: Tuple[Any, ...] = ()) -> np.ndarray:
+    """Read the ``selection`` of a dataset or of an array stored by :func:`write_sparse`."""
+    if isinstance(node, h5py.Dataset):
+        return decode(node[selection], node.attrs)
+    data = node["data"]
+    values, indptr = decode(data[()], data.attrs), node["indptr"][()]
+    shape = tuple(node["shape"][()])
+    matrix = np.zeros((len(indptr) - 1, int(np.prod(shape[1:])) if len(shape) > 1 else shape[0]),
+                      dtype=values.dtype)
+    matrix[np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), node["indices"][()]] = values
+    return matrix.reshape(shape)[selection]
+
+
+def append_frames(
+        f5: h5py.File, group: str, items: List[Tuple[int, PendingWrite]],
+        policy: StoragePolicy = StoragePolicy()) -> None:
+    """Append the frames missing in the stacked ``group``, creating it if necessary.
+
+    The rows of the stored frames are only written if they are overwritten.
+    """
+    if group not in f5:
+        _, (data, dtype, attrs, _) = items[0]
+        _, dtype, codec = policy.encode(data, dtype, np.int32)
+        attrs = {**attrs, **codec}
+        options = policy.dataset_options(data.shape)
+        frame_chunks = options.pop("chunks", data.shape)
+        frame_bytes = max(1, np.dtype(dtype).itemsize * int(np.prod(frame_chunks)))
+        nchunk = int(np.clip(CHUNK_BYTES // frame_bytes, 1, 1024))
+        g5 = f5.create_group(group)
+        g5.create_dataset("data", shape=(0, *data.shape), maxshape=(None, *data.shape),
+                          chunks=(nchunk, *frame_chunks), dtype=dtype, **options)
+        g5.create_dataset("frames", shape=(0,), maxshape=(None,), chunks=(1024,), dtype=np.int64)
+        # The attributes are shared by all the frames
+        for name, value in attrs.items():
+            g5["data"].attrs[name] = value
+
+    dset, frames = f5[group]["data"], f5[group]["frames"]
+    stored = {frame: row for row, frame in enumerate(frames[()].tolist())}
+    new = sorted((item for item in items if item[0] not in stored), key=lambda item: item[0])
+    replaced = [(stored[frame], pending) for frame, pending in items
+                if frame in stored and pending.overwrite]
+    if not (new or replaced):
+        return
+    if dset.is_virtual:
+        raise RuntimeError(f"The frames cannot be written in the virtual dataset in {group}")
+    if any(pending.data.shape != dset.shape[1:] for _, pending in chain(new, replaced)):
+        raise TypeError(f"The frames stored in {group} must have shape {dset.shape[1:]}")
+
+    for row, pending in replaced:
+        dset[row] = encode_rows(dset, group, pending.data[np.newaxis])[0]
+    if not new:
+        return
+    start = dset.shape[0]
+    dset.resize(start + len(new), axis=0)
+    dset[start:] = encode_rows(dset, group, np.stack([pending.data for _, pending in new]))
+    frames.resize(start + len(new), axis=0)
+    frames[start:] = [frame for frame, _ in new]
+
+
+def encode_rows(dset: h5py.Dataset, group: str, stacked: np.ndarray) -> np.ndarray:
+    """Encode the frames written in the rows of a stacked dataset with its codec."""
+    if dset.attrs.get("codec") != "quantized":
+        return stacked
+    stacked = np.rint(stacked / dset.attrs["scale"])
+    # NaN fails the comparison, it would be stored as the smallest integer
+    if not np.abs(stacked).max(initial=0) <= np.iinfo(dset.dtype).max:
+        raise ValueError(f"The quantized frames do not fit in the dataset of {group}")
+    return stacked
+
+
+class HDF5Follower:
+    """Read the frames of a stage while a workflow is still writing them.
+
+    Each call to :meth:`poll` returns only the frames stored since the previous
+    call. If the workflow writes the file in SWMR mode the follower keeps it
+    open, without the HDF5 file locks, and reads the rows appended to the
+    stacked datasets. Otherwise the file is opened read-only and locked for
+    each poll, so that no frame is read while it is being written: a poll
+    that finds the file locked by the workflow returns nothing, and the
+    workflow waits for the poll to finish, see :func:`open_for_writing`.
+
+    Parameters
+    ----------
+    path_hdf5
+        Path to the HDF5
+    stage
+        Name of the stage that computes the frames, see :data:`FRAME_PATHS`
+    prefix
+        Orbitals type of the frames: ``""``, ``alphas`` or ``betas``
+
+    """
+
+    def __init__(self, path_hdf5: PathLike, stage: str, prefix: Optional[str] = "") -> None:
+        """Create the follower without opening the file."""
+        if stage not in FRAME_PATHS:
+            raise ValueError(f"Unknown stage: {stage}, available stages: {tuple(FRAME_PATHS)}")
+        self.path_hdf5 = os.path.abspath(os.fsdecode(path_hdf5))
+        self.stage = stage
+        self.prefix = (prefix or "").strip("/")
+        self._handle: Optional[h5py.File] = None
+        # Rows of the stacked datasets and frames already returned
+        self._rows = 0
+        self._seen: Set[int] = set()
+
+    def __enter__(self) -> "HDF5Follower":
+        """Follow the stage until the context finishes."""
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Close the file."""
+        self.close()
+
+    def close(self) -> None:
+        """Close the file, it is opened again by the next poll."""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def poll(self) -> Tuple[List[int], List[np.ndarray]]:
+        """Return the frames stored since the previous poll and their arrays.
+
+        Nothing is returned while the file cannot be read, for example while
+        the workflow is creating new datasets.
+        """
+        try:
+            return self._poll()
+        except (OSError, KeyError, RuntimeError) as error:
+            logger.debug(f"{self.path_hdf5} cannot be read yet: {error}")
+            self.close()
+            return [], []
+
+    def follow(
+            self, interval: float = 1.0,
+            timeout: Optional[float] = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """Yield the frames as they are stored, polling every ``interval`` seconds.
+
+        The iteration finishes after ``timeout`` seconds without new frames, it
+        runs until interrupted if ``timeout`` is None.
+        """
+        last = time.monotonic()
+        while True:
+            frames, arrays = self.poll()
+            yield from zip(frames, arrays)
+            if frames:
+                last = time.monotonic()
+            elif timeout is not None and time.monotonic() - last >= timeout:
+                return
+            else:
+                time.sleep(interval)
+
+    def _poll(self) -> Tuple[List[int], List[np.ndarray]]:
+        """Read the new frames, see :meth:`poll`."""
+        if self._handle is None:
+            self._handle = h5py.File(self.path_hdf5, 'r', libver='latest', swmr=True)
+            if self._handle.attrs.get("swmr", False):
+                # The SWMR writer does not wait for the lock of a handle kept open
+                self._handle.close()
+                self._handle = h5py.File(
+                    self.path_hdf5, 'r', libver='latest', swmr=True, locking=False)
+        f5 = self._handle
+        if f5.attrs.get("layout", "frames") not in ("stacked", b"stacked"):
+            try:
+                return self._read_new_nodes(f5)
+            finally:
+                self.close()
+
+        group = stacked_group(self.stage, self.prefix)
+        # The groups created after opening the file are not visible
+        if group not in f5:
+            self.close()
+            return [], []
+        data, frames = f5[group]["data"], f5[group]["frames"]
+        if f5.swmr_mode:
+            frames.refresh()
+            data.refresh()
+        rows = min(len(frames), len(data))
+        new_frames = frames[self._rows: rows].tolist()
+        arrays = list(decode(data[self._rows: rows], data.attrs))
+        self._rows = rows
+        if not f5.attrs.get("swmr", False):
+            self.close()
+        return new_frames, arrays
+
+    def _read_new_nodes(self, f5: h5py.File) -> Tuple[List[int], List[np.ndarray]]:
+        """Read the frames stored as one dataset each that have not been returned."""
+        frames = [int(i) for i in FrameIndex.from_file(f5).frames(self.stage, self.prefix)
+                  if i not in self._seen]
+        arrays = [read_node(f5[frame_path(self.stage, i, self.prefix)]) for i in frames]
+        self._seen.update(frames)
+        return frames, arrays
+
+
+#: Stores shared by all the stages using the same HDF5
+_stores: Dict[str, HDF5Store] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path_hdf5: PathLike) -> HDF5Store:
+    """Return the store shared by all the users of ``path_hdf5``."""
+    key = os.path.abspath(os.fsdecode(path_hdf5))
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = HDF5Store(path_hdf5)
+        return _stores[key]
+
+
+@atexit.register
+def checkpoint_stores() -> None:
+    """Write the arrays waiting in all the stores."""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        try:
+            store.checkpoint()
+        except Exception as error:
+            logger.error(f"the arrays could not be written in {store.path_hdf5}: {error}")
@@ -1,9 +1,13 @@
 """Nonadiabatic coupling implementation."""
 from .nonAdiabaticCoupling import (calculate_couplings_3points,
+                                   calculate_couplings_batch,
                                    calculate_couplings_levine,
                                    compute_overlaps_for_coupling,
+                                   compute_mo_overlaps_for_trajectory,
+                                   compute_overlaps_for_trajectory,
                                    correct_phases)
 
-__all__ = ['calculate_couplings_3points', 'calculate_couplings_levine',
+__all__ = ['calculate_couplings_3points', 'calculate_couplings_batch',
            'calculate_couplings_levine', 'compute_overlaps_for_coupling',
+           'compute_mo_overlaps_for_trajectory', 'compute_overlaps_for_trajectory',
            'correct_phases']
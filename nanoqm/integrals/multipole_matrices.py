@@ -9,25 +9,26 @@ Index
 .. autosummary::
     get_multipole_matrix
     compute_matrix_multipole
+    compute_sparse_multipole
 
 API
 ---
 .. autofunction:: get_multipole_matrix
 .. autofunction:: compute_matrix_multipole
+.. autofunction:: compute_sparse_multipole
 """
 import logging
-import os
-import uuid
 from os.path import join
 from pathlib import Path
 from typing import List, Optional, Union
 
 import numpy as np
-from compute_integrals import compute_integrals_multipole
 from qmflows.common import AtomXYZ
+from scipy import sparse
 
-from ..common import (DictConfig, Matrix, is_data_in_hdf5, retrieve_hdf5_data,
-                      store_arrays_in_hdf5, tuplesXYZ_to_plams)
+from ..common import (DictConfig, Matrix, blas_threads, is_data_in_hdf5,
+                      molecule_to_arrays, retrieve_hdf5_data, store_arrays_in_hdf5)
+from .session import get_integral_session, log_integrals_stats
 
 logger = logging.getLogger(__name__)
 
@@ -75,13 +76,15 @@ def search_multipole_in_hdf5(
 
 
 def compute_matrix_multipole(
-        mol: List[AtomXYZ], config: DictConfig, multipole: str) -> Matrix:
+        mol: List[AtomXYZ], config: DictConfig, multipole: str,
+        out: Optional[np.ndarray] = None) -> Matrix:
     """Compute a `multipole` matrix: overlap, dipole, etc. for a given geometry `mol`.
 
     The multipole is Computed in spherical coordinates.
 
-    Note: for the dipole and quadrupole the super_matrix contains all the matrices stack all the
-    0-axis.
+    Note: for the dipole and quadrupole the result is a C ordered tensor with the matrix
+    of each operator component along the 0-axis, which is filled in place by the
+    integrals library.
 
     Parameters
     ----------
@@ -91,6 +94,9 @@ def compute_matrix_multipole(
         Dictionary with the current configuration
     multipole
         kind of multipole to compute
+    out
+        Optional C contiguous float64 array with the shape of the result
+        where the integrals are written
 
     Returns
     -------
@@ -98,39 +104,67 @@ def compute_matrix_multipole(
         Matrix with entries <ψi | x^i y^j z^k | ψj>
 
     """
-    path_hdf5 = config.path_hdf5
+    # Pass the geometry in memory to the integrals library
+    coordinates, atomic_numbers = molecule_to_arrays(mol)
 
-    # Write molecule in temporal file
-    path = join(config.scratch_path, f"molecule_{uuid.uuid4()}.xyz")
-    mol_plams = tuplesXYZ_to_plams(mol)
-    mol_plams.write(path)
+    # Integrals state shared by all the frames
+    session = get_integral_session(config)
 
-    # name of the basis set
-    basis_name = config["cp2k_general_settings"]["basis"]
+    # Shell pairs with an estimated overlap below the threshold are skipped
+    threshold = config.screening_threshold
 
-    if multipole == 'overlap':
-        matrix_multipole = compute_integrals_multipole(
-            path, path_hdf5, basis_name, multipole)
-    elif multipole == 'dipole':
-        # The tensor contains the overlap + {x, y, z} dipole matrices
-        super_matrix = compute_integrals_multipole(
-            path, path_hdf5, basis_name, multipole)
-        dim = super_matrix.shape[1]
+    if multipole not in {'overlap', 'dipole', 'quadrupole'}:
+        raise ValueError(f"unknown multipole: {multipole}")
 
-        # Reshape the super_matrix as a tensor containing overlap + {x, y, z} dipole matrices
-        matrix_multipole = super_matrix.reshape(4, dim, dim)
+    # BLAS threads are not used while the integrals run
+    with blas_threads(1):
+        if multipole == 'overlap':
+            matrix_multipole = session.overlap(coordinates, atomic_numbers, threshold, out)
+        else:
+            # The tensor contains the overlap + {x, y, z} dipole matrices
+            # and the {xx, xy, xz, yy, yz, zz} quadrupole matrices
+            matrix_multipole = session.multipole(
+                coordinates, atomic_numbers, multipole, threshold, out)
 
-    elif multipole == 'quadrupole':
-        # The tensor contains the overlap + {xx, xy, xz, yy, yz, zz} quadrupole matrices
-        print("super_matrix: ", path, path_hdf5, basis_name, multipole)
-        super_matrix = compute_integrals_multipole(
-            path, path_hdf5, basis_name, multipole)
-        dim = super_matrix.shape[1]
+    log_integrals_stats(session)
 
-        # Reshape to 3d tensor containing overlap + {x, y, z} + {xx, xy, xz, yy, yz, zz} quadrupole matrices
-        matrix_multipole = super_matrix.reshape(10, dim, dim)
+    return matrix_multipole
 
-    # Delete the tmp molecule file
-    os.remove(path)
 
-    return matrix_multipole
+def compute_sparse_multipole(
+        mol: List[AtomXYZ], config: DictConfig,
+        multipole: str) -> Union[sparse.csr_matrix, List[sparse.csr_matrix]]:
+    """Compute a `multipole` as atom-block sparse matrices for a given geometry `mol`.
+
+    The blocks between two atoms whose integrals are all smaller than
+    ``config.ao_drop_tolerance`` are not stored, therefore the memory
+    grows linearly with the number of atoms for large systems.
+
+    Parameters
+    ----------
+    mol
+        Molecule to compute the multipole
+    config
+        Dictionary with the current configuration
+    multipole
+        kind of multipole to compute
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        The overlap or a list with the sparse matrix of each operator component
+
+    """
+    coordinates, atomic_numbers = molecule_to_arrays(mol)
+    session = get_integral_session(config)
+    drop_tolerance = config.ao_drop_tolerance or 0.0
+
+    with blas_threads(1):
+        matrices = session.sparse_multipole(
+            coordinates, atomic_numbers, multipole, config.screening_threshold, drop_tolerance)
+
+    log_integrals_stats(session)
+    density = sum(m.nnz for m in matrices) / (len(matrices) * np.prod(matrices[0].shape))
+    logger.info(f"the sparse {multipole} stores {density:.1%} of the entries")
+
+    return matrices[0] if multipole == 'overlap' else matrices
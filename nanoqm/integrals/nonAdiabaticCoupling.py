@@ -13,7 +13,10 @@ Index
 .. autosummary::
     calculate_couplings_3points
     calculate_couplings_levine
+    calculate_couplings_batch
     compute_overlaps_for_coupling
+    compute_overlaps_for_trajectory
+    compute_mo_overlaps_for_trajectory
     correct_phases
 
 
@@ -21,24 +24,30 @@ API
 ---
 .. autofunction:: calculate_couplings_3points
 .. autofunction:: calculate_couplings_levine
+.. autofunction:: calculate_couplings_batch
 .. autofunction:: compute_overlaps_for_coupling
+.. autofunction:: compute_overlaps_for_trajectory
+.. autofunction:: compute_mo_overlaps_for_trajectory
 .. autofunction:: correct_phases
 
 """
-__all__ = ['calculate_couplings_3points', 'calculate_couplings_levine',
-           'compute_overlaps_for_coupling', 'correct_phases']
+__all__ = ['calculate_couplings_3points', 'calculate_couplings_levine', 'calculate_couplings_batch',
+           'compute_overlaps_for_coupling', 'compute_overlaps_for_trajectory',
+           'compute_mo_overlaps_for_trajectory', 'correct_phases']
 
-import os
-import uuid
-from os.path import join
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 import numpy as np
 
-from compute_integrals import compute_integrals_couplings
+from ..common import (DictConfig, Matrix, MolXYZ, Tensor3D, blas_threads,
+                      molecule_to_arrays)
+from ..hdf5_store import HDF5Store, get_store
+from .session import get_integral_session, log_integrals_stats
 
-from ..common import (DictConfig, Matrix, MolXYZ, Tensor3D, retrieve_hdf5_data,
-                      tuplesXYZ_to_plams)
+# Starting logger
+logger = logging.getLogger(__name__)
 
 
 def calculate_couplings_3points(
@@ -154,6 +163,104 @@ def calculate_couplings_levine(dt: float, w_jk: Matrix,
     return cte * (np.arccos(w_jj) * (A + B) + np.arcsin(w_kj) * (C + D) + E)
 
 
+def calculate_couplings_batch(
+        dt: float, overlaps: Tensor3D, algorithm: str = "levine", workers: int = 1) -> Tensor3D:
+    """Compute the couplings between consecutive frames of a stack of overlap matrices.
+
+    Each overlap ``S`` is used like ``S`` and ``S.T`` in
+    :func:`calculate_couplings_levine` or :func:`calculate_couplings_3points`,
+    which use one and two consecutive overlaps per coupling respectively.
+    The frames are split among ``workers`` threads, NumPy releases the GIL
+    while the element-wise functions are evaluated.
+
+    Returns
+    -------
+    np.ndarray
+        Couplings with shape ``(len(overlaps) - step + 1, n, n)``
+
+    """
+    kernel, step = {"levine": (levine_kernel, 1), "3points": (three_points_kernel, 2)}[algorithm]
+    ncouplings = len(overlaps) - step + 1
+    nchunks = max(1, min(workers, ncouplings))
+    if nchunks == 1:
+        return kernel(dt, overlaps)
+    bounds = np.linspace(0, ncouplings, nchunks + 1).astype(int)
+    with ThreadPoolExecutor(nchunks) as executor:
+        chunks = executor.map(
+            lambda ij: kernel(dt, overlaps[ij[0]: ij[1] + step - 1]), zip(bounds[:-1], bounds[1:]))
+        return np.concatenate(list(chunks))
+
+
+def three_points_kernel(dt: float, overlaps: Tensor3D) -> Tensor3D:
+    """Compute :func:`calculate_couplings_3points` for all the consecutive pairs of overlaps."""
+    cte = 1.0 / (4.0 * dt)
+    sji_t0, sji_t1 = overlaps[:-1], overlaps[1:]
+    sij_t0, sij_t1 = sji_t0.swapaxes(1, 2), sji_t1.swapaxes(1, 2)
+    return cte * (3 * (sji_t1 - sij_t1) + (sij_t0 - sji_t0))
+
+
+def levine_kernel(dt: float, overlaps: Tensor3D) -> Tensor3D:
+    """Compute :func:`calculate_couplings_levine` for a stack of overlaps.
+
+    Outside the diagonal ``w_jj`` and ``w_kk`` are zero, so every term of
+    the coupling ``(j, k)`` depends either on ``S[j, k]`` or on ``S[k, j]``.
+    The transcendental functions are evaluated once per element, in place,
+    and the terms depending on ``S[k, j]`` are transposed.
+    """
+    overlaps = np.asarray(overlaps)
+    # arccos of the zeros outside the diagonal of w_jj
+    half_pi = np.arccos(np.zeros((), dtype=overlaps.dtype))
+
+    asin_w = np.arcsin(overlaps)
+    # Components A + B, the same functions give C + D for the transposed element
+    sinc_a = _sinc_over_pi(np.subtract(half_pi, asin_w))
+    sinc_b = _sinc_over_pi(np.add(half_pi, asin_w))
+    terms = np.negative(sinc_a)
+    terms += sinc_b
+    terms *= half_pi
+    sinc_a += sinc_b
+    sinc_a *= asin_w
+    terms += sinc_a.swapaxes(1, 2)
+
+    # Component E, w_lk is zero since w_jj is diagonal and w_jk has no diagonal
+    w_lj = np.square(overlaps, out=sinc_b)
+    np.subtract(1, w_lj, out=w_lj)
+    np.sqrt(w_lj, out=w_lj)
+    asin_w_lj2 = np.square(np.arcsin(w_lj, out=asin_w), out=asin_w)
+    # Like calculate_couplings_levine, E is computed in double precision
+    component_e = np.where(_is_close_to_zero(asin_w_lj2), np.square(w_lj), np.zeros(1))
+    terms = np.add(terms, component_e.swapaxes(1, 2),
+                   out=np.empty(terms.shape, dtype=component_e.dtype))
+
+    # On the diagonal w_jk and w_kj are zero
+    diagonal = np.diagonal(overlaps, axis1=1, axis2=2)
+    acos_w_jj = np.arccos(diagonal)
+    sinc_jj = np.sinc(acos_w_jj / np.pi)
+    w_lj = np.sqrt(1 - (diagonal ** 2))
+    zero = np.zeros((), dtype=overlaps.dtype)
+    diagonal_terms = acos_w_jj * (-sinc_jj + sinc_jj) + zero * (sinc_jj + sinc_jj)
+    diagonal_terms = diagonal_terms + np.where(
+        _is_close_to_zero(np.arcsin(w_lj) ** 2), w_lj ** 2, np.zeros(1))
+    rows = np.arange(overlaps.shape[1])
+    terms[:, rows, rows] = diagonal_terms
+
+    terms *= 1 / (2 * dt)
+    return terms
+
+
+def _is_close_to_zero(x: np.ndarray) -> np.ndarray:
+    """Compute ``np.isclose(x, 0)`` without its temporary arrays."""
+    return np.abs(x) <= 1e-8
+
+
+def _sinc_over_pi(x: np.ndarray) -> np.ndarray:
+    """Compute ``np.sinc(x / np.pi)`` in place."""
+    x /= np.pi
+    x[x == 0] = 1.0e-20
+    x *= np.pi
+    return np.divide(np.sin(x), x, out=x)
+
+
 def correct_phases(overlaps: Tensor3D, mtx_phases: Matrix) -> np.ndarray:
     """Correct the phases for all the overlaps."""
     noverlaps = overlaps.shape[0]  # total number of overlap matrices
@@ -178,6 +285,12 @@ def compute_overlaps_for_coupling(
         coefficients: Tuple[Matrix, Matrix]) -> Matrix:
     """Compute the Overlap matrices used to compute the couplings.
 
+    The overlap between the molecular orbitals is accumulated shell by shell
+    in the integrals library, therefore the atomic orbitals overlap matrix
+    is never stored. If ``config.overlap_reuse_tolerance`` is set, the atomic
+    orbitals overlap of the previous call is kept instead and only the blocks
+    of the atoms that moved more than the tolerance are recomputed.
+
     Parameters
     ---------
     config
@@ -193,26 +306,140 @@ def compute_overlaps_for_coupling(
         containing the overlaps at different times
 
     """
-    # Atomic orbitals overlap
-    suv = calcOverlapMtx(config, pair_molecules)
+    (coords_i, atomic_numbers), (coords_j, _) = tuple(
+        molecule_to_arrays(mol) for mol in pair_molecules)
 
     # Read Orbitals Coefficients
     css0, css1 = coefficients
 
+    session = get_integral_session(config)
+    tolerance = config.overlap_reuse_tolerance
+    with blas_threads(1):
+        if tolerance is None:
+            overlaps = session.cross_overlap_mo(
+                coords_i, coords_j, atomic_numbers, css0, css1, config.screening_threshold)
+        else:
+            suv = session.cross_overlap_incremental(
+                coords_i, coords_j, atomic_numbers, tolerance, config.screening_threshold)
+
+    log_integrals_stats(session)
+    if tolerance is None:
+        return overlaps
+
+    reused, total = session.reuse_stats()
+    if total:
+        logger.info(f"reused {reused / total:.1%} of the shell pairs of the previous overlap")
+
     return np.dot(css0.T, np.dot(suv, css1))
 
 
+def compute_overlaps_for_trajectory(
+        config: DictConfig,
+        molecules: List[MolXYZ],
+        pairs: List[Tuple[int, int]]) -> Tensor3D:
+    """Compute the atomic orbitals overlaps between several pairs of geometries.
+
+    All the overlaps are computed with a single call to the integrals library,
+    which distributes the work over both the pairs and the shell pairs.
+
+    Parameters
+    ---------
+    config
+        Configuration of the current task
+    molecules
+        Geometries of the trajectory
+    pairs
+        Indices of the geometries to compute the overlap
+
+    Returns
+    -------
+    Tensor3D
+        Atomic orbitals overlap for each pair
+
+    """
+    arrays = [molecule_to_arrays(mol) for mol in molecules]
+    coordinates = np.stack([xyz for xyz, _ in arrays])
+    atomic_numbers = arrays[0][1]
+
+    session = get_integral_session(config)
+    with blas_threads(1):
+        integrals = session.cross_overlaps(
+            coordinates, atomic_numbers, pairs, config.screening_threshold)
+
+    log_integrals_stats(session)
+
+    return integrals
+
+
+def compute_mo_overlaps_for_trajectory(
+        config: DictConfig,
+        molecules: List[MolXYZ],
+        pairs: List[Tuple[int, int]],
+        coefficients: Tuple[Tensor3D, Tensor3D]) -> Tensor3D:
+    """Compute the molecular orbitals overlaps between several pairs of geometries.
+
+    Like :func:`compute_overlaps_for_trajectory` but the overlaps are transformed
+    to the active space in the integrals library without storing the atomic
+    orbitals overlaps.
+
+    Parameters
+    ---------
+    config
+        Configuration of the current task
+    molecules
+        Geometries of the trajectory
+    pairs
+        Indices of the geometries to compute the overlap
+    coefficients
+        Active space coefficients of the left and right geometry of each pair
+
+    Returns
+    -------
+    Tensor3D
+        Molecular orbitals overlap for each pair
+
+    """
+    arrays = [molecule_to_arrays(mol) for mol in molecules]
+    coordinates = np.stack([xyz for xyz, _ in arrays])
+    atomic_numbers = arrays[0][1]
+    css0, css1 = coefficients
+
+    session = get_integral_session(config)
+    with blas_threads(1):
+        overlaps = session.cross_overlaps_mo(
+            coordinates, atomic_numbers, pairs, css0, css1, config.screening_threshold)
+
+    log_integrals_stats(session)
+
+    return overlaps
+
+
 def read_overlap_data(config: DictConfig, mo_paths: List[str]) -> Tuple[Matrix, Matrix]:
-    """Read the Molecular orbital coefficients."""
-    mos = retrieve_hdf5_data(config.path_hdf5, mo_paths)
+    """Read the Molecular orbital coefficients of the active space.
 
+    Only the columns of the active space are read from the HDF5.
+    """
     # Extract a subset of molecular orbitals to compute the coupling
     lowest, highest = compute_range_orbitals(config)
-    css0, css1 = tuple(map(lambda xs: xs[:, lowest: highest], mos))
+    with get_store(config.path_hdf5) as store:
+        css0, css1 = tuple(read_mo_window(store, path, lowest, highest) for path in mo_paths)
 
     return css0, css1
 
 
+def read_mo_window(store: HDF5Store, path: str, lowest: int, highest: int) -> Matrix:
+    """Read the columns ``lowest:highest`` of the MO coefficients stored in ``path``.
+
+    The coefficients may contain only a window of the orbitals, given by
+    their ``mo_window`` attribute.
+    """
+    start, stop = store.attributes(path).get("mo_window", (0, None))
+    if lowest < start or (stop is not None and highest > stop):
+        msg = f"The orbitals {lowest}:{highest} are not stored in {path}, only {start}:{stop}"
+        raise ValueError(msg)
+    return store.read_slice(path, np.s_[:, lowest - start: highest - start])
+
+
 def compute_range_orbitals(config: DictConfig) -> Tuple[int, int]:
     """Compute the lowest and highest index used to extract a subset of Columns from the MOs."""
     lowest = config.nHOMO - (config.mo_index_range[0] + config.active_space[0])
@@ -225,26 +452,18 @@ def calcOverlapMtx(config: DictConfig, molecules: Tuple[MolXYZ, MolXYZ]) -> Matr
     """Compute the overlap matrix between two geometries.
 
     The calculation of the overlap matrix uses the libint2 library
-    at two different geometries: R0 and R1.
+    at two different geometries: R0 and R1, which are passed in memory
+    to the integrals library. The shell pairs whose estimated
+    overlap is smaller than ``config.screening_threshold`` are skipped.
     """
-    mol_i, mol_j = tuple(tuplesXYZ_to_plams(x) for x in molecules)
-
-    # unique molecular paths
-    path_i = join(config["scratch_path"],
-                  f"molecule_{uuid.uuid4()}.xyz")
-    path_j = join(config["scratch_path"],
-                  "molecule_{uuid.uuid4()}.xyz")
-
-    # Write the molecules in atomic units
-    mol_i.write(path_i)
-    mol_j.write(path_j)
-
-    basis_name = config["cp2k_general_settings"]["basis"]
-    try:
-        integrals = compute_integrals_couplings(
-            path_i, path_j, config["path_hdf5"], basis_name)
-    finally:
-        os.remove(path_i)
-        os.remove(path_j)
+    (coords_i, atomic_numbers), (coords_j, _) = tuple(
+        molecule_to_arrays(mol) for mol in molecules)
+
+    session = get_integral_session(config)
+    with blas_threads(1):
+        integrals = session.cross_overlap(
+            coords_i, coords_j, atomic_numbers, config.screening_threshold)
+
+    log_integrals_stats(session)
 
     return integrals
@@ -0,0 +1,70 @@
+"""Persistent state of the `Libint2 <https://github.com/evaleev/libint/wiki>` integrals.
+
+Setting up the integrals requires reading the basis set of every element
+from the HDF5, initializing libint and building the integral engines. An
+:class:`IntegralSession` keeps that state alive, therefore the same session
+is shared by all the frames of a workflow.
+
+Index
+-----
+.. currentmodule:: nanoqm.integrals.session
+.. autosummary::
+    get_integral_session
+    log_integrals_stats
+
+API
+---
+.. autofunction:: get_integral_session
+.. autofunction:: log_integrals_stats
+
+"""
+__all__ = ['get_integral_session', 'log_integrals_stats']
+
+import logging
+from functools import lru_cache
+
+from compute_integrals import IntegralSession
+
+from ..common import DictConfig, path_to_posix
+from ..hdf5_store import get_store
+
+# Starting logger
+logger = logging.getLogger(__name__)
+
+
+def get_integral_session(config: DictConfig) -> IntegralSession:
+    """Return the integral session for the HDF5 and basis set of ``config``."""
+    return create_integral_session(
+        path_to_posix(config.path_hdf5), config.cp2k_general_settings["basis"],
+        config.num_threads or 0)
+
+
+@lru_cache(maxsize=None)
+def create_integral_session(
+        path_hdf5: str, basis_name: str, nthreads: int = 0) -> IntegralSession:
+    """Create a new session, which is reused for the lifetime of the process.
+
+    All the available cores are used if ``nthreads`` is zero.
+    """
+    # The integrals library reads the basis set from the HDF5 the first time the
+    # session is used, so the background writer must not be writing the file
+    get_store(path_hdf5).checkpoint()
+    session = IntegralSession(path_hdf5, basis_name, nthreads)
+    logger.info(f"integrals for basis {basis_name} stored in {path_hdf5} "
+                f"will use {session.nthreads} threads")
+    return session
+
+
+def log_integrals_stats(session: IntegralSession) -> None:
+    """Report the screening and the load balance of the last computation of ``session``.
+
+    The utilisation is the fraction of the time that the threads spent computing
+    integrals instead of waiting for the slowest thread.
+    """
+    skipped, total = session.screening_stats()
+    if skipped:
+        logger.info(f"screening skipped {skipped} out of {total} shell pairs")
+
+    utilisation, blocks, nthreads = session.load_balance()
+    logger.info(f"thread utilisation {utilisation:.1%} computing {blocks} blocks "
+                f"of shell pairs with {nthreads} threads")
@@ -23,8 +23,10 @@ from qmflows.common import InfoMO
 from qmflows.type_hints import PathLike, PromisedObject
 from qmflows.warnings_qmflows import SCF_Convergence_Warning
 
-from ..common import (DictConfig, Matrix, is_data_in_hdf5,
-                      read_cell_parameters_as_array, store_arrays_in_hdf5)
+from ..common import (DictConfig, Matrix, read_cell_parameters_as_array,
+                      store_arrays_in_hdf5)
+from ..hdf5_store import get_store
+from ..integrals.nonAdiabaticCoupling import compute_range_orbitals
 from .scheduleCP2K import prepare_job_cp2k
 
 # Starting logger
@@ -82,59 +84,62 @@ def calculate_mos(config: DictConfig) -> List[str]:
     # or alpha/beta for unrestricted calculations
     orbitals_type = config.orbitals_type
 
-    for j, gs in enumerate(config.geometries):
+    # Look for the points already computed in the index of the HDF5
+    with get_store(config.path_hdf5) as store:
+        for j, gs in enumerate(config.geometries):
 
-        # number of the point with respect to all the trajectory
-        k = j + config.enumerate_from
+            # number of the point with respect to all the trajectory
+            k = j + config.enumerate_from
 
-        # dictionary containing the information of the j-th job
-        dict_input = defaultdict(lambda: None)  # type:  DefaultDict[str, Any]
-        dict_input["geometry"] = gs
-        dict_input["k"] = k
+            # dictionary containing the information of the j-th job
+            dict_input = defaultdict(lambda: None)  # type:  DefaultDict[str, Any]
+            dict_input["geometry"] = gs
+            dict_input["k"] = k
 
-        # Path where the MOs will be store in the HDF5
-        dict_input["node_MOs"] = [
-            join(orbitals_type, "eigenvalues", f"point_{k}"),
-            join(orbitals_type, "coefficients", f"point_{k}")]
+            # Path where the MOs will be store in the HDF5
+            dict_input["node_MOs"] = [
+                join(orbitals_type, "eigenvalues", f"point_{k}"),
+                join(orbitals_type, "coefficients", f"point_{k}")]
 
-        dict_input["node_energy"] = join(orbitals_type, "energy", f"point_{k}")
+            dict_input["node_energy"] = join(orbitals_type, "energy", f"point_{k}")
 
-        # If the MOs are already store in the HDF5 format return the path
-        # to them and skip the calculation
-        if config["compute_orbitals"]:
-            predicate = dict_input["node_MOs"]
-        else:
-            predicate = dict_input["node_energy"]
-        
-        if is_data_in_hdf5(config.path_hdf5, predicate):
-            logger.info(f"point_{k} has already been calculated")
-            orbitals.append(dict_input["node_MOs"])
-        else:
-            logger.info(f"point_{k} has been scheduled")
+            # If the MOs are already store in the HDF5 format return the path
+            # to them and skip the calculation
+            stages: Tuple[str, ...]
+            if config["compute_orbitals"]:
+                stages = ("eigenvalues", "coefficients")
+            else:
+                stages = ("energy",)
+
+            if all(store.is_completed(stage, k, orbitals_type) for stage in stages):
+                logger.info(f"point_{k} has already been calculated")
+                orbitals.append(dict_input["node_MOs"])
+            else:
+                logger.info(f"point_{k} has been scheduled")
 
-            # Add cell parameters from file if given
-            if file_cell_parameters is not None:
-                adjust_cell_parameters(general, array_cell_parameters, j)
-            # Path to I/O files
-            dict_input["point_dir"] = config.folders[j]
-            dict_input["job_files"] = create_file_names(
-                dict_input["point_dir"], k)
-            dict_input["job_name"] = f'point_{k}'
+                # Add cell parameters from file if given
+                if file_cell_parameters is not None:
+                    adjust_cell_parameters(general, array_cell_parameters, j)
+                # Path to I/O files
+                dict_input["point_dir"] = config.folders[j]
+                dict_input["job_files"] = create_file_names(
+                    dict_input["point_dir"], k)
+                dict_input["job_name"] = f'point_{k}'
 
-            # Compute the MOs and return a new guess
-            promise_qm = compute_orbitals(config, dict_input, guess_job)
+                # Compute the MOs and return a new guess
+                promise_qm = compute_orbitals(config, dict_input, guess_job)
 
-            # Check if the job finishes succesfully
-            promise_qm = schedule_check(promise_qm, config, dict_input)
+                # Check if the job finishes succesfully
+                promise_qm = schedule_check(promise_qm, config, dict_input)
 
-            # Store the computation
-            if config["compute_orbitals"]:
-                orbitals.append(store_molecular_orbitals(config, dict_input, promise_qm))
-            else:
-                orbitals.append(None)
-            energies.append(store_enery(config, dict_input, promise_qm))
+                # Store the computation
+                if config["compute_orbitals"]:
+                    orbitals.append(store_molecular_orbitals(config, dict_input, promise_qm))
+                else:
+                    orbitals.append(None)
+                energies.append(store_enery(config, dict_input, promise_qm))
 
-            guess_job = promise_qm
+                guess_job = promise_qm
 
     return gather(gather(*orbitals), gather(*energies))
 
@@ -168,12 +173,13 @@ def store_molecular_orbitals(
 
 def save_orbitals_in_hdf5(mos: OrbitalType, config: DictConfig, job_name: str) -> None:
     """Store the orbitals from restricted and unrestricted calculations."""
-    if isinstance(mos, InfoMO):
-        dump_orbitals_to_hdf5(mos, config, job_name)
-    else:
-        alphas, betas = mos  # type: Tuple[InfoMO, InfoMO]
-        dump_orbitals_to_hdf5(alphas, config, job_name, "alphas")
-        dump_orbitals_to_hdf5(betas, config, job_name, "betas")
+    with get_store(config.path_hdf5):
+        if isinstance(mos, InfoMO):
+            dump_orbitals_to_hdf5(mos, config, job_name)
+        else:
+            alphas, betas = mos  # type: Tuple[InfoMO, InfoMO]
+            dump_orbitals_to_hdf5(alphas, config, job_name, "alphas")
+            dump_orbitals_to_hdf5(betas, config, job_name, "betas")
 
 
 def dump_orbitals_to_hdf5(
@@ -192,9 +198,17 @@ def dump_orbitals_to_hdf5(
         Either an empty string for MO coming from a restricted job or alpha/beta
         for unrestricted MO calculation
     """
-    for name, array in zip(("eigenvalues", "coefficients"), (data.eigenvalues, data.eigenvectors)):
-        path_property = join(orbitals_type, name, job_name)
-        store_arrays_in_hdf5(config.path_hdf5, path_property, array)
+    path_eigenvalues, path_coefficients = (
+        join(orbitals_type, name, job_name) for name in ("eigenvalues", "coefficients"))
+    store_arrays_in_hdf5(config.path_hdf5, path_eigenvalues, data.eigenvalues)
+
+    # Keep only the coefficients of the orbitals used by the workflow
+    coefficients, attrs = data.eigenvectors, {}
+    if config.store_active_space:
+        lowest, highest = compute_range_orbitals(config)
+        coefficients = coefficients[:, lowest: highest]
+        attrs = {"mo_window": (lowest, highest)}
+    get_store(config.path_hdf5).write(path_coefficients, coefficients, attrs=attrs)
 
 
 @schedule
@@ -21,33 +21,45 @@ API
 import logging
 import os
 from os.path import join
+from itertools import tee
 # Types hint
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 from noodles import schedule
+from scipy import sparse
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
 from qmflows.parsers import parse_string_xyz
 
-from ..common import (DictConfig, Matrix, MolXYZ, Tensor3D, Vector, hbar,
+from ..common import (DictConfig, Matrix, Tensor3D, Vector, hbar,
                       femtosec2au, h2ev, is_data_in_hdf5, retrieve_hdf5_data,
                       store_arrays_in_hdf5)
-from ..integrals import (calculate_couplings_3points,
-                         calculate_couplings_levine,
-                         compute_overlaps_for_coupling, correct_phases)
+from ..hdf5_store import HDF5Store, frame_path, get_store
+from ..integrals import (calculate_couplings_batch,
+                         compute_mo_overlaps_for_trajectory,
+                         compute_overlaps_for_coupling)
 from ..integrals.nonAdiabaticCoupling import (compute_range_orbitals,
                                               read_overlap_data)
+from ..integrals.session import get_integral_session
 
 # Starting logger
 logger = logging.getLogger(__name__)
 
 __all__ = ["calculate_overlap", "lazy_couplings", "write_hamiltonians"]
 
+#: Largest fraction of the orbitals in a group of :func:`assign_block`
+#: before solving a single assignment problem for all of them
+DENSE_ASSIGNMENT_FRACTION = 0.5
+
+#: Number of consecutive overlaps used by each coupling algorithm
+COUPLING_STEPS = {'levine': 1, '3points': 2}
+
 
 @schedule
 def lazy_couplings(
         config: DictConfig,
-        paths_overlaps: List[str]) -> Tuple[np.ndarray, List[np.ndarray]]:
+        paths_overlaps: List[str]) -> Tuple[np.ndarray, List[str]]:
     """Compute the Nonadibatic coupling.
 
     The coupling is computed sing a either 3-point approximation. See:
@@ -60,6 +72,11 @@ def lazy_couplings(
     such crossing must be track. see:
     J. Chem. Phys. 137, 014512 (2012); doi: 10.1063/1.4732536
 
+    The overlaps flow through the tracking, the phase correction and the
+    couplings one frame at a time, reading ``config.overlaps_window`` overlaps
+    at once from the HDF5, so the memory does not grow with the trajectory.
+    The couplings of each window of overlaps are computed together.
+
     Parameters
     ----------
     config:
@@ -70,144 +87,293 @@ def lazy_couplings(
     Returns
     -------
     Tuple
-        with the swaps and couplings in each point.
+        with the swaps and the paths to the couplings in each point.
 
     """
-    if config.tracking:
-        fixed_phase_overlaps, swaps = compute_the_fixed_phase_overlaps(
-            paths_overlaps, config)
-    else:
-        # Do not track the crossings
-        mtx_0 = retrieve_hdf5_data(config.path_hdf5, paths_overlaps[0])
-        _, dim = mtx_0.shape
-        overlaps = np.stack(
-            retrieve_hdf5_data(config.path_hdf5, paths_overlaps))
-        nOverlaps, nOrbitals, _ = overlaps.shape
-        swaps = np.tile(np.arange(nOrbitals), (nOverlaps + 1, 1))
-        mtx_phases = compute_phases(overlaps, nOverlaps, dim)
-        fixed_phase_overlaps = correct_phases(overlaps, mtx_phases)
-
-    # Write the overlaps in text format
-    if config.write_overlaps:
-        logger.debug("Writing down the overlaps in ascii format")
-        write_overlaps_in_ascii(fixed_phase_overlaps)
-
-    # Compute the couplings using either the levine method
-    # or the 3Points approximation
-    coupling_algorithms = {'levine': (calculate_couplings_levine, 1),
-                           '3points': (calculate_couplings_3points, 2)}
-    # Choose an algorithm to compute the couplings
-    fun_coupling, step = coupling_algorithms[config["algorithm"]]
-    config["fun_coupling"] = fun_coupling
+    # Number of consecutive overlaps used by each coupling
+    step = COUPLING_STEPS[config.algorithm]
 
-    # Number of couplings to compute
-    nCouplings = fixed_phase_overlaps.shape[0] - step + 1
-    couplings = [calculate_couplings(config, i, fixed_phase_overlaps)
-                 for i in range(nCouplings)]
-
-    return swaps, couplings
+    # Keep the HDF5 open while the overlaps are read and the couplings stored
+    with get_store(config.path_hdf5) as store:
+        if config.tracking:
+            fixed_phase_overlaps = compute_the_fixed_phase_overlaps(paths_overlaps, config)
+        else:
+            # Do not track the crossings
+            overlaps = read_frames_in_windows(
+                store, "overlaps", overlap_frames(config, len(paths_overlaps)),
+                config.orbitals_type, config.overlaps_window)
+            fixed_phase_overlaps = (
+                (mtx, np.arange(len(mtx)), False) for mtx, _ in fix_phases(overlaps))
+
+        # The couplings of a window of overlaps are computed together
+        batch: List[Matrix] = []
+        # The couplings using a replaced overlap are computed again
+        replaced: List[bool] = []
+        swaps: List[Vector] = []
+        couplings: List[str] = []
+        for k, (mtx, swaps_k, replaced_k) in enumerate(fixed_phase_overlaps):
+            # Write the overlaps in text format
+            if config.write_overlaps:
+                write_overlap_in_ascii(k, mtx)
+            swaps.append(swaps_k)
+            batch.append(mtx)
+            replaced.append(replaced_k)
+            if len(batch) == config.overlaps_window + step - 1:
+                couplings.extend(calculate_couplings(config, len(couplings), batch, any(replaced)))
+                # The last overlaps are shared with the next couplings
+                batch = batch[len(batch) - step + 1:]
+                replaced = replaced[len(replaced) - step + 1:]
+        if len(batch) >= step:
+            couplings.extend(calculate_couplings(config, len(couplings), batch, any(replaced)))
+
+        # The states are not swapped in the first frame
+        swaps.insert(0, np.arange(len(swaps[0])))
+        all_swaps = np.stack(swaps)
+        if config.tracking:
+            # Store the swaps tracking the crossings of the whole trajectory
+            store.write(join(config.orbitals_type, 'swaps'), all_swaps, dtype=np.int32,
+                        overwrite=True)
+
+    return all_swaps, couplings
 
 
 def compute_the_fixed_phase_overlaps(
-        paths_overlaps: List[str], config: DictConfig) -> Tuple[np.ndarray, np.ndarray]:
+        paths_overlaps: List[str], config: DictConfig) -> Iterator[Tuple[Matrix, Vector, bool]]:
     """Fix the phase of the overlaps.
 
     First track the unavoided crossings between Molecular orbitals and
-    finally correct the phase for the whole trajectory.
+    finally correct the phase, one frame at a time.
+
+    The accumulated swaps and the phases after each frame are stored in the
+    HDF5, so the tracking continues from the last tracked frame when the
+    workflow is restarted or the trajectory is extended. The state of the
+    last frame is not stored, since its columns are not swapped. That frame is
+    tracked again by the next run and its corrected overlap is replaced.
+
+    Yields
+    ------
+    tuple
+        The overlap with the fixed phases, the accumulated swaps at time t + dt
+        and whether the overlap replaces the one stored by a previous run
+
     """
     number_of_frames = len(paths_overlaps)
-    # Pasth to the overlap matrices after the tracking
-    # and phase correction
-    roots = [join(config.orbitals_type, f'overlaps_{i}')
-             for i in range(config.enumerate_from, number_of_frames + config.enumerate_from)]
-    paths_corrected_overlaps = [join(r, 'mtx_sji_t0_corrected') for r in roots]
-    # Paths inside the HDF5 to the array containing the tracking of the
-    # unavoided crossings
-    path_swaps = join(config.orbitals_type, 'swaps')
-
-    # Compute the corrected overlaps if not avaialable in the HDF5
-    all_data_in_hdf5 = all(is_data_in_hdf5(config.path_hdf5, path_data)
-                           for path_data in (paths_corrected_overlaps[0], path_swaps))
-    if not all_data_in_hdf5:
-        # Compute the dimension of the coupling matrix
-        mtx_0 = retrieve_hdf5_data(config.path_hdf5, paths_overlaps[0])
-        _, dim = mtx_0.shape
-
-        # Read all the Overlaps
-        overlaps = np.stack([retrieve_hdf5_data(config.path_hdf5, ps)
-                             for ps in paths_overlaps])
-
-        # Number of couplings to compute
-        nCouplings = overlaps.shape[0]
-
-        # Compute the unavoided crossing using the Overlap matrix
-        # and correct the swaps between Molecular Orbitals
-        logger.debug("Computing the Unavoided crossings, "
-                     "Tracking the crossings between MOs")
-        overlaps, swaps = track_unavoided_crossings(overlaps, config.nHOMO)
-
-        # Compute all the phases taking into account the unavoided crossings
-        logger.debug("Computing the phases of the MOs")
-        mtx_phases = compute_phases(overlaps, nCouplings, dim)
-
-        # Fixed the phases of the whole set of overlap matrices
-        fixed_phase_overlaps = correct_phases(overlaps, mtx_phases)
-
+    store = get_store(config.path_hdf5)
+    frames = overlap_frames(config, number_of_frames)
+    prefix = config.orbitals_type
+
+    # Files created before the tracking state was stored
+    path_swaps = join(prefix, 'swaps')
+    path_corrected = frame_path("corrected_overlaps", frames[0], prefix)
+    tracked = store.completed("tracking", frames[-1] + 1, prefix)[frames]
+    if not tracked[0] and all(
+            is_data_in_hdf5(config.path_hdf5, path) for path in (path_corrected, path_swaps)):
+        swaps = retrieve_hdf5_data(config.path_hdf5, path_swaps)
+        # The overlaps of a shorter trajectory are tracked again
+        if len(swaps) == number_of_frames + 1:
+            # Read the corrected overlaps and the swaps from the HDF5
+            corrected = read_frames_in_windows(
+                store, "corrected_overlaps", frames, prefix, config.overlaps_window)
+            for mtx, swaps_k in zip(corrected, swaps[1:]):
+                yield mtx, swaps_k, False
+            return
+
+    # Frames tracked by a previous run
+    start = len(frames) if tracked.all() else int(np.argmin(tracked))
+    permutation: Optional[Vector] = None
+    references: Optional[Vector] = None
+    if start > 0:
+        logger.info(f"The crossings of the first {start} frames have already been tracked")
+        stored = read_frames_in_windows(
+            store, "corrected_overlaps", frames[:start], prefix, config.overlaps_window)
+        states = read_frames_in_windows(
+            store, "tracking", frames[:start], prefix, config.overlaps_window)
+        for mtx, (permutation, references) in zip(stored, states):
+            yield mtx, permutation, False
+
+    # Compute the unavoided crossing using the Overlap matrix
+    # and correct the swaps between Molecular Orbitals
+    logger.debug("Computing the Unavoided crossings, "
+                 "Tracking the crossings between MOs")
+    overlaps = read_frames_in_windows(
+        store, "overlaps", frames[start:], prefix, config.overlaps_window)
+    # Corrected overlaps stored by a previous run that are tracked again
+    stored_overlaps = store.completed("corrected_overlaps", frames[-1] + 1, prefix)[frames]
+    # Both copies of the iterator advance together, so a single frame is buffered
+    tracked_overlaps, tracked_swaps = tee(track_crossings(
+        overlaps, config.nHOMO, permutation, config.tracking_threshold))
+
+    # Compute all the phases taking into account the unavoided crossings
+    logger.debug("Computing the phases of the MOs")
+    fixed_phase_overlaps = fix_phases((mtx for mtx, _ in tracked_overlaps), references)
+    for frame, replaced, (mtx, phases), (_, swaps_k) in zip(
+            frames[start:], stored_overlaps[start:], fixed_phase_overlaps, tracked_swaps):
         # Store corrected overlaps in the HDF5
-        store_arrays_in_hdf5(config.path_hdf5, paths_corrected_overlaps,
-                             fixed_phase_overlaps)
+        store.write(frame_path("corrected_overlaps", frame, prefix), mtx, overwrite=replaced)
+        if frame != frames[-1]:
+            # Store the state of the tracking after this frame
+            state = np.stack((swaps_k, phases))
+            store.write(frame_path("tracking", frame, prefix), state, dtype=np.int32)
+        yield mtx, swaps_k, bool(replaced)
 
-        # Store the Swaps tracking the crossing
-        store_arrays_in_hdf5(config.path_hdf5, path_swaps, swaps, dtype=np.int32)
-    else:
-        # Read the corrected overlaps and the swaps from the HDF5
-        fixed_phase_overlaps = np.stack(
-            retrieve_hdf5_data(config.path_hdf5, paths_corrected_overlaps))
-        swaps = retrieve_hdf5_data(config.path_hdf5, path_swaps)
 
-    return fixed_phase_overlaps, swaps
+def read_frames_in_windows(
+        store: HDF5Store, stage: str, frames: Sequence[int], prefix: str,
+        window: int) -> Iterator[Matrix]:
+    """Yield the arrays of ``stage`` for ``frames``, reading ``window`` frames at once."""
+    for start in range(0, len(frames), window):
+        yield from store.read_frames(stage, frames[start: start + window], prefix)
 
 
-def calculate_couplings(config: DictConfig, i: int, fixed_phase_overlaps: Tensor3D) -> str:
-    """Compute couplings for the i-th geometry.
+def track_crossings(
+        overlaps: Iterable[Matrix], nHOMO: int, permutation: Optional[Vector] = None,
+        threshold: Optional[float] = None) -> Iterator[Tuple[Matrix, Vector]]:
+    """Track the index of the states if there is a crossing, one overlap at a time.
 
-    Search for the ith Coupling in the HDF5, if it is not available compute it
-    using the 3 points approximation and store it in the HDF5.
+    It uses the algorithm  described at:
+    J. Chem. Phys. 137, 014512 (2012); doi: 10.1063/1.4732536.
+
+    The swaps found up to time t are accumulated in a single permutation,
+    which is applied to the overlap at time t when it is consumed. The columns
+    of each overlap, except the last one, are also swapped with the
+    permutation at time t + dt. The tracking starts from the accumulated
+    ``permutation`` of a previous frame, if given. See :func:`assign_block`
+    for the meaning of ``threshold``.
+
+    Yields
+    ------
+    tuple
+        The tracked overlap and the accumulated swaps at time t + dt
+
+    """
+    overlaps = iter(overlaps)
+    current = next(overlaps, None)
+    k = 0
+    while current is not None:
+        # The last overlap is not swapped with the permutation at t + dt
+        following = next(overlaps, None)
+        if permutation is None:
+            permutation = np.arange(len(current))
+        logger.info(f"Tracking crossings at time: {k}")
+        tracked = current[permutation][:, permutation]
+        total_swaps = assign_orbitals(tracked, nHOMO, threshold)
+        if following is not None:
+            tracked = swap_columns(tracked, total_swaps)
+        permutation = permutation[total_swaps]
+        yield tracked, permutation
+        current = following
+        k += 1
+
+
+def assign_orbitals(overlap: Matrix, nHOMO: int, threshold: Optional[float] = None) -> Vector:
+    """Compute the swaps at time t + dt for the HOMOs and LUMOs, that maximize the overlap.
+
+    See :func:`assign_block` for the meaning of ``threshold``.
+    """
+    # Notice that the cost is compute on half of the overlap matrices
+    # correspoding to Sji_t, the other half corresponds to Sij_t
+    swaps_homos = assign_block(overlap[:nHOMO, :nHOMO], threshold)
+    swaps_lumos = assign_block(overlap[nHOMO:, nHOMO:], threshold)
+    return np.concatenate((swaps_homos, swaps_lumos + nHOMO))
+
+
+def assign_block(overlap: Matrix, threshold: Optional[float] = None) -> Vector:
+    """Solve the assignment of the orbitals in ``overlap`` maximizing the squared overlaps.
+
+    If ``threshold`` is given, an orbital can only be swapped with the orbitals
+    whose overlap is larger than ``threshold`` in absolute value. The orbitals
+    connected by these pairs form independent groups, and a small assignment
+    problem is solved for each group. If the largest group contains more than
+    half of the orbitals, a single problem is solved for all of them.
+    """
+    cost = np.negative(overlap ** 2)
+    if threshold is None or len(cost) == 0:
+        return linear_sum_assignment(cost)[1]
+
+    # An orbital can always keep its index
+    candidates = (np.abs(overlap) > threshold) | np.eye(len(cost), dtype=bool)
+    ncomponents, labels = connected_components(
+        sparse.csr_matrix(candidates), directed=False)
+    sizes = np.bincount(labels)
+    logger.debug(f"The assignment of {len(cost)} orbitals is split in {ncomponents} problems, "
+                 f"the largest with {sizes.max()} orbitals")
+    if sizes.max() > DENSE_ASSIGNMENT_FRACTION * len(cost):
+        logger.debug("The assignment is solved for all the orbitals")
+        return linear_sum_assignment(cost)[1]
+
+    # The orbitals alone in their group keep their index
+    swaps = np.arange(len(cost))
+    for label in np.flatnonzero(sizes > 1):
+        orbitals = np.flatnonzero(labels == label)
+        swaps[orbitals] = orbitals[linear_sum_assignment(cost[np.ix_(orbitals, orbitals)])[1]]
+    return swaps
+
+
+def fix_phases(
+        overlaps: Iterable[Matrix],
+        references: Optional[Vector] = None) -> Iterator[Tuple[Matrix, Vector]]:
+    """Correct the phases of the overlaps one at a time, see :func:`compute_phases`.
+
+    The overlaps are modified in place. The phases start from the
+    ``references`` of a previous frame, if given.
+
+    Yields
+    ------
+    tuple
+        The overlap with the fixed phases and the phases at time t + dt
+
+    """
+    for mtx in overlaps:
+        if references is None:
+            references = np.ones(len(mtx))
+        # Compute the phase at time t + dt
+        phases = np.sign(np.diag(mtx)) * references
+        mtx *= np.outer(references, phases)
+        references = phases
+        yield mtx, phases
+
+
+def calculate_couplings(
+        config: DictConfig, i: int, overlaps: Sequence[Matrix],
+        overwrite: bool = False) -> List[str]:
+    """Compute couplings starting at the i-th geometry.
+
+    Search for the couplings in the HDF5, if some of them are not available
+    compute all the couplings of the phase corrected ``overlaps`` together,
+    using ``config.num_threads`` threads. If ``overwrite`` is True the
+    couplings are computed again and replace the stored ones.
 
     Returns
     -------
-    str
-        Path to the couplings store in the HDF5 file.
+    list
+        Paths to the couplings store in the HDF5 file.
 
     """
     # time in atomic units
     dt_au = config.dt * femtosec2au
 
-    # Path were the couplinp is store
-    k = i + config.enumerate_from
-    path = join(config.orbitals_type, f'coupling_{k}')
+    # Path were the couplings are store
+    ncouplings = len(overlaps) - COUPLING_STEPS[config.algorithm] + 1
+    indices = [i + k + config.enumerate_from for k in range(ncouplings)]
+    paths = [join(config.orbitals_type, f'coupling_{k}') for k in indices]
 
-    # Skip the computation if the coupling is already done
-    if is_data_in_hdf5(config.path_hdf5, path):
-        logger.info(f"Coupling: {path} has already been calculated")
-        return path
-    else:
-        logger.info(f"Computing coupling: {path}")
-        if config.algorithm == 'levine':
-            # Extract the overlap matrices involved in the coupling computation
-            sji_t0 = fixed_phase_overlaps[i]
-            # Compute the couplings with the phase corrected overlaps
-            couplings = config["fun_coupling"](
-                dt_au, sji_t0, sji_t0.transpose())
-        elif config.algorithm == '3points':
-            sji_t0, sji_t1 = fixed_phase_overlaps[i: i + 2]
-            couplings = config["fun_coupling"](dt_au, sji_t0, sji_t0.transpose(), sji_t1,
-                                               sji_t1.transpose())
+    # Skip the computation if the couplings are already done
+    store = get_store(config.path_hdf5)
+    if not overwrite and all(
+            store.is_completed("couplings", k, config.orbitals_type) for k in indices):
+        logger.info(f"Couplings: {paths[0]} to {paths[-1]} have already been calculated")
+        return paths
 
-            # Store the Coupling in the HDF5
-        store_arrays_in_hdf5(config.path_hdf5, path, couplings)
+    logger.info(f"Computing couplings: {paths[0]} to {paths[-1]}")
+    couplings = calculate_couplings_batch(
+        dt_au, np.stack(overlaps), config.algorithm, config.num_threads or os.cpu_count() or 1)
 
-        return path
+    # Store the Couplings in the HDF5
+    with store:
+        for path, mtx in zip(paths, couplings):
+            store.write(path, mtx, overwrite=overwrite)
+
+    return paths
 
 
 def compute_phases(overlaps: Tensor3D, nCouplings: int,
@@ -241,77 +407,31 @@ def compute_phases(overlaps: Tensor3D, nCouplings: int,
 
 
 def track_unavoided_crossings(
-        overlaps: Tensor3D, nHOMO: int) -> Tuple[List[Matrix], np.ndarray]:
+        overlaps: Tensor3D, nHOMO: int,
+        threshold: Optional[float] = None) -> Tuple[Tensor3D, np.ndarray]:
     """Track the index of the states if there is a crossing.
 
     It uses the algorithm  described at:
     J. Chem. Phys. 137, 014512 (2012); doi: 10.1063/1.4732536.
 
+    The swaps are accumulated in a single permutation that is applied to each
+    overlap when it is tracked, see :func:`track_crossings`, therefore the cost
+    grows linearly with the number of overlaps. The overlaps are modified in place.
+    See :func:`assign_block` for the meaning of ``threshold``.
+
     Returns
     -------
     tuple
         containing the corrected overlaps and the crossings
 
     """
-    # 3D array containing the costs
-    # Notice that the cost is compute on half of the overlap matrices
-    # correspoding to Sji_t, the other half corresponds to Sij_t
-    nOverlaps, nOrbitals, _ = overlaps.shape
-
     # Indexes taking into account the crossing
-    # There are 2 Overlap matrices at each time t
-    indexes = np.empty((nOverlaps + 1, nOrbitals), dtype=np.int)
-    indexes[0] = np.arange(nOrbitals, dtype=np.int)
-
-    # Track the crossing using the overlap matrices
-
-    for k in range(nOverlaps):
-        # Cost matrix to track the corssings
-        logger.info(f"Tracking crossings at time: {k}")
-        cost_mtx_homos = np.negative(overlaps[k, :nHOMO, :nHOMO] ** 2)
-        cost_mtx_lumos = np.negative(overlaps[k, nHOMO:, nHOMO:] ** 2)
-
-        # Compute the swap at time t + dt using two set of Orbitals:
-        # HOMOs and LUMOS
-        swaps_homos = linear_sum_assignment(cost_mtx_homos)[1]
-        swaps_lumos = linear_sum_assignment(cost_mtx_lumos)[1]
-        total_swaps = np.concatenate((swaps_homos, swaps_lumos + nHOMO))
-        indexes[k + 1] = total_swaps
-
-        # update the overlaps at times > t with the previous swaps
-        if k != (nOverlaps - 1):  # last element
-            k1 = k + 1
-            # Update the matrix Sji at time t
-            overlaps[k] = swap_columns(overlaps[k], total_swaps)
-            # Update all the matrices Sji at time > t
-            overlaps[k1:] = swap_forward(overlaps[k1:], total_swaps)
-    # Accumulate the swaps
-    acc = indexes[0]
-    arr = np.empty(indexes.shape, dtype=np.int)
-    arr[0] = acc
-
-    # Fold accumulating the crossings
-    for i in range(nOverlaps):
-        acc = acc[indexes[i + 1]]
-        arr[i + 1] = acc
-
-    return overlaps, arr
-
-
-def swap_forward(overlaps: Tensor3D, swaps: np.ndarray) -> List[Matrix]:
-    """Track all the crossings that happend previous to the current time.
-
-    Swap the index i corresponding to the ith Molecular orbital
-    with the corresponding swap at time t0.
-    Repeat the same procedure with the index and swap at time t1.
-    The swaps are compute with the linear sum assignment algorithm from Scipy.
-    https://docs.scipy.org/doc/scipy-0.18.1/reference/generated/scipy.optimize.linear_sum_assignment.html
-
-    """
-    for i, mtx in enumerate(np.rollaxis(overlaps, 0)):
-        overlaps[i] = mtx[:, swaps][swaps]
+    swaps = [np.arange(overlaps.shape[1])]
+    for k, (mtx, swaps_k) in enumerate(track_crossings(overlaps, nHOMO, threshold=threshold)):
+        overlaps[k] = mtx
+        swaps.append(swaps_k)
 
-    return overlaps
+    return overlaps, np.stack(swaps)
 
 
 @schedule
@@ -332,48 +452,79 @@ def calculate_overlap(config: DictConfig, mo_paths_hdf5: List[str]) -> List[str]
     # Number of couplings to compute
     npoints = len(config.geometries) - 1
     # Check what are the missing Couplings
-    all_overlaps_paths = [create_overlap_path(
-        config, i) for i in range(npoints)]
-    overlap_is_done = [check_if_overlap_is_done(
-        config, p) for p in all_overlaps_paths]
-
-    paths = []
-    for i in range(npoints):
-        if overlap_is_done[i]:
-            p = all_overlaps_paths[i]
-        else:
-            p = single_machine_overlaps(config, mo_paths_hdf5, i)
-        paths.append(p)
-
-    return paths
+    # Keep the HDF5 open while the overlaps are checked and stored
+    with get_store(config.path_hdf5):
+        all_overlaps_paths = [create_overlap_path(
+            config, i) for i in range(npoints)]
+        overlap_is_done = [check_if_overlap_is_done(
+            config, i) for i in range(npoints)]
+
+        missing = [i for i in range(npoints) if not overlap_is_done[i]]
+
+        # Compute the missing overlaps in batches, one native call per batch.
+        # The incremental overlaps reuse the previous frame, so they go one by one
+        incremental = config.overlap_reuse_tolerance is not None
+        batch_size = 1 if incremental else config.overlaps_batch_size
+        try:
+            for k in range(0, len(missing), batch_size):
+                single_machine_overlaps(config, mo_paths_hdf5, missing[k: k + batch_size])
+        finally:
+            # The overlap kept for the incremental overlaps is only valid in this run
+            if incremental and missing:
+                get_integral_session(config).reset_incremental()
+
+    return all_overlaps_paths
 
 
 def single_machine_overlaps(
-        config: DictConfig, mo_paths_hdf5: List[str], i: int) -> str:
+        config: DictConfig, mo_paths_hdf5: List[str], indices: List[int]) -> List[str]:
     """Compute the overlaps in the CPUs avaialable on the local machine.
 
+    The overlaps of all the `indices` are computed together in a single call
+    to the integrals library.
+
     Returns
     -------
-    str
-        Node path to the overlaps store in the HDF5
+    list
+        Node paths to the overlaps store in the HDF5
 
     """
-    # Data to compute the overlaps
-    pair_molecules = select_molecules(config, i)
-    mo_paths = [mo_paths_hdf5[i + j][1] for j in range(2)]
-    coefficients = read_overlap_data(config, mo_paths)
+    # Geometries required by the overlaps
+    pairs = [select_frames(config, i) for i in indices]
+    frames = sorted({idx for pair in pairs for idx in pair})
+    position = {idx: k for k, idx in enumerate(frames)}
+    molecules = [parse_string_xyz(config.geometries[idx]) for idx in frames]
+
+    # Active space coefficients of each pair
+    coefficients = [read_overlap_data(config, [mo_paths_hdf5[i + j][1] for j in range(2)])
+                    for i in indices]
+
+    # Molecular orbitals overlaps
+    overlaps: Iterable[Matrix]
+    if config.overlap_reuse_tolerance is not None:
+        overlaps = [compute_overlaps_for_coupling(
+            config, (molecules[position[j]], molecules[position[k]]), css)
+            for (j, k), css in zip(pairs, coefficients)]
+    else:
+        css0, css1 = tuple(np.stack(css) for css in zip(*coefficients))
+        overlaps = compute_mo_overlaps_for_trajectory(
+            config, molecules, [(position[j], position[k]) for j, k in pairs], (css0, css1))
 
-    # Compute the overlap
-    overlaps = compute_overlaps_for_coupling(
-        config, pair_molecules, coefficients)
+    paths = []
+    for i, mtx in zip(indices, overlaps):
+        logger.info(f"overlap for point {i} was sucessfully computed!")
 
-    logger.info(f"overlap for point {i} was sucessfully computed!")
+        # Store the array in the HDF5
+        overlaps_paths_hdf5 = create_overlap_path(config, i)
+        store_arrays_in_hdf5(config.path_hdf5, overlaps_paths_hdf5, mtx)
+        paths.append(overlaps_paths_hdf5)
+
+    return paths
 
-    # Store the array in the HDF5
-    overlaps_paths_hdf5 = create_overlap_path(config, i)
-    store_arrays_in_hdf5(config.path_hdf5, overlaps_paths_hdf5, overlaps)
 
-    return overlaps_paths_hdf5
+def overlap_frames(config: DictConfig, number_of_frames: int) -> List[int]:
+    """Frames of the first ``number_of_frames`` overlaps of the trajectory."""
+    return list(range(config.enumerate_from, config.enumerate_from + number_of_frames))
 
 
 def create_overlap_path(config: DictConfig, i: int) -> str:
@@ -383,15 +534,17 @@ def create_overlap_path(config: DictConfig, i: int) -> str:
     return join(root, 'mtx_sji_t0')
 
 
-def select_molecules(config: DictConfig, i: int) -> Tuple[MolXYZ, MolXYZ]:
-    """Select the pairs of molecules to compute the couplings."""
+def select_frames(config: DictConfig, i: int) -> Tuple[int, int]:
+    """Select the indices of the pair of geometries to compute the couplings."""
     k = 0 if config.overlaps_deph else i
-    return tuple(parse_string_xyz(config.geometries[idx]) for idx in (k, i + 1))
+    return k, i + 1
 
 
-def check_if_overlap_is_done(config: DictConfig, overlaps_paths_hdf5: str) -> bool:
-    """Search for a given Overlap inside the HDF5."""
-    if is_data_in_hdf5(config.path_hdf5, overlaps_paths_hdf5):
+def check_if_overlap_is_done(config: DictConfig, i: int) -> bool:
+    """Search for the i-th Overlap in the index of the HDF5."""
+    overlaps_paths_hdf5 = create_overlap_path(config, i)
+    store = get_store(config.path_hdf5)
+    if store.is_completed("overlaps", i + config.enumerate_from, config.orbitals_type):
         logger.info(f"{overlaps_paths_hdf5} Overlaps are already in the HDF5")
         return True
     else:
@@ -476,7 +629,8 @@ def write_hamiltonians(
 
     # The couplings are compute at time t + dt therefore
     # we associate the energies at time t + dt with the corresponding coupling
-    return [write_data(i) for i in range(config.npoints)]
+    with get_store(config.path_hdf5):
+        return [write_data(i) for i in range(config.npoints)]
 
 
 def swap_columns(arr: Matrix, swaps_t: Vector) -> Matrix:
@@ -484,15 +638,10 @@ def swap_columns(arr: Matrix, swaps_t: Vector) -> Matrix:
     return np.transpose(np.transpose(arr)[swaps_t])
 
 
-def write_overlaps_in_ascii(overlaps: Tensor3D) -> None:
-    """Write the corrected overlaps in text files."""
+def write_overlap_in_ascii(k: int, mtx_Sji: Matrix) -> None:
+    """Write the k-th corrected overlap in a text file."""
     if not os.path.isdir('overlaps'):
         os.mkdir('overlaps')
 
-    # write overlaps
-    nframes = overlaps.shape[0]
-    for k in range(nframes):
-        mtx_Sji = overlaps[k]
-        path_Sji = f'overlaps/mtx_Sji_{k}'
-
-        np.savetxt(path_Sji, mtx_Sji, fmt='%10.5e', delimiter='  ')
+    path_Sji = f'overlaps/mtx_Sji_{k}'
+    np.savetxt(path_Sji, mtx_Sji, fmt='%10.5e', delimiter='  ')
@@ -25,6 +25,7 @@ from pathlib import Path
 from subprocess import PIPE, Popen
 from typing import List, Union
 
+import h5py
 import numpy as np
 import pkg_resources
 from qmflows.parsers import parse_string_xyz
@@ -34,6 +35,7 @@ from qmflows.type_hints import PathLike
 from ..common import (BasisFormats, DictConfig, Matrix, change_mol_units,
                       is_data_in_hdf5, retrieve_hdf5_data,
                       store_arrays_in_hdf5)
+from ..hdf5_store import get_store
 from ..schedule.components import create_point_folder, split_file_geometries
 
 # Starting logger
@@ -66,7 +68,16 @@ def initialize(config: DictConfig) -> DictConfig:
 
     # Touch HDF5 if it doesn't exists
     if not os.path.exists(config.path_hdf5):
-        Path(config.path_hdf5).touch()
+        if config.hdf5_swmr:
+            # SWMR mode requires the file format of HDF5 1.10
+            h5py.File(config.path_hdf5, 'w', libver='latest').close()
+        else:
+            Path(config.path_hdf5).touch()
+    store = get_store(config.path_hdf5)
+    store.set_layout(config.hdf5_layout or "frames")
+    store.set_policies(config.hdf5_storage or {})
+    store.set_swmr(config.hdf5_swmr or False)
+    store.set_async(config.hdf5_async_writes or False)
 
     # all_geometries type :: [String]
     geometries = split_file_geometries(config["path_traj_xyz"])
@@ -19,6 +19,7 @@ import os
 
 import yaml
 
+from ..common import blas_threads
 from .input_validation import process_input
 from .workflow_coop import workflow_crystal_orbital_overlap_population
 from .workflow_coupling import workflow_derivative_couplings
@@ -62,7 +63,10 @@ def main():
     function = dict_workflows[workflow_name]
 
     logger.info(f"Running worflow using: {os.path.abspath(input_file)}")
-    function(inp)
+
+    # Share the thread budget between the integrals and the linear algebra
+    with blas_threads(inp.get("num_threads")):
+        function(inp)
 
 
 if __name__ == "__main__":
@@ -20,7 +20,9 @@ __all__ = [
     'schema_distribute_single_points',
     'schema_absorption_spectrum',
     'schema_ipr',
-    'schema_coop']
+    'schema_coop',
+    'schema_storage_policy',
+    'schema_hdf5_storage']
 
 import os
 from numbers import Real
@@ -29,6 +31,8 @@ from typing import Any, Dict, Iterable
 import pkg_resources as pkg
 from schema import And, Optional, Or, Regex, Schema, Use
 
+from ..hdf5_store import LOSSY_STAGES, POLICY_STAGES
+
 
 def equal_lambda(name: str) -> And:
     """Create an schema checking that the keyword matches the expected value."""
@@ -112,8 +116,45 @@ schema_cp2k_general_settings = Schema({
 })
 
 
+#: Input for how the arrays of a quantity are stored in the HDF5
+dict_storage_policy: Dict[Any, Any] = {
+    # Data type of the stored arrays, None keeps the type used by the workflow
+    Optional("dtype", default=None): Or(None, any_lambda(("float16", "float32", "float64"))),
+
+    # Compression filter and its level (only for gzip)
+    Optional("compression", default=None): Or(None, any_lambda(("gzip", "lzf"))),
+    Optional("compression_opts", default=None): Or(None, And(int, lambda n: 0 <= n <= 9)),
+
+    # Reorder the bytes before the compression
+    Optional("shuffle", default=False): bool,
+
+    # Shape of the chunks of a single frame
+    Optional("chunks", default=None): Or(None, [And(int, lambda n: n > 0)])}
+
+#: Input for the lossy archival codec, only available for the stages in LOSSY_STAGES
+dict_archival_policy: Dict[Any, Any] = {
+    # Lossy archival codec: maximum absolute error of the stored values
+    Optional("error_bound", default=None): Or(None, And(Real, lambda x: x > 0)),
+
+    # Store as zero the entries smaller than this value (in absolute value)
+    Optional("zero_threshold", default=None): Or(None, And(Real, lambda x: x >= 0)),
+
+    # Store only the non-zero entries (frames layout)
+    Optional("sparse", default=False): bool}
+
+#: Schema to validate how the arrays of a quantity are stored in the HDF5
+schema_storage_policy = Schema(merge(dict_storage_policy, dict_archival_policy))
+
+#: Schema to validate the storage policy of each stage, the results used to
+#: compute other quantities cannot be stored with the lossy codec
+schema_hdf5_storage = Schema({
+    Optional(any_lambda(LOSSY_STAGES)): schema_storage_policy,
+    Optional(any_lambda(tuple(s for s in POLICY_STAGES if s not in LOSSY_STAGES))):
+        Schema(dict_storage_policy)})
+
+
 #: Dictionary with the options common to all workflows
-dict_general_options = {
+dict_general_options: Dict[Any, Any] = {
 
     # Number of occupied/virtual orbitals to use
     Optional('active_space', default=[10, 10]): And(list, lambda xs: len(xs) == 2),
@@ -136,6 +177,19 @@ dict_general_options = {
     # path to the HDF5 to store the results
     Optional("path_hdf5", default="quantum.hdf5"): str,
 
+    # Store the results of each frame in its own dataset or stack the frames
+    # in a single dataset per quantity. Only used when creating the HDF5
+    Optional("hdf5_layout", default="frames"): any_lambda(("frames", "stacked")),
+
+    # Compression, chunks and data type used to store each quantity
+    Optional("hdf5_storage", default={}): schema_hdf5_storage,
+
+    # Write the arrays in the HDF5 using a background thread
+    Optional("hdf5_async_writes", default=False): bool,
+
+    # Let other processes read the HDF5 while it is written (stacked layout only)
+    Optional("hdf5_swmr", default=False): bool,
+
     # path to xyz trajectory of the Molecular dynamics
     "path_traj_xyz": os.path.exists,
 
@@ -164,6 +218,15 @@ dict_general_options = {
     # Flag to remove the log containing the orbitals for debugging purposes
     Optional("remove_log_file", default=False): bool,
 
+    # Skip the integrals between shells whose estimated overlap, computed
+    # from the primitive exponents and the distance between the atoms,
+    # is smaller than this threshold. Zero means no screening.
+    Optional("screening_threshold", default=0.0): Real,
+
+    # Number of threads used by the integrals and the linear algebra,
+    # None means all the available cores
+    Optional("num_threads", default=None): Or(None, And(int, lambda n: n > 0)),
+
     # General settings
     "cp2k_general_settings": schema_cp2k_general_settings,
 
@@ -173,7 +236,7 @@ dict_general_options = {
 }
 
 #: Dict with input options to run a derivate coupling workflow
-dict_derivative_couplings = {
+dict_derivative_couplings: Dict[Any, Any] = {
     # Name of the workflow to run
     "workflow": equal_lambda("derivative_couplings"),
 
@@ -187,11 +250,28 @@ dict_derivative_couplings = {
     # Track the crossing between states
     Optional("tracking", default=True): bool,
 
+    # Only swap the orbitals whose overlap is larger than this value, solving
+    # an assignment problem for each group of connected orbitals
+    Optional("tracking_threshold", default=None): Or(None, And(Real, lambda x: 0 <= x < 1)),
+
     # Write the overlaps in ascii
     Optional("write_overlaps", default=False): bool,
 
     # Compute the overlap between molecular geometries using a dephase"
-    Optional("overlaps_deph", default=False): bool
+    Optional("overlaps_deph", default=False): bool,
+
+    # Number of overlaps computed together by the integrals library
+    Optional("overlaps_batch_size", default=16): And(int, lambda n: n > 0),
+
+    # Number of overlaps read together from the HDF5 to compute the couplings
+    Optional("overlaps_window", default=64): And(int, lambda n: n > 0),
+
+    # Store only the coefficients of the orbitals in the active space
+    Optional("store_active_space", default=False): bool,
+
+    # Reuse the atomic orbitals overlap of the previous frame for the atoms
+    # that moved less than this distance (Angstrom). None recomputes everything
+    Optional("overlap_reuse_tolerance", default=None): Or(None, And(Real, lambda x: x >= 0))
 }
 
 dict_merged_derivative_couplings = merge(
@@ -215,7 +295,7 @@ schema_job_scheduler = Schema({
 })
 
 #: Input options to distribute a job
-dict_distribute = {
+dict_distribute: Dict[Any, Any] = {
 
     Optional("workdir", default=os.getcwd()): str,
 
@@ -232,7 +312,7 @@ dict_distribute = {
 }
 
 #: input to distribute a derivative coupling job
-dict_distribute_derivative_couplings = {
+dict_distribute_derivative_couplings: Dict[Any, Any] = {
 
     # Name of the workflow to run
     "workflow": equal_lambda("distribute_derivative_couplings")
@@ -248,7 +328,7 @@ schema_distribute_derivative_couplings = Schema(
             dict_distribute_derivative_couplings)))
 
 #: Input for an absorption spectrum calculation
-dict_absorption_spectrum = {
+dict_absorption_spectrum: Dict[Any, Any] = {
 
     # Name of the workflow to run
     "workflow": equal_lambda("absorption_spectrum"),
@@ -273,7 +353,7 @@ dict_merged_absorption_spectrum = merge(
 schema_absorption_spectrum = Schema(dict_merged_absorption_spectrum)
 
 
-dict_distribute_absorption_spectrum = {
+dict_distribute_absorption_spectrum: Dict[Any, Any] = {
 
     # Name of the workflow to run
     "workflow": equal_lambda("distribute_absorption_spectrum")
@@ -283,7 +363,7 @@ schema_distribute_absorption_spectrum = Schema(
     merge(dict_distribute, merge(
         dict_merged_absorption_spectrum, dict_distribute_absorption_spectrum)))
 
-dict_single_points = {
+dict_single_points: Dict[Any, Any] = {
     # Name of the workflow to run
     "workflow": any_lambda(("single_points", "ipr_calculation", "coop_calculation")),
 
@@ -292,16 +372,21 @@ dict_single_points = {
 }
 
 #: input to distribute single point calculations
-dict_distribute_single_points = {
+dict_distribute_single_points: Dict[Any, Any] = {
 
     # Name of the workflow to run
     "workflow": equal_lambda("distribute_single_points")
 }
 
 #: Input for a Crystal Orbital Overlap Population calculation
-dict_coop = {
+dict_coop: Dict[Any, Any] = {
     # List of the two elements to calculate the COOP for
-    "coop_elements": list}
+    "coop_elements": list,
+
+    # Compute the overlap as an atom-block sparse matrix, dropping the
+    # blocks whose integrals are smaller than this tolerance.
+    # None means a dense matrix.
+    Optional("ao_drop_tolerance", default=None): Or(None, Real)}
 
 
 dict_merged_single_points = merge(dict_general_options, dict_single_points)
@@ -10,15 +10,17 @@ Index
 __all__ = ['workflow_crystal_orbital_overlap_population']
 
 import logging
-from typing import List, Tuple
+from typing import List, Tuple, Union, cast
 
 import numpy as np
 
 from qmflows.parsers.xyzParser import readXYZ
+from scipy import sparse
 
-from ..common import (DictConfig, MolXYZ, h2ev,
+from ..common import (DictConfig, Matrix, MolXYZ, h2ev,
                       number_spherical_functions_per_atom, retrieve_hdf5_data)
-from ..integrals.multipole_matrices import compute_matrix_multipole
+from ..integrals.multipole_matrices import (compute_matrix_multipole,
+                                            compute_sparse_multipole)
 from .initialization import initialize
 from .tools import compute_single_point_eigenvalues_coefficients
 
@@ -87,9 +89,15 @@ def compute_overlap_and_atomic_orbitals(
     """Compute the indices of the atomic orbitals of the two selected elements.
 
     Computes the overlap matrix, containing only the elements related to those two elements.
+    If ``ao_drop_tolerance`` is given, the overlap is computed as an atom-block sparse matrix.
     """
-    # Computing the overlap-matrix S
-    overlap = compute_matrix_multipole(mol, config, 'overlap')
+    # Computing the overlap-matrix S, as a sparse matrix for large systems
+    overlap: Union[Matrix, sparse.csr_matrix]
+    if config.ao_drop_tolerance is None:
+        overlap = compute_matrix_multipole(mol, config, 'overlap')
+    else:
+        # The overlap has a single operator component, hence a single matrix
+        overlap = cast(sparse.csr_matrix, compute_sparse_multipole(mol, config, 'overlap'))
 
     # Computing number of spherical orbitals per atom
     sphericals = number_spherical_functions_per_atom(
@@ -139,23 +147,15 @@ def compute_coop(
         el_2_orbital_ind: np.array) -> np.ndarray:
     """Define the function that computes the crystal orbital overlap population.
 
-    Applying it to each column of the coefficent matrix.
+    For each column of the coefficent matrix the coefficient-products are
+    multiplied with the relevant overlap and everything is summed up. The
+    reduced overlap can be either a dense or a sparse matrix.
     """
-    # Define a function to be applied to each column of the coefficient matrix
-    def coop_func(column_of_coefficient_matrix: np.array):
-        # Multiply each coefficient-product with the relevant overlap, and sum
-        # everything
-        return np.sum(
-            np.tensordot(
-                column_of_coefficient_matrix[el_1_orbital_ind],
-                column_of_coefficient_matrix[el_2_orbital_ind],
-                0) * overlap_reduced)
-
-    # Call the function
-    coop = np.apply_along_axis(
-        coop_func,
-        0,
-        atomic_orbitals)
+    coefficients_1 = atomic_orbitals[el_1_orbital_ind]
+    coefficients_2 = atomic_orbitals[el_2_orbital_ind]
+
+    # sum_ij c_ik S_ij c_jk for all the columns k at once
+    coop = np.sum(coefficients_1 * (overlap_reduced @ coefficients_2), axis=0)
 
     # Return the calculated crystal orbital overlap population
     return coop
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compare the size and read throughput of the HDF5 storage policies.
+
+The molecular orbital coefficients are read from an existing HDF5 (``-i``) or,
+if no file is given, generated as matrices whose entries decay with the
+distance to the diagonal, like the coefficients of localized basis functions.
+
+Example
+-------
+.. code-block:: bash
+
+    python benchmark_hdf5_storage.py -i quantum.hdf5 -p alphas -n 100
+
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from nanoqm.hdf5_store import HDF5Store, frame_path
+
+msg = "benchmark_hdf5_storage.py [-i path_hdf5] [-p orbitals_type] [-n frames]"
+
+parser = argparse.ArgumentParser(description=msg)
+parser.add_argument('-i', help="HDF5 with the coefficients to use", default=None)
+parser.add_argument('-p', help="orbitals type: '', alphas or betas", default="")
+parser.add_argument('-n', help="number of frames", type=int, default=50)
+parser.add_argument('--size', help="number of basis functions of the synthetic data",
+                    type=int, default=1000)
+
+#: Policies to compare, see :class:`nanoqm.hdf5_store.StoragePolicy`
+POLICIES: Dict[str, Dict[str, Any]] = {
+    "float32": {},
+    "float64": {"dtype": "float64"},
+    "lzf": {"compression": "lzf"},
+    "lzf+shuffle": {"compression": "lzf", "shuffle": True},
+    "gzip-4": {"compression": "gzip", "compression_opts": 4},
+    "gzip-4+shuffle": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    "gzip-9+shuffle": {"compression": "gzip", "compression_opts": 9, "shuffle": True},
+    "float16+gzip": {"dtype": "float16", "compression": "gzip", "shuffle": True},
+}
+
+
+def read_coefficients(path_hdf5: Path, prefix: str, nframes: int) -> List[np.ndarray]:
+    """Read the coefficients of the first ``nframes`` stored in ``path_hdf5``."""
+    store = HDF5Store(path_hdf5)
+    with store:
+        frames = [i for i in range(nframes) if store.is_completed("coefficients", i, prefix)]
+        return list(store.read_frames("coefficients", frames, prefix))
+
+
+def synthetic_coefficients(size: int, nframes: int) -> List[np.ndarray]:
+    """Generate coefficients decaying with the distance to the diagonal."""
+    generator = np.random.default_rng(42)
+    distance = np.abs(np.subtract.outer(np.arange(size), np.arange(size)))
+    envelope = np.exp(-distance / 20)
+    envelope[envelope < 1e-7] = 0
+    return [generator.normal(size=(size, size)) * envelope for _ in range(nframes)]
+
+
+def benchmark(
+        name: str, policy: Dict[str, Any], coefficients: List[np.ndarray],
+        layout: str, workdir: Path) -> Dict[str, Any]:
+    """Store the coefficients using ``policy`` and read them back."""
+    path_hdf5 = workdir / f"{name}_{layout}.hdf5"
+    path_hdf5.touch()
+    store = HDF5Store(path_hdf5)
+    store.set_layout(layout)
+    store.set_policies({"coefficients": policy})
+
+    start = time.perf_counter()
+    store.write_frames("coefficients", range(len(coefficients)), coefficients)
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with store:
+        for i in range(len(coefficients)):
+            store.read(frame_path("coefficients", i))
+    read_time = time.perf_counter() - start
+
+    raw = sum(np.dtype(policy.get("dtype", np.float32)).itemsize * x.size for x in coefficients)
+    return {"policy": name, "layout": layout, "size": path_hdf5.stat().st_size,
+            "ratio": raw / path_hdf5.stat().st_size, "write": write_time,
+            "read": raw / read_time / 2 ** 20}
+
+
+def main(path_hdf5: Optional[str], prefix: str, nframes: int, size: int) -> None:
+    """Run the benchmark for all the policies and layouts."""
+    if path_hdf5 is not None:
+        coefficients = read_coefficients(Path(path_hdf5), prefix, nframes)
+    else:
+        coefficients = synthetic_coefficients(size, nframes)
+    print(f"frames: {len(coefficients)} shape: {coefficients[0].shape}")
+    print(f"{'policy':<16} {'layout':<8} {'size (MiB)':>10} {'ratio':>6} "
+          f"{'write (s)':>9} {'read (MiB/s)':>12}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout in ("frames", "stacked"):
+            for name, policy in POLICIES.items():
+                r = benchmark(name, policy, coefficients, layout, Path(tmp))
+                print(f"{r['policy']:<16} {r['layout']:<8} {r['size'] / 2 ** 20:10.1f} "
+                      f"{r['ratio']:6.2f} {r['write']:9.2f} {r['read']:12.1f}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.i, args.p, args.n, args.size)
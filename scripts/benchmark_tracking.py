@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Compare the time to track the crossings with the length of the trajectory.
+
+The previous algorithm permuted all the following overlaps after each
+step, so its cost grew quadratically with the number of frames, while
+:func:`nanoqm.schedule.scheduleCoupling.track_unavoided_crossings`
+applies the accumulated permutation to each overlap once. With ``-t`` the
+tracking solving an assignment problem for each group of orbitals with
+overlaps above the threshold is timed as well.
+
+Example
+-------
+.. code-block:: bash
+
+    python benchmark_tracking.py -n 100 200 400 800 --size 100 -t 0.1
+
+"""
+
+import argparse
+import time
+from functools import partial
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from nanoqm.schedule.scheduleCoupling import assign_orbitals, track_unavoided_crossings
+
+msg = "benchmark_tracking.py [-n frames ...] [--size orbitals]"
+
+parser = argparse.ArgumentParser(description=msg)
+parser.add_argument('-n', help="number of frames", type=int, nargs='+',
+                    default=[100, 200, 400, 800])
+parser.add_argument('--size', help="number of orbitals", type=int, default=100)
+parser.add_argument('-t', '--threshold', help="threshold of the overlaps to swap the orbitals",
+                    type=float, default=None)
+
+
+def track_reindexing(overlaps: np.ndarray, nHOMO: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Track the crossings permuting all the following overlaps at each step."""
+    nOverlaps, nOrbitals, _ = overlaps.shape
+    indexes = np.empty((nOverlaps + 1, nOrbitals), dtype=int)
+    indexes[0] = np.arange(nOrbitals)
+    for k in range(nOverlaps):
+        total_swaps = assign_orbitals(overlaps[k], nHOMO)
+        indexes[k + 1] = total_swaps
+        if k != nOverlaps - 1:
+            overlaps[k] = overlaps[k][:, total_swaps]
+            for i in range(k + 1, nOverlaps):
+                overlaps[i] = overlaps[i][:, total_swaps][total_swaps]
+    # Accumulate the swaps
+    arr = np.empty(indexes.shape, dtype=int)
+    arr[0] = acc = indexes[0]
+    for i in range(nOverlaps):
+        acc = acc[indexes[i + 1]]
+        arr[i + 1] = acc
+    return overlaps, arr
+
+
+def synthetic_overlaps(nframes: int, size: int) -> np.ndarray:
+    """Generate overlaps close to the identity with some crossings."""
+    generator = np.random.default_rng(42)
+    overlaps = np.tile(np.eye(size, dtype=np.float32) * 0.9, (nframes, 1, 1))
+    overlaps += generator.normal(scale=0.02, size=overlaps.shape).astype(np.float32)
+    for mtx in overlaps:
+        i = generator.integers(size - 1)
+        mtx[[i, i + 1]] = mtx[[i + 1, i]]
+    return overlaps
+
+
+def timing(
+        fun: Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]],
+        overlaps: np.ndarray, nHOMO: int) -> Tuple[float, np.ndarray, np.ndarray]:
+    """Time the tracking of a copy of the overlaps."""
+    overlaps = overlaps.copy()
+    start = time.perf_counter()
+    tracked, swaps = fun(overlaps, nHOMO)
+    return time.perf_counter() - start, tracked, swaps
+
+
+def main(nframes: List[int], size: int, threshold: Optional[float]) -> None:
+    """Time both algorithms for each number of frames."""
+    print(f"orbitals: {size}")
+    header = f"{'frames':>8} {'reindexing (s)':>15} {'lazy (s)':>10} {'speedup':>8}"
+    print(header if threshold is None else f"{header} {'groups (s)':>10}")
+    for n in nframes:
+        overlaps = synthetic_overlaps(n, size)
+        old, *expected = timing(track_reindexing, overlaps, size // 2)
+        new, *result = timing(track_unavoided_crossings, overlaps, size // 2)
+        if not all(np.array_equal(x, y) for x, y in zip(expected, result)):
+            raise RuntimeError("The tracked overlaps are different")
+        line = f"{n:8d} {old:15.2f} {new:10.2f} {old / new:8.1f}"
+        if threshold is not None:
+            groups, *result = timing(
+                partial(track_unavoided_crossings, threshold=threshold), overlaps, size // 2)
+            if not all(np.array_equal(x, y) for x, y in zip(expected, result)):
+                print("The tracking with the threshold gives different swaps")
+            line += f" {groups:10.2f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.n, args.size, args.threshold)
@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 
-"""Convert old HDF5 files to the new storage layout."""
+"""Convert old HDF5 files to the new storage layout.
+
+The datasets are copied in slabs of bounded size, read by several processes.
+"""
 
 import argparse
 from itertools import chain
 from pathlib import Path
-from typing import Iterable, Optional, Set
+from typing import Dict, Iterable, List
 
 import h5py
 import numpy as np
 
+from nanoqm.hdf5_merge import DatasetSpec, SlabCopy, split_rows, stream_copy
+
 
 def exists(input_file: str) -> Path:
     """Check if the input file exists."""
@@ -23,11 +28,14 @@ def exists(input_file: str) -> Path:
 class LegacyConverter:
     """Convert legacy HDF5 files to the new storage layout."""
 
-    def __init__(self, source: h5py.File, dest: h5py.File) -> None:
+    def __init__(self, source: h5py.File, slab_bytes: int = 2 ** 26) -> None:
         """Initialize the converter."""
         self.source = source
-        self.dest = dest
+        self.slab_bytes = slab_bytes
         self.project = self.get_project_name()
+        # Datasets to create and slabs to copy into them
+        self.specs: Dict[str, DatasetSpec] = {}
+        self.copies: List[SlabCopy] = []
 
     def get_project_name(self) -> str:
         """Get the project root name."""
@@ -36,10 +44,13 @@ class LegacyConverter:
         return diff.pop()
 
     def copy_data_set(self, old_path: str, new_path: str) -> None:
-        """Copy data set from old ``source`` to new ``dest``."""
-        if old_path in self.source:
-            data = self.source[old_path][()]
-            self.dest.require_dataset(new_path, shape=np.shape(data), data=data, dtype=np.float32)
+        """Schedule the copy of a data set from old ``source`` to the new file."""
+        if old_path in self.source and new_path not in self.specs:
+            dset = self.source[old_path]
+            self.specs[new_path] = DatasetSpec(dset.shape, np.dtype(np.float32), {}, {})
+            self.copies.extend(
+                SlabCopy(self.source.filename, dset.name, rows, new_path, rows.start or 0)
+                for rows in split_rows(dset, self.slab_bytes))
 
     def copy_node_values(self, old_names: Iterable[str], new_names: Iterable[str]) -> None:
         """Copy the data set values from the old file to the new one."""
@@ -91,23 +102,25 @@ class LegacyConverter:
             method()
 
 
-def convert(path_hdf5: Path) -> None:
+def convert(path_hdf5: Path, workers: int = 2) -> None:
     """Convert ``path_hdf5`` to new storage format."""
     new_hdf5 = path_hdf5
-    old_hdf5 = path_hdf5.rename(f'old_{path_hdf5.name}')
+    old_hdf5 = path_hdf5.rename(path_hdf5.with_name(f'old_{path_hdf5.name}'))
 
-    with h5py.File(new_hdf5, 'a') as dest, h5py.File(old_hdf5, 'r') as source:
-        converter = LegacyConverter(source, dest)
+    with h5py.File(old_hdf5, 'r') as source:
+        converter = LegacyConverter(source)
         converter.copy_all()
+    stream_copy(new_hdf5, converter.specs, converter.copies, workers)
 
 
 def main():
     """Perform the conversion."""
     parser = argparse.ArgumentParser("convert_legacy_hdf5")
     parser.add_argument("input", type=exists, help="HDF5 file to convert")
+    parser.add_argument("-j", type=int, default=2, help="Number of processes reading the file")
 
     args = parser.parse_args()
-    convert(args.input)
+    convert(args.input, args.j)
 
 
 if __name__ == "__main__":
@@ -2,10 +2,14 @@
 """This programs plots the electronic coupling between two states.
 
   It reads all Ham_*_im files and cache them in a tensor saved on disk.
+  Alternatively, the couplings are read from the HDF5 while the workflow
+  is still computing them.
   Usage:
   plot_couplings.py -p . -s1 XX -s2 YY -dt 1.0
+  plot_couplings.py -hdf5 quantum.hdf5 -s1 XX -s2 YY -dt 1.0
 
 p = path to the hamiltonian files
+hdf5 = path to the HDF5 written by the workflow
 s1 = state 1 index
 s2 = state 2 index
 dt = time step in fs
@@ -16,6 +20,9 @@ import argparse
 import glob
 import os.path
 
+from nanoqm.common import femtosec2au, hbar
+from nanoqm.hdf5_store import HDF5Follower
+
 r2meV = 13605.698  # From Rydeberg to eV
 
 
@@ -38,6 +45,26 @@ def main(path_output, s1, s2, dt):
         plt.show()
 
 
+def follow_couplings(path_hdf5, s1, s2, dt, prefix, interval):
+    """Plot the couplings stored in the HDF5 and update the plot with the new ones."""
+    ts, couplings = [], []
+    line, = plt.plot(ts, couplings)
+    plt.xlabel('Time (fs)')
+    plt.ylabel('Energy (meV)')
+    plt.ion()
+    plt.show()
+    with HDF5Follower(path_hdf5, "couplings", prefix) as follower:
+        while plt.get_fignums():
+            for frame, css in sorted(zip(*follower.poll()), key=lambda x: x[0]):
+                ts.append(frame * dt)
+                # Same units as the Hamiltonians written by the workflow
+                couplings.append(css[s1, s2] * femtosec2au * hbar * 1000)
+            line.set_data(ts, couplings)
+            plt.gca().relim()
+            plt.gca().autoscale_view()
+            plt.pause(interval)
+
+
 def read_cmd_line(parser):
     """
     Parse Command line options.
@@ -54,12 +81,23 @@ if __name__ == "__main__":
     -dt <time step>"
 
     parser = argparse.ArgumentParser(description=msg)
-    parser.add_argument('-p', required=True,
+    parser.add_argument('-p', default='.',
                         help='path to the Hamiltonian files in Pyxaid format')
+    parser.add_argument('-hdf5', default=None,
+                        help='follow the couplings stored in this HDF5')
+    parser.add_argument('-orbitals_type', default='',
+                        help="orbitals type of the couplings: '', alphas or betas")
+    parser.add_argument('-interval', type=float, default=5.0,
+                        help='seconds between the reads of the HDF5')
     parser.add_argument('-s1', required=True, type=int,
                         help='Index of the first state')
     parser.add_argument('-s2', required=True, type=int,
                         help='Index of the second state')
     parser.add_argument('-dt', type=float, default=1.0,
                         help='Index of the second state')
-    main(*read_cmd_line(parser))
+    args = parser.parse_args()
+    if args.hdf5 is not None:
+        follow_couplings(args.hdf5, args.s1, args.s2, args.dt, args.orbitals_type,
+                         args.interval)
+    else:
+        main(*read_cmd_line(parser))
@@ -7,11 +7,14 @@ Example:
 
 mergeHDF5.py -i chunk_a.hdf5 chunk_b.hdf5 chunk_c.hdf5 -o total.hdf5
 
-An empty total.hdf5 file should be already available before using the script.
+The frames of each chunk are renumbered to follow the previous chunk, unless
+-keep_numbers is given, and the nodes already stored in total.hdf5 are kept.
+The chunks are read in parallel by -j processes.
 """
 import argparse
-import h5py
-import os
+import logging
+
+from nanoqm.hdf5_merge import chunk_offsets, merge_chunks
 
 # ====================================<>=======================================
 msg = " script -i <Path(s)/to/source/hdf5> -o <path/to/destiny/hdf5>"
@@ -21,6 +24,10 @@ parser.add_argument('-i', required=True,
                     help='Path(s) to the HDF5 to merge', nargs='+')
 parser.add_argument('-o', required=True,
                     help='Path to the HDF5 were the merge is going to be stored')
+parser.add_argument('-j', type=int, default=None,
+                    help='Number of processes reading the HDF5 files')
+parser.add_argument('-keep_numbers', action='store_true',
+                    help='Do not renumber the frames of the chunks')
 
 
 def read_cmd_line():
@@ -31,41 +38,15 @@ def read_cmd_line():
     inp = args.i
     out = args.o
 
-    return inp, out
+    return inp, out, args.j, args.keep_numbers
 # ===============><==================
 
 
-def mergeHDF5(inp, out):
-    """Merge Recursively two hdf5 Files."""
-    with h5py.File(inp, 'r') as f5, h5py.File(out, 'r+') as g5:
-        merge_recursively(f5, g5)
-
-
-def merge_recursively(f, g):
-    """Traverse all the groups tree and copy the different datasets."""
-    for k in f.keys():
-        if k not in g:
-            if isinstance(f[k], h5py.Dataset):
-                f.copy(k, g)
-            else:
-                g.create_group(k)
-                merge_recursively(f[k], g[k])
-        elif isinstance(f[k], h5py.Group):
-            merge_recursively(f[k], g[k])
-
-
 def main():
-    inps, out = read_cmd_line()
-    if not os.path.exists(out):
-        touch(out)
-    for i in inps:
-        mergeHDF5(i, out)
-
-
-def touch(fname, times=None):
-    """Equivalent to unix touch command"""
-    with open(fname, 'a'):
-        os.utime(fname, times)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    inps, out, workers, keep_numbers = read_cmd_line()
+    offsets = [0] * len(inps) if keep_numbers else chunk_offsets(inps)
+    merge_chunks(inps, out, offsets, workers)
 
 
 if __name__ == "__main__":
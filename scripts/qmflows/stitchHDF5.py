@@ -0,0 +1,40 @@
+#! /usr/bin/env python
+
+"""
+This program creates a master HDF5 pointing to the HDF5 files obtained from the
+chunks of a MD trajectory split in more than one block, without copying the data.
+Example:
+
+stitchHDF5.py -i chunk_0.hdf5 chunk_1.hdf5 chunk_2.hdf5 -o total.hdf5
+
+The frames of each chunk are renumbered to follow the previous chunk. The chunks
+must be kept, since the master file only contains references to their datasets.
+"""
+import argparse
+import logging
+
+from nanoqm.hdf5_merge import chunk_offsets, stitch_chunks
+
+# ====================================<>=======================================
+msg = " script -i <Path(s)/to/chunks/hdf5> -o <path/to/master/hdf5>"
+
+parser = argparse.ArgumentParser(description=msg)
+parser.add_argument('-i', required=True,
+                    help='Path(s) to the HDF5 of the chunks, sorted along the trajectory',
+                    nargs='+')
+parser.add_argument('-o', required=True,
+                    help='Path to the master HDF5 to create')
+
+
+def main():
+    """Stitch the chunks given in the command line."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = parser.parse_args()
+    offsets = chunk_offsets(args.i)
+    for path, offset in zip(args.i, offsets):
+        print(f"{path}: adding {offset} to the frame numbers")
+    stitch_chunks(args.i, args.o, offsets)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Report the error introduced by the lossy codec of the overlaps and couplings.
+
+The overlaps stored in an existing HDF5 (``-i``) are encoded with the given
+error bound and zero threshold, then the phases are fixed and the couplings and
+the imaginary part of the Hamiltonians are computed from both the original and
+the decoded overlaps. The couplings are encoded as well, like in the workflow.
+The size of the HDF5 storing the overlaps and couplings is compared with the
+size using single precision without compression.
+
+Example
+-------
+.. code-block:: bash
+
+    python validate_lossy_storage.py -i quantum.hdf5 -p alphas -e 1e-5 -z 1e-4 --sparse -c gzip
+
+"""
+
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from nanoqm.common import femtosec2au, hbar
+from nanoqm.hdf5_store import HDF5Store, StoragePolicy
+from nanoqm.integrals import (calculate_couplings_3points,
+                              calculate_couplings_levine, correct_phases)
+from nanoqm.schedule.scheduleCoupling import compute_phases
+
+msg = "validate_lossy_storage.py -i path_hdf5 [-p orbitals_type] -e error_bound"
+
+parser = argparse.ArgumentParser(description=msg)
+parser.add_argument('-i', required=True, help="HDF5 with the overlaps")
+parser.add_argument('-p', help="orbitals type: '', alphas or betas", default="")
+parser.add_argument('-e', '--error_bound', help="maximum absolute error of the stored values",
+                    type=float, required=True)
+parser.add_argument('-z', '--zero_threshold', help="store as zero the smaller entries",
+                    type=float, default=None)
+parser.add_argument('--sparse', help="store only the non-zero entries", action="store_true")
+parser.add_argument('-c', '--compression', help="compression filter", choices=("gzip", "lzf"),
+                    default=None)
+parser.add_argument('-dt', help="integration step (fs)", type=float, default=1.0)
+parser.add_argument('-a', '--algorithm', help="algorithm used to compute the couplings",
+                    choices=("levine", "3points"), default="levine")
+
+
+def read_overlaps(path_hdf5: str, prefix: str) -> np.ndarray:
+    """Read all the overlaps stored in ``path_hdf5``."""
+    store = HDF5Store(path_hdf5)
+    with store:
+        frames = store.index.frames("overlaps", prefix)
+        if len(frames) == 0:
+            raise RuntimeError(f"There are no overlaps stored in {path_hdf5}")
+        return store.read_frames("overlaps", frames.tolist(), prefix).astype(np.float64)
+
+
+def compute_couplings(overlaps: np.ndarray, dt: float, algorithm: str) -> List[np.ndarray]:
+    """Fix the phases of the overlaps and compute the couplings between the frames."""
+    noverlaps, dim = overlaps.shape[:2]
+    fixed = correct_phases(overlaps.copy(), compute_phases(overlaps, noverlaps, dim))
+    dt_au = dt * femtosec2au
+    if algorithm == "levine":
+        return [calculate_couplings_levine(dt_au, s.copy(), s.T.copy()) for s in fixed]
+    return [calculate_couplings_3points(dt_au, s0, s0.T, s1, s1.T)
+            for s0, s1 in zip(fixed[:-1], fixed[1:])]
+
+
+def stored_size(
+        overlaps: np.ndarray, couplings: List[np.ndarray],
+        policy: Dict[str, Any], workdir: Path) -> int:
+    """Return the size of a HDF5 storing the overlaps and couplings with ``policy``."""
+    path_hdf5 = workdir / f"{len(list(workdir.iterdir()))}.hdf5"
+    path_hdf5.touch()
+    store = HDF5Store(path_hdf5)
+    store.set_policies({"overlaps": policy, "couplings": policy})
+    store.write_frames("overlaps", range(len(overlaps)), overlaps)
+    store.write_frames("couplings", range(len(couplings)), couplings)
+    return path_hdf5.stat().st_size
+
+
+def main(args: argparse.Namespace) -> None:
+    """Compare the couplings and Hamiltonians computed with and without the codec."""
+    overlaps = read_overlaps(args.i, args.p)
+    options = {"error_bound": args.error_bound, "zero_threshold": args.zero_threshold,
+               "sparse": args.sparse, "compression": args.compression,
+               "shuffle": args.compression is not None}
+    policy = StoragePolicy.from_dict(options)
+    decoded = policy.quantize(overlaps)
+
+    couplings = compute_couplings(overlaps, args.dt, args.algorithm)
+    lossy = [policy.quantize(c) for c in compute_couplings(decoded, args.dt, args.algorithm)]
+    coupling_error = max(np.abs(c - x).max() for c, x in zip(couplings, lossy))
+    # Imaginary part of the Hamiltonian in meV, see write_hamiltonians
+    hamiltonian_error = coupling_error * femtosec2au * hbar * 1000
+    hamiltonian_max = max(np.abs(c).max() for c in couplings) * femtosec2au * hbar * 1000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        reference = stored_size(overlaps, couplings, {}, Path(tmp))
+        compressed = stored_size(overlaps, couplings, options, Path(tmp))
+
+    print(f"overlaps: {overlaps.shape[0]} of shape {overlaps.shape[1:]}")
+    bound = max(args.error_bound, args.zero_threshold or 0)
+    print(f"overlaps max error: {np.abs(decoded - overlaps).max():.3e} (bound {bound:.3e})")
+    print(f"overlaps entries stored as zero: {np.mean(decoded == 0):.1%}")
+    print(f"couplings ({args.algorithm}) max error: {coupling_error:.3e} "
+          f"(max value {max(np.abs(c).max() for c in couplings):.3e})")
+    print(f"Hamiltonians max error: {hamiltonian_error:.3e} meV "
+          f"(max value {hamiltonian_max:.3e} meV)")
+    print(f"size: {compressed / 2 ** 20:.2f} MiB, {reference / compressed:.2f} times "
+          f"smaller than single precision")
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -151,7 +151,7 @@ setup(
     ],
     install_requires=[
         'h5py', 'mendeleev', 'more-itertools', 'noodles==0.3.3', 'numpy', 'pybind11>=2.2.4',
-        'scipy', 'schema', 'pyyaml>=5.1',
+        'scipy', 'schema', 'pyyaml>=5.1', 'threadpoolctl',
         'plams@git+https://github.com/SCM-NV/PLAMS@master',
         'qmflows@git+https://github.com/SCM-NV/qmflows@master'
     ],
@@ -174,6 +174,7 @@ setup(
     },
     scripts=[
         'scripts/convert_legacy_hdf5.py',
+        'scripts/validate_lossy_storage.py',
         'scripts/hamiltonians/plot_mos_energies.py',
         'scripts/hamiltonians/plot_spectra.py',
         'scripts/pyxaid/plot_average_energy.py',
@@ -183,6 +184,7 @@ setup(
         'scripts/qmflows/mergeHDF5.py',
         'scripts/qmflows/plot_dos.py',
         'scripts/qmflows/rdf.py',
+        'scripts/qmflows/stitchHDF5.py',
         'scripts/qmflows/removeHDF5folders.py',
         'scripts/qmflows/remove_mos_hdf5.py',
         'scripts/qmflows/convolution.py'
@@ -0,0 +1,74 @@
+"""Test the tools combining the HDF5 files of the chunks."""
+import h5py
+import numpy as np
+import pytest
+
+from nanoqm.hdf5_merge import chunk_offsets, merge_chunks, renumber_path, stitch_chunks
+from nanoqm.hdf5_store import HDF5Store
+
+
+def create_chunks(tmp_path, layout, enumerate_from):
+    """Create two chunks with three geometries and two overlaps each."""
+    arrays = np.random.rand(2, 3, 4, 4)
+    paths = []
+    for i, start in enumerate(enumerate_from):
+        path = tmp_path / f"chunk_{i}.hdf5"
+        path.touch()
+        store = HDF5Store(path)
+        store.set_layout(layout)
+        store.write_frames("coefficients", range(start, start + 3), arrays[i])
+        store.write_frames("overlaps", range(start, start + 2), arrays[i, :2])
+        store.write("cp2k/basis", np.ones(3))
+        paths.append(path)
+    return paths, arrays
+
+
+def test_renumber_path():
+    """Test the renumbering of the frames in the node paths."""
+    assert renumber_path("alphas/overlaps_2/mtx_sji_t0", 3) == "alphas/overlaps_5/mtx_sji_t0"
+    assert renumber_path("dipole/point_0", 3) == "dipole/point_3"
+    assert renumber_path("cp2k/basis_1", 3) == "cp2k/basis_1"
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+@pytest.mark.parametrize("enumerate_from", [(0, 0), (0, 3)])
+def test_stitch_chunks(tmp_path, layout, enumerate_from):
+    """Test that the master file contains the whole trajectory using virtual datasets."""
+    paths, arrays = create_chunks(tmp_path, layout, enumerate_from)
+    assert chunk_offsets(paths) == [0, 3 - enumerate_from[1]]
+
+    master = tmp_path / "master.hdf5"
+    stitch_chunks(paths, master)
+    store = HDF5Store(master)
+    assert store.layout == layout
+    assert np.allclose(store.read_frames("coefficients", range(6)), arrays.reshape(6, 4, 4))
+    assert np.allclose(store.read("overlaps_4/mtx_sji_t0"), arrays[1, 1])
+    assert not store.contains("overlaps_2/mtx_sji_t0")
+    assert np.allclose(store.read("cp2k/basis"), 1)
+
+    with h5py.File(master, 'r') as f5:
+        node = "stacked/coefficients/data" if layout == "stacked" else "coefficients/point_5"
+        assert f5[node].is_virtual
+    assert master.stat().st_size < sum(path.stat().st_size for path in paths)
+
+
+@pytest.mark.parametrize("layout,workers", [("frames", 0), ("stacked", 0), ("stacked", 2)])
+def test_merge_chunks(tmp_path, layout, workers):
+    """Test that the chunks are copied in slabs and renumbered in a single pass."""
+    paths, arrays = create_chunks(tmp_path, layout, (0, 0))
+    merged = tmp_path / "merged.hdf5"
+    with h5py.File(merged, 'w') as f5:
+        f5["cp2k/basis"] = np.zeros(3)
+
+    # Slabs smaller than a frame
+    merge_chunks(paths, merged, workers=workers, slab_bytes=32)
+    store = HDF5Store(merged)
+    assert store.layout == layout
+    assert np.allclose(store.read_frames("coefficients", range(6)), arrays.reshape(6, 4, 4))
+    assert np.allclose(store.read("overlaps_4/mtx_sji_t0"), arrays[1, 1])
+    assert not store.contains("overlaps_2/mtx_sji_t0")
+    # The existing nodes are kept
+    assert np.allclose(store.read("cp2k/basis"), 0)
+    with h5py.File(merged, 'r') as f5:
+        node = "stacked/coefficients/data" if layout == "stacked" else "coefficients/point_5"
+        assert not f5[node].is_virtual
@@ -0,0 +1,426 @@
+"""Test the session-scoped HDF5 store."""
+import json
+import shutil
+import subprocess
+import sys
+import time
+
+import h5py
+import numpy as np
+import pytest
+from qmflows.common import InfoMO
+
+from nanoqm.common import (DictConfig, is_data_in_hdf5, retrieve_hdf5_data,
+                           store_arrays_in_hdf5)
+from nanoqm.hdf5_store import FrameIndex, HDF5Follower, HDF5Store, frame_path, get_store
+from nanoqm.integrals.nonAdiabaticCoupling import read_mo_window, read_overlap_data
+from nanoqm.schedule.components import dump_orbitals_to_hdf5
+
+from .utilsTest import PATH_TEST
+
+
+def copy_hdf5(tmp_path) -> str:
+    """Copy the test HDF5 to a temporal folder."""
+    path_hdf5 = tmp_path / "store.hdf5"
+    shutil.copyfile(PATH_TEST / "ethylene.hdf5", path_hdf5)
+    return path_hdf5
+
+
+def test_stage_buffers_writes(tmp_path):
+    """Test that the writes are visible inside the stage and stored when it finishes."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    arr = np.random.rand(4, 4)
+    with get_store(path_hdf5) as store:
+        store_arrays_in_hdf5(path_hdf5, "stage/point_0", arr)
+        assert is_data_in_hdf5(path_hdf5, "stage/point_0")
+        assert np.allclose(retrieve_hdf5_data(path_hdf5, "stage/point_0"), arr.astype(np.float32))
+        # Nothing has been written yet
+        with h5py.File(path_hdf5, 'r') as f5:
+            assert "stage/point_0" not in f5
+        assert store.in_stage
+
+    assert not store.in_stage
+    with h5py.File(path_hdf5, 'r') as f5:
+        stored = f5["stage/point_0"][()]
+    assert stored.dtype == np.float32
+    assert np.allclose(stored, arr)
+
+
+def test_stage_opens_the_file_once(tmp_path, mocker):
+    """Test that a stage opens the HDF5 a single time to read and once to write."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    spy = mocker.spy(h5py, "File")
+    with HDF5Store(path_hdf5) as store:
+        for i in range(10):
+            assert not store.contains(f"stage/point_{i}")
+            store.write(f"stage/point_{i}", np.full(3, i))
+    assert spy.call_count == 2
+    assert retrieve_hdf5_data(path_hdf5, "stage/point_9")[0] == 9
+
+
+def test_store_absolute_path(tmp_path, monkeypatch):
+    """Test that the store keeps the absolute path of the HDF5, whatever the path type."""
+    tmp_path = tmp_path.resolve()
+    path_hdf5 = copy_hdf5(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    store = get_store("store.hdf5")
+    assert store is get_store(path_hdf5)
+    assert store is get_store(bytes(path_hdf5))
+    assert store.path_hdf5 == str(path_hdf5)
+    assert HDF5Follower(b"store.hdf5", "overlaps").path_hdf5 == str(path_hdf5)
+
+    # The store still finds the file after changing the working directory
+    monkeypatch.chdir(PATH_TEST)
+    with store:
+        store.write("stage/point_0", np.ones(3))
+    assert np.allclose(retrieve_hdf5_data(path_hdf5, "stage/point_0"), 1)
+
+
+def test_no_overwrite(tmp_path):
+    """Test that existing nodes are not overwritten, like ``require_dataset``."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    store_arrays_in_hdf5(path_hdf5, "stage/point_0", np.zeros(3))
+    with get_store(path_hdf5):
+        store_arrays_in_hdf5(path_hdf5, "stage/point_0", np.ones(3))
+        assert np.allclose(retrieve_hdf5_data(path_hdf5, "stage/point_0"), 0)
+    assert np.allclose(retrieve_hdf5_data(path_hdf5, "stage/point_0"), 0)
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+def test_overwrite(tmp_path, layout):
+    """Test that the nodes are replaced if requested, also while the write is pending."""
+    path_hdf5 = tmp_path / "overwrite.hdf5"
+    path_hdf5.touch()
+    store = get_store(path_hdf5)
+    store.set_layout(layout)
+    store.write_frames("couplings", range(3), np.zeros((3, 2, 2)))
+    path = frame_path("couplings", 1)
+    with store:
+        store.write(path, np.ones((2, 2)), overwrite=True)
+        store.write("swaps", np.arange(3), overwrite=True)
+        assert np.allclose(store.read(path), 1)
+    store.write("swaps", np.arange(4), overwrite=True)
+    assert store.read_frames("couplings", range(3))[:, 0, 0].tolist() == [0, 1, 0]
+    assert np.array_equal(store.read("swaps"), np.arange(4))
+
+
+def test_missing_data(tmp_path):
+    """Test the errors for missing nodes and files."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    with pytest.raises(KeyError):
+        retrieve_hdf5_data(path_hdf5, "missing/node")
+    with pytest.raises(RuntimeError):
+        retrieve_hdf5_data(tmp_path / "missing.hdf5", "missing/node")
+    assert not is_data_in_hdf5(tmp_path / "missing.hdf5", "missing/node")
+
+
+def test_frame_index(tmp_path):
+    """Test the bitmaps of the frames computed by each stage."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    with get_store(path_hdf5) as store:
+        assert store.completed("coefficients", 6).tolist() == [True] * 5 + [False]
+        assert not store.is_completed("overlaps", 0)
+
+        store.write("overlaps_0/mtx_sji_t0", np.eye(2))
+        store.write("alphas/coupling_3", np.eye(2))
+        assert store.is_completed("overlaps", 0)
+        assert store.contains("overlaps_0")
+        assert store.is_completed("couplings", 3, "alphas")
+        assert not store.is_completed("couplings", 3)
+
+    with get_store(path_hdf5) as store:
+        assert store.is_completed("overlaps", 0)
+        assert store.completed("couplings", 4, "alphas").tolist() == [False] * 3 + [True]
+
+
+def test_frame_index_patterns():
+    """Test that only the nodes with per-frame results are added to the bitmaps."""
+    index = FrameIndex(["eigenvalues/point_2", "betas/energy/point_1",
+                        "overlaps_7/mtx_sji_t0_corrected", "cp2k/basis"])
+    assert "cp2k" in index
+    assert index.is_completed("eigenvalues", 2)
+    assert index.is_completed("energy", 1, "betas")
+    assert index.is_completed("corrected_overlaps", 7)
+    assert not index.is_completed("overlaps", 7)
+
+
+def test_stacked_layout(tmp_path):
+    """Test that the stacked layout is transparent for the per-frame nodes."""
+    path_hdf5 = tmp_path / "stacked.hdf5"
+    path_hdf5.touch()
+    store = get_store(path_hdf5)
+    store.set_layout("stacked")
+    overlaps = np.random.rand(6, 3, 3).astype(np.float32)
+
+    # Frames written one by one and as a time series
+    store_arrays_in_hdf5(path_hdf5, frame_path("overlaps", 5, "alphas"), overlaps[5])
+    store.write_frames("overlaps", range(5), overlaps[:5], "alphas")
+
+    with h5py.File(path_hdf5, 'r') as f5:
+        assert f5.attrs["layout"] == "stacked"
+        assert f5["alphas/stacked/overlaps/data"].shape == (6, 3, 3)
+        assert f5["alphas/stacked/overlaps/frames"][()].tolist() == [5, 0, 1, 2, 3, 4]
+        assert "alphas/overlaps_5" not in f5
+
+    assert is_data_in_hdf5(path_hdf5, "alphas/overlaps_3/mtx_sji_t0")
+    assert not is_data_in_hdf5(path_hdf5, "alphas/overlaps_6/mtx_sji_t0")
+    assert np.allclose(retrieve_hdf5_data(path_hdf5, "alphas/overlaps_5/mtx_sji_t0"), overlaps[5])
+    assert np.allclose(store.read_frames("overlaps", range(6), "alphas"), overlaps)
+    assert np.allclose(store.read_frames("overlaps", [4, 1], "alphas"), overlaps[[4, 1]])
+    with get_store(path_hdf5):
+        assert store.completed("overlaps", 7, "alphas").tolist() == [True] * 6 + [False]
+
+    # The frames are not overwritten
+    store.write_frames("overlaps", [2], [np.zeros((3, 3))], "alphas")
+    assert np.allclose(retrieve_hdf5_data(path_hdf5, "alphas/overlaps_2/mtx_sji_t0"), overlaps[2])
+
+
+def test_layout_of_existing_file(tmp_path):
+    """Test that the layout of a file with frames is not changed."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    store = get_store(path_hdf5)
+    store.set_layout("stacked")
+    assert store.layout == "frames"
+    coefficients = store.read_frames("coefficients", range(5))
+    assert np.allclose(coefficients[3], retrieve_hdf5_data(path_hdf5, "coefficients/point_3"))
+    with pytest.raises(ValueError):
+        store.set_layout("columns")
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+def test_storage_policies(tmp_path, layout):
+    """Test that the datasets are created with the compression and dtype of their policy."""
+    path_hdf5 = tmp_path / "policies.hdf5"
+    path_hdf5.touch()
+    store = get_store(path_hdf5)
+    store.set_layout(layout)
+    store.set_policies({"coefficients": {"dtype": "float64", "compression": "gzip",
+                                         "shuffle": True, "chunks": [4, 2]}})
+    coefficients = np.random.rand(3, 8, 6)
+    store.write_frames("coefficients", range(3), coefficients)
+    store.write_frames("couplings", range(3), coefficients)
+
+    dataset = "stacked/coefficients/data" if layout == "stacked" else "coefficients/point_0"
+    with h5py.File(path_hdf5, 'r') as f5:
+        assert f5[dataset].dtype == np.float64
+        assert f5[dataset].compression == "gzip"
+        assert f5[dataset].shuffle
+        assert f5[dataset].chunks[-2:] == (4, 2)
+        other = "stacked/couplings/data" if layout == "stacked" else "coupling_0"
+        assert f5[other].dtype == np.float32
+        assert f5[other].compression is None
+
+    assert np.array_equal(store.read_frames("coefficients", range(3)), coefficients)
+
+    # The tracking states are permutation indices, always stored as integers
+    with pytest.raises(ValueError):
+        store.set_policies({"tracking": {"dtype": "float16"}})
+    store.write_frames("tracking", [0], [np.array([2049, 0, 1])], dtype=np.int32)
+    assert store.read_frames("tracking", [0]).tolist() == [[2049, 0, 1]]
+
+
+@pytest.mark.parametrize("layout,sparse", [("frames", False), ("frames", True), ("stacked", False)])
+def test_lossy_storage(tmp_path, layout, sparse):
+    """Test that the quantized overlaps are read back within the error bound."""
+    path_hdf5 = tmp_path / "lossy.hdf5"
+    path_hdf5.touch()
+    store = get_store(path_hdf5)
+    store.set_layout(layout)
+    store.set_policies({"overlaps": {"error_bound": 1e-4, "zero_threshold": 1e-3,
+                                     "sparse": sparse}})
+    overlaps = np.random.normal(scale=0.1, size=(3, 6, 6))
+    paths = [frame_path("overlaps", i, "alphas") for i in range(3)]
+    with store:
+        for path, data in zip(paths, overlaps):
+            store.write(path, data, attrs={"unit": "au"})
+        pending = retrieve_hdf5_data(path_hdf5, paths)
+
+    stored = retrieve_hdf5_data(path_hdf5, paths)
+    assert np.array_equal(stored, pending)
+    small = np.abs(overlaps) < 1e-3
+    assert np.all(np.asarray(stored)[small] == 0)
+    assert np.abs(np.asarray(stored) - overlaps)[~small].max() <= 1e-4 * (1 + 1e-6)
+    assert np.allclose(store.read_frames("overlaps", [2, 0], "alphas"), [stored[2], stored[0]])
+    assert store.attributes(paths[1]) == {"unit": "au"}
+
+    dataset = "alphas/stacked/overlaps/data" if layout == "stacked" else paths[0]
+    with h5py.File(path_hdf5, 'r') as f5:
+        assert isinstance(f5[dataset], h5py.Group) == sparse
+        data = f5[dataset]["data"] if sparse else f5[dataset]
+        assert np.issubdtype(data.dtype, np.integer)
+        assert data.attrs["codec"] == "quantized"
+
+    # The results used to compute other stages cannot be stored with the codec
+    with pytest.raises(ValueError):
+        store.set_policies({"coefficients": {"error_bound": 0.05}})
+
+    # The values that the codec cannot represent are rejected when they are written
+    for invalid in (np.full((6, 6), np.nan), np.full((6, 6), 1e20)):
+        with pytest.raises(ValueError):
+            store.write(frame_path("overlaps", 3, "alphas"), invalid)
+    assert not store.contains(frame_path("overlaps", 3, "alphas"))
+
+
+@pytest.mark.parametrize("layout", ["frames", "stacked"])
+def test_active_space_storage(tmp_path, layout):
+    """Test that only the active space of the coefficients is stored and read back."""
+    path_hdf5 = tmp_path / "active.hdf5"
+    path_hdf5.touch()
+    get_store(path_hdf5).set_layout(layout)
+    config = DictConfig(path_hdf5=path_hdf5, store_active_space=True, nHOMO=10,
+                        mo_index_range=(5, 20), active_space=(2, 3))
+    mos = [InfoMO(np.arange(15.), np.random.rand(30, 15)) for _ in range(2)]
+    for i, data in enumerate(mos):
+        dump_orbitals_to_hdf5(data, config, f"point_{i}")
+
+    store = get_store(path_hdf5)
+    assert store.attributes("coefficients/point_0")["mo_window"].tolist() == [3, 8]
+    assert store.read("coefficients/point_0").shape == (30, 5)
+    assert store.read("eigenvalues/point_1").shape == (15,)
+
+    css0, css1 = read_overlap_data(config, ["coefficients/point_0", "coefficients/point_1"])
+    assert np.allclose(css0, mos[0].eigenvectors[:, 3:8])
+    assert np.allclose(css1, mos[1].eigenvectors[:, 3:8])
+
+    # Hyperslab inside the stored window
+    assert np.allclose(read_mo_window(store, "coefficients/point_1", 4, 6),
+                       mos[1].eigenvectors[:, 4:6])
+    with pytest.raises(ValueError):
+        read_mo_window(store, "coefficients/point_1", 2, 6)
+
+
+def test_asynchronous_writes(tmp_path):
+    """Test that the background writer keeps the pending arrays readable until they are written."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    store = HDF5Store(path_hdf5)
+    store.set_async(True)
+    arrays = np.random.rand(3, 4, 4)
+    # The writer cannot take the batch while the lock is held
+    with store._lock:
+        store.write_frames("overlaps", range(3), arrays)
+        assert store.is_completed("overlaps", 2)
+        assert np.allclose(store.read_frames("overlaps", range(3)), arrays)
+        assert np.allclose(store.read("overlaps_1/mtx_sji_t0"), arrays[1])
+        with h5py.File(path_hdf5, 'r') as f5:
+            assert "overlaps_1" not in f5
+
+    store.checkpoint()
+    assert np.allclose(store.read("overlaps_1/mtx_sji_t0"), arrays[1])
+    with h5py.File(path_hdf5, 'r') as f5:
+        assert np.allclose(f5["overlaps_2/mtx_sji_t0"][()], arrays[2])
+    store.set_async(False)
+
+
+def test_asynchronous_errors(tmp_path, mocker):
+    """Test that the errors of the background writer are raised by the next checkpoint."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    store = HDF5Store(path_hdf5)
+    store.set_async(True)
+    mocker.patch.object(store, "_write_batch", side_effect=OSError("disk full"))
+    store.write("stage/point_0", np.zeros(3))
+    with pytest.raises(RuntimeError):
+        store.checkpoint()
+    store.set_async(False)
+
+
+FOLLOWER = """
+import sys, time
+from nanoqm.hdf5_store import HDF5Follower
+frames = []
+deadline = time.monotonic() + 30
+with HDF5Follower(sys.argv[1], "couplings") as follower:
+    while len(frames) < 6 and time.monotonic() < deadline:
+        frames.extend(follower.poll()[0])
+        time.sleep(0.05)
+print(frames)
+"""
+
+
+def test_swmr_follower(tmp_path):
+    """Test that another process follows the frames while the HDF5 is written in SWMR mode."""
+    path_hdf5 = tmp_path / "swmr.hdf5"
+    h5py.File(path_hdf5, 'w', libver='latest').close()
+    store = get_store(path_hdf5)
+    store.set_layout("stacked")
+    store.set_swmr(True)
+    assert store.swmr
+    couplings = np.random.rand(6, 3, 3)
+    store.write_frames("couplings", range(2), couplings[:2])
+
+    follower = subprocess.Popen([sys.executable, "-c", FOLLOWER, str(path_hdf5)],
+                                stdout=subprocess.PIPE, text=True)
+    time.sleep(1)
+    store.write_frames("couplings", range(2, 5), couplings[2:5])
+    # A new stacked dataset is created while the follower reads the file
+    store.write_frames("energy", range(2), couplings[:2, 0])
+    store.write_frames("couplings", [5], couplings[5:])
+    output, _ = follower.communicate(timeout=60)
+    assert output.strip() == str(list(range(6)))
+
+    assert np.allclose(store.read_frames("couplings", range(6)), couplings)
+    store.set_swmr(False)
+    with HDF5Follower(path_hdf5, "energy") as follower:
+        frames, arrays = follower.poll()
+        assert frames == [0, 1]
+        assert np.allclose(arrays, couplings[:2, 0])
+
+
+SLOW_FOLLOWER = """
+import sys, time
+from nanoqm.hdf5_store import HDF5Follower
+
+class SlowFollower(HDF5Follower):
+    def _read_new_nodes(self, f5):
+        # Keep the file open while the workflow writes it
+        time.sleep(0.2)
+        return super()._read_new_nodes(f5)
+
+frames, sums = [], []
+deadline = time.monotonic() + 30
+with SlowFollower(sys.argv[1], "couplings") as follower:
+    print("following", flush=True)
+    while len(frames) < 6 and time.monotonic() < deadline:
+        new_frames, arrays = follower.poll()
+        frames.extend(new_frames)
+        sums.extend(round(float(a.sum()), 4) for a in arrays)
+        time.sleep(0.1)
+print(frames)
+print(sums)
+"""
+
+
+def test_follower_does_not_lock_the_writer(tmp_path):
+    """Test that a workflow writing a file without SWMR mode waits for the polls of a follower."""
+    path_hdf5 = tmp_path / "locks.hdf5"
+    path_hdf5.touch()
+    store = get_store(path_hdf5)
+    couplings = np.random.rand(6, 3, 3)
+    store.write_frames("couplings", [0], couplings[:1])
+
+    follower = subprocess.Popen([sys.executable, "-c", SLOW_FOLLOWER, str(path_hdf5)],
+                                stdout=subprocess.PIPE, text=True)
+    assert follower.stdout.readline().strip() == "following"
+    for i in range(1, 6):
+        store.write_frames("couplings", [i], couplings[i:i + 1])
+        time.sleep(0.1)
+    output, _ = follower.communicate(timeout=60)
+    frames, sums = output.strip().splitlines()
+    assert frames == str(list(range(6)))
+    # The frames are not read while they are written
+    expected = [round(float(c.sum()), 4) for c in couplings.astype(np.float32)]
+    assert np.allclose(json.loads(sums), expected)
+
+
+def test_frames_follower(tmp_path):
+    """Test that the follower only returns the new frames of the frames layout."""
+    path_hdf5 = copy_hdf5(tmp_path)
+    store = get_store(path_hdf5)
+    store.set_swmr(True)
+    assert not store.swmr
+    with HDF5Follower(path_hdf5, "coefficients") as follower:
+        assert follower.poll()[0] == list(range(5))
+        assert follower.poll() == ([], [])
+        store.write("coefficients/point_7", np.eye(2))
+        frames, arrays = follower.poll()
+        assert frames == [7]
+        assert np.allclose(arrays[0], np.eye(2))
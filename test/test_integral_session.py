@@ -0,0 +1,224 @@
+"""Test the persistent integral session."""
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from assertionlib import assertion
+from compute_integrals import IntegralSession
+from qmflows.parsers.xyzParser import readXYZ
+
+from nanoqm.common import molecule_to_arrays
+from nanoqm.integrals.multipole_matrices import compute_matrix_multipole
+from nanoqm.integrals.nonAdiabaticCoupling import (
+    calcOverlapMtx, compute_mo_overlaps_for_trajectory,
+    compute_overlaps_for_coupling, compute_overlaps_for_trajectory)
+from nanoqm.integrals.session import create_integral_session, get_integral_session
+from nanoqm.workflows.input_validation import process_input
+
+from .utilsTest import PATH_TEST
+
+
+def create_config(tmp_path: Path):
+    """Create a configuration using a temporal copy of the HDF5."""
+    config = process_input(PATH_TEST / "input_test_single_points.yml", 'single_points')
+    path_test_hdf5 = (Path(tmp_path) / "session.hdf5").as_posix()
+    shutil.copyfile(config.path_hdf5, path_test_hdf5)
+    config.path_hdf5 = path_test_hdf5
+    config.scratch_path = tmp_path
+
+    return config
+
+
+def test_session_is_shared(tmp_path):
+    """Check that all the frames use the same session."""
+    config = create_config(tmp_path)
+    assertion.is_(get_integral_session(config), get_integral_session(config))
+
+
+def test_session_overlaps(tmp_path):
+    """Check that the overlap is the same computed from the session and the cross overlap."""
+    config = create_config(tmp_path)
+    mol = readXYZ((PATH_TEST / "ethylene.xyz").as_posix())
+
+    overlap = compute_matrix_multipole(mol, config, "overlap")
+    cross_overlap = calcOverlapMtx(config, (mol, mol))
+    assertion.truth(np.allclose(overlap, cross_overlap))
+
+    # Computing it again reuses the cached basis and engines
+    assertion.truth(np.allclose(overlap, compute_matrix_multipole(mol, config, "overlap")))
+
+
+def test_in_memory_coordinates(tmp_path):
+    """Check that the coordinates passed in memory give the same integrals as the xyz file."""
+    config = create_config(tmp_path)
+    path_xyz = (PATH_TEST / "ethylene.xyz").as_posix()
+    coordinates, atomic_numbers = molecule_to_arrays(readXYZ(path_xyz))
+
+    session = get_integral_session(config)
+    from_file = session.multipole(path_xyz, "dipole")
+    from_memory = session.multipole(coordinates, atomic_numbers, "dipole")
+    assertion.truth(np.allclose(from_file, from_memory))
+
+
+def create_trajectory():
+    """Create a trajectory displacing the ethylene molecule."""
+    mol = readXYZ((PATH_TEST / "ethylene.xyz").as_posix())
+    displaced = [atom._replace(xyz=tuple(x + 0.05 for x in atom.xyz)) for atom in mol]
+    return [mol, displaced, mol]
+
+
+def test_trajectory_overlaps(tmp_path):
+    """Check that the batched overlaps are equal to the overlaps computed pair by pair."""
+    config = create_config(tmp_path)
+    molecules = create_trajectory()
+    pairs = [(0, 1), (1, 2), (0, 2)]
+    overlaps = compute_overlaps_for_trajectory(config, molecules, pairs)
+    assertion.eq(overlaps.shape[0], len(pairs))
+    for (i, j), suv in zip(pairs, overlaps):
+        expected = calcOverlapMtx(config, (molecules[i], molecules[j]))
+        assertion.truth(np.allclose(suv, expected))
+
+
+def test_active_space_overlaps(tmp_path):
+    """Check the molecular orbitals overlaps computed without the atomic orbitals overlap."""
+    config = create_config(tmp_path)
+    molecules = create_trajectory()
+    pairs = [(0, 1), (1, 2)]
+    suvs = [calcOverlapMtx(config, (molecules[i], molecules[j])) for i, j in pairs]
+
+    generator = np.random.default_rng(42)
+    nbasis = suvs[0].shape[0]
+    css0 = generator.normal(size=(len(pairs), nbasis, 5))
+    css1 = generator.normal(size=(len(pairs), nbasis, 7))
+    expected = [c0.T @ suv @ c1 for c0, suv, c1 in zip(css0, suvs, css1)]
+
+    overlaps = compute_mo_overlaps_for_trajectory(config, molecules, pairs, (css0, css1))
+    assertion.eq(overlaps.shape, (len(pairs), 5, 7))
+    assertion.truth(np.allclose(overlaps, expected))
+
+    i, j = pairs[0]
+    overlap = compute_overlaps_for_coupling(
+        config, (molecules[i], molecules[j]), (css0[0], css1[0]))
+    assertion.truth(np.allclose(overlap, expected[0]))
+
+
+def test_multipole_buffer(tmp_path):
+    """Check that the multipoles are written in the given C ordered buffer."""
+    config = create_config(tmp_path)
+    mol = readXYZ((PATH_TEST / "ethylene.xyz").as_posix())
+
+    dipole = compute_matrix_multipole(mol, config, "dipole")
+    assertion.eq(dipole.ndim, 3)
+    assertion.truth(dipole.flags.c_contiguous)
+
+    out = np.empty_like(dipole)
+    result = compute_matrix_multipole(mol, config, "dipole", out=out)
+    assertion.is_(result, out)
+    assertion.truth(np.allclose(out, dipole))
+
+    # Buffers that would require a copy are rejected
+    assertion.assert_(compute_matrix_multipole, mol, config, "dipole",
+                      out=np.asfortranarray(out), exception=ValueError)
+
+
+def test_load_balance(tmp_path):
+    """Check that the thread utilisation of the last computation is reported."""
+    config = create_config(tmp_path)
+    mol = readXYZ((PATH_TEST / "ethylene.xyz").as_posix())
+    compute_matrix_multipole(mol, config, "quadrupole")
+
+    utilisation, blocks, nthreads = get_integral_session(config).load_balance()
+    assertion.gt(blocks, 0)
+    assertion.ge(nthreads, 1)
+    assertion.truth(0 < utilisation <= 1)
+
+
+def test_screening_d_shells(tmp_path):
+    """Check that the screened overlaps of distant d shells differ by less than the threshold."""
+    path_hdf5 = tmp_path / "Cd33Se33.hdf5"
+    shutil.copyfile(PATH_TEST / "Cd33Se33.hdf5", path_hdf5)
+    session = IntegralSession(path_hdf5.as_posix(), "DZVP-MOLOPT-SR-GTH", 2)
+    atomic_numbers = [48, 48]
+    threshold = 1e-6
+
+    for distance in (3.0, 6.0, 9.0, 12.0, 20.0):
+        coords_0 = np.array([[0.0, 0.0, 0.0], [distance, 0.0, 0.0]])
+        coords_1 = coords_0 + 0.1
+        cross = [session.cross_overlap(coords_0, coords_1, atomic_numbers, threshold=x)
+                 for x in (0, threshold)]
+        overlaps = [session.multipole(coords_0, atomic_numbers, "overlap", threshold=x)
+                    for x in (0, threshold)]
+        for expected, screened in (cross, overlaps):
+            assertion.le(np.abs(screened - expected).max(), threshold)
+
+    # The shells of the atoms far apart are skipped
+    skipped, total = session.screening_stats()
+    assertion.truth(0 < skipped < total)
+
+
+def test_incremental_overlap(tmp_path):
+    """Check that the incremental overlap only recomputes the atoms that moved."""
+    config = create_config(tmp_path)
+    session = get_integral_session(config)
+    session.reset_incremental()
+    molecules = create_trajectory()
+    (coords_0, atomic_numbers), (coords_1, _) = (molecule_to_arrays(mol) for mol in molecules[:2])
+
+    # The first overlap is computed from scratch
+    overlap = session.cross_overlap_incremental(coords_0, coords_1, atomic_numbers, 0.1)
+    assertion.truth(np.allclose(overlap, session.cross_overlap(coords_0, coords_1, atomic_numbers)))
+    assertion.eq(session.reuse_stats()[0], 0)
+
+    # Displacements below the tolerance reuse all the blocks
+    reused = session.cross_overlap_incremental(
+        coords_0 + 1e-3, coords_1 - 1e-3, atomic_numbers, 0.1)
+    assertion.truth(np.array_equal(reused, overlap))
+    reused_pairs, total = session.reuse_stats()
+    assertion.eq(reused_pairs, total)
+
+    # Moving a single atom recomputes only its blocks
+    coords_1[0] += 0.5
+    updated = session.cross_overlap_incremental(coords_0, coords_1, atomic_numbers, 0.1)
+    expected = session.cross_overlap(coords_0, coords_1, atomic_numbers)
+    assertion.truth(np.allclose(updated, expected))
+    reused_pairs, total = session.reuse_stats()
+    assertion.truth(0 < reused_pairs < total)
+
+    # The blocks computed with another screening threshold are not reused
+    screened = session.cross_overlap_incremental(coords_0, coords_1, atomic_numbers, 0.1, 1e-8)
+    assertion.eq(session.reuse_stats()[0], 0)
+    expected = session.cross_overlap(coords_0, coords_1, atomic_numbers, 1e-8)
+    assertion.truth(np.allclose(screened, expected))
+
+    # The blocks of an atom that leaves its neighbours are set to zero and
+    # computed again when it comes back
+    for shift in (50, -50):
+        coords_1[0] += shift
+        updated = session.cross_overlap_incremental(
+            coords_0, coords_1, atomic_numbers, 0.1, 1e-8)
+        expected = session.cross_overlap(coords_0, coords_1, atomic_numbers, 1e-8)
+        assertion.truth(np.allclose(updated, expected))
+    session.reset_incremental()
+
+
+def test_sessions_with_different_threads(tmp_path):
+    """Check that sessions with different number of threads can run at the same time."""
+    config = create_config(tmp_path)
+    coordinates, atomic_numbers = molecule_to_arrays(
+        readXYZ((PATH_TEST / "ethylene.xyz").as_posix()))
+    sessions = [create_integral_session(config.path_hdf5, config.cp2k_general_settings["basis"], n)
+                for n in (1, 4)]
+    assertion.eq([session.nthreads for session in sessions], [1, 4])
+    expected = sessions[0].multipole(coordinates, atomic_numbers, "quadrupole")
+
+    def compute(session):
+        return [session.multipole(coordinates, atomic_numbers, "quadrupole")
+                for _ in range(20)]
+
+    with ThreadPoolExecutor(len(sessions)) as executor:
+        results = list(executor.map(compute, sessions * 2))
+    assertion.truth(all(np.allclose(x, expected) for xs in results for x in xs))
+
+    # Each session reports the statistics of its own computations
+    assertion.eq([session.load_balance()[2] for session in sessions], [1, 4])
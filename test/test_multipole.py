@@ -5,8 +5,11 @@ from pathlib import Path
 
 import numpy as np
 from assertionlib import assertion
-from nanoqm.integrals.multipole_matrices import compute_matrix_multipole
+from nanoqm.common import number_spherical_functions_per_atom
+from nanoqm.integrals.multipole_matrices import (compute_matrix_multipole,
+                                                 compute_sparse_multipole)
 from nanoqm.workflows.input_validation import process_input
+from qmflows.common import AtomXYZ
 from qmflows.parsers.xyzParser import readXYZ
 
 from .utilsTest import PATH_TEST
@@ -31,3 +34,41 @@ def test_quadropole(tmp_path):
     for i in range(10):
         arr = matrix[i].reshape(46, 46)
         assertion.truth(np.allclose(arr, arr.T))
+
+
+def test_sparse_multipole(tmp_path):
+    """Test that the sparse multipoles contain the same integrals as the dense ones."""
+    config = process_input(PATH_TEST / "input_test_single_points.yml", 'single_points')
+    path_test_hdf5 = (Path(tmp_path) / "multipoles.hdf5").as_posix()
+    shutil.copyfile(config.path_hdf5, path_test_hdf5)
+    config.path_hdf5 = path_test_hdf5
+
+    mol = readXYZ((PATH_TEST / "ethylene.xyz").as_posix())
+    dense = compute_matrix_multipole(mol, config, "dipole")
+
+    config.ao_drop_tolerance = 0.0
+    matrices = compute_sparse_multipole(mol, config, "dipole")
+    assertion.len_eq(matrices, 4)
+    for sparse_matrix, dense_matrix in zip(matrices, dense):
+        assertion.truth(np.allclose(sparse_matrix.toarray(), dense_matrix))
+
+    # Two ethylene molecules 20 Angstrom apart, the blocks between them are dropped
+    dimer = mol + [AtomXYZ(atom.symbol, (atom.xyz[0] + 20, *atom.xyz[1:])) for atom in mol]
+    dense_overlap = compute_matrix_multipole(dimer, config, "overlap")
+    config.ao_drop_tolerance = 1e-3
+    overlap = compute_sparse_multipole(dimer, config, "overlap")
+    assertion.lt(overlap.nnz, dense_overlap.size)
+
+    # The atom blocks are either kept as they are or all their integrals are below the tolerance
+    sphericals = number_spherical_functions_per_atom(
+        dimer, "cp2k", config.cp2k_general_settings["basis"], config.path_hdf5)
+    offsets = np.concatenate(([0], np.cumsum(sphericals)))
+    blocks = [slice(begin, end) for begin, end in zip(offsets[:-1], offsets[1:])]
+    for rows in blocks:
+        for cols in blocks:
+            block = overlap[rows, cols]
+            if block.nnz:
+                assertion.truth(np.allclose(block.toarray(), dense_overlap[rows, cols],
+                                            rtol=0, atol=1e-12))
+            else:
+                assertion.lt(np.abs(dense_overlap[rows, cols]).max(), 1e-3)
@@ -0,0 +1,184 @@
+"""Test the tracking of the crossings, the phases and the couplings."""
+from typing import Tuple
+
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+from nanoqm.common import DictConfig, femtosec2au, retrieve_hdf5_data
+from nanoqm.hdf5_store import get_store
+from nanoqm.integrals import (calculate_couplings_3points,
+                              calculate_couplings_batch,
+                              calculate_couplings_levine, correct_phases)
+from nanoqm.schedule import scheduleCoupling
+from nanoqm.schedule.scheduleCoupling import (compute_phases, lazy_couplings,
+                                              track_unavoided_crossings)
+
+
+def create_overlaps(nframes: int, dim: int, seed: int = 0) -> np.ndarray:
+    """Create overlaps close to signed permutations, so the orbitals cross."""
+    generator = np.random.default_rng(seed)
+    overlaps = []
+    for _ in range(nframes):
+        permutation = np.arange(dim)
+        i = generator.integers(dim - 1)
+        permutation[[i, i + 1]] = permutation[[i + 1, i]]
+        signs = generator.choice([-1, 1], dim)
+        noise = generator.normal(scale=0.02, size=(dim, dim))
+        overlaps.append(np.eye(dim)[permutation] * signs * 0.9 + noise)
+    return np.stack(overlaps).astype(np.float32)
+
+
+def reference_tracking(overlaps: np.ndarray, nHOMO: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Track the crossings permuting all the following overlaps at each step."""
+    overlaps = overlaps.copy()
+    nOverlaps, nOrbitals, _ = overlaps.shape
+    indexes = np.empty((nOverlaps + 1, nOrbitals), dtype=int)
+    indexes[0] = np.arange(nOrbitals)
+    for k in range(nOverlaps):
+        swaps_homos = linear_sum_assignment(-overlaps[k, :nHOMO, :nHOMO] ** 2)[1]
+        swaps_lumos = linear_sum_assignment(-overlaps[k, nHOMO:, nHOMO:] ** 2)[1]
+        total_swaps = np.concatenate((swaps_homos, swaps_lumos + nHOMO))
+        indexes[k + 1] = total_swaps
+        if k != nOverlaps - 1:
+            overlaps[k] = overlaps[k][:, total_swaps]
+            for i in range(k + 1, nOverlaps):
+                overlaps[i] = overlaps[i][:, total_swaps][total_swaps]
+    arr = np.empty(indexes.shape, dtype=int)
+    arr[0] = acc = indexes[0]
+    for i in range(nOverlaps):
+        acc = acc[indexes[i + 1]]
+        arr[i + 1] = acc
+    return overlaps, arr
+
+
+def reference_couplings(overlaps: np.ndarray, algorithm: str, tracking: bool, nHOMO: int):
+    """Compute the couplings with all the overlaps of the trajectory in memory."""
+    if tracking:
+        overlaps, swaps = reference_tracking(overlaps, nHOMO)
+    else:
+        overlaps = overlaps.copy()
+        swaps = np.tile(np.arange(overlaps.shape[1]), (len(overlaps) + 1, 1))
+    fixed = correct_phases(overlaps, compute_phases(overlaps, *overlaps.shape[:2]))
+    dt_au = femtosec2au
+    if algorithm == "levine":
+        couplings = [calculate_couplings_levine(dt_au, s, s.transpose()) for s in fixed.copy()]
+    else:
+        couplings = [calculate_couplings_3points(dt_au, s0, s0.T, s1, s1.T)
+                     for s0, s1 in zip(fixed[:-1], fixed[1:])]
+    return fixed, swaps, couplings
+
+
+@pytest.mark.parametrize("nframes", [1, 2, 15])
+def test_track_unavoided_crossings(nframes):
+    """Test that the lazy permutation gives the same overlaps and swaps."""
+    overlaps = create_overlaps(nframes, 8, seed=nframes)
+    expected, expected_swaps = reference_tracking(overlaps, 5)
+    tracked, swaps = track_unavoided_crossings(overlaps, 5)
+    assert tracked is overlaps
+    assert np.array_equal(tracked, expected)
+    assert np.array_equal(swaps, expected_swaps)
+
+
+@pytest.mark.parametrize("threshold,problems", [(None, 2), (0.1, 2), (0., 2)])
+def test_assignment_components(mocker, threshold, problems):
+    """Test that the assignment is solved for each group of orbitals that can be swapped."""
+    overlap = create_overlaps(1, 20, seed=4)[0]
+    # A crossing between the HOMO and the orbital below it
+    overlap[[8, 9]] = overlap[[9, 8]]
+    expected = scheduleCoupling.assign_orbitals(overlap, 10)
+    spy = mocker.spy(scheduleCoupling, "linear_sum_assignment")
+    swaps = scheduleCoupling.assign_orbitals(overlap, 10, threshold)
+    assert np.array_equal(swaps, expected)
+    assert spy.call_count == problems
+    if threshold == 0.1:
+        # Only the crossing orbitals are assigned
+        assert [args[0].shape for args, _ in spy.call_args_list] == [(2, 2), (2, 2)]
+
+    # The orbitals cannot be swapped if their overlaps are below the threshold
+    assert np.array_equal(scheduleCoupling.assign_orbitals(overlap, 10, 0.95), np.arange(20))
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_couplings_batch(dtype, workers):
+    """Test that the batched kernels give the same couplings that the functions per frame."""
+    overlaps = create_overlaps(7, 9, seed=5).astype(dtype)
+    levine = calculate_couplings_batch(femtosec2au, overlaps, "levine", workers)
+    expected = [calculate_couplings_levine(femtosec2au, s.copy(), s.T.copy()) for s in overlaps]
+    assert levine.dtype == expected[0].dtype
+    assert np.array_equal(levine, expected, equal_nan=True)
+
+    three_points = calculate_couplings_batch(femtosec2au, overlaps, "3points", workers)
+    expected = [calculate_couplings_3points(femtosec2au, s0, s0.T, s1, s1.T)
+                for s0, s1 in zip(overlaps[:-1], overlaps[1:])]
+    assert three_points.dtype == expected[0].dtype
+    assert np.array_equal(three_points, expected)
+
+
+@pytest.mark.parametrize("algorithm", ["levine", "3points"])
+@pytest.mark.parametrize("tracking", [True, False])
+def test_streaming_couplings(tmp_path, algorithm, tracking):
+    """Test that the frame by frame pipeline matches the whole-trajectory algorithm."""
+    path_hdf5 = tmp_path / "couplings.hdf5"
+    path_hdf5.touch()
+    overlaps = create_overlaps(10, 6)
+    get_store(path_hdf5).write_frames("overlaps", range(2, 12), overlaps, "alphas")
+    config = DictConfig(
+        path_hdf5=path_hdf5, orbitals_type="alphas", enumerate_from=2, nHOMO=3, dt=1,
+        algorithm=algorithm, tracking=tracking, overlaps_window=3)
+    paths = [f"alphas/overlaps_{i}/mtx_sji_t0" for i in range(2, 12)]
+
+    fixed, swaps, couplings = reference_couplings(overlaps, algorithm, tracking, 3)
+    # The orbitals cross only if they are tracked
+    assert (swaps != np.arange(6)).any() == tracking
+    for _ in range(2):
+        # The second time the corrected overlaps and the swaps are read from the HDF5
+        computed_swaps, paths_couplings = lazy_couplings.__wrapped__(config, paths)
+        assert np.array_equal(computed_swaps, swaps)
+        assert len(paths_couplings) == len(couplings)
+        assert paths_couplings[0] == "alphas/coupling_2"
+        stored = retrieve_hdf5_data(path_hdf5, paths_couplings)
+        assert np.allclose(stored, couplings, atol=1e-6)
+
+    if tracking:
+        corrected = [f"alphas/overlaps_{i}/mtx_sji_t0_corrected" for i in range(2, 12)]
+        assert np.allclose(retrieve_hdf5_data(path_hdf5, corrected), fixed)
+        # The state of the tracking is stored for all the frames but the last one
+        states = get_store(path_hdf5).read_frames("tracking", range(2, 11), "alphas")
+        assert np.array_equal(states[:, 0], swaps[1:-1])
+        assert np.all(np.abs(states[:, 1]) == 1)
+
+
+@pytest.mark.parametrize("algorithm", ["levine", "3points"])
+def test_resume_tracking(tmp_path, mocker, algorithm):
+    """Test that an extended trajectory continues the tracking of the previous run."""
+    path_hdf5 = tmp_path / "resume.hdf5"
+    path_hdf5.touch()
+    overlaps = create_overlaps(10, 6, seed=3)
+    get_store(path_hdf5).write_frames("overlaps", range(10), overlaps)
+    config = DictConfig(
+        path_hdf5=path_hdf5, orbitals_type="", enumerate_from=0, nHOMO=3, dt=1,
+        algorithm=algorithm, tracking=True, overlaps_window=4)
+    paths = [f"overlaps_{i}/mtx_sji_t0" for i in range(10)]
+    fixed, swaps, couplings = reference_couplings(overlaps, algorithm, True, 3)
+
+    # The first run stops at the fifth frame, where two orbitals cross
+    assert not np.array_equal(swaps[4], swaps[5])
+    lazy_couplings.__wrapped__(config, paths[:5])
+    assert get_store(path_hdf5).completed("tracking", 10).tolist() == [True] * 4 + [False] * 6
+
+    # Only the last frame of the first run and the new frames are tracked
+    spy = mocker.spy(scheduleCoupling, "assign_orbitals")
+    computed_swaps, paths_couplings = lazy_couplings.__wrapped__(config, paths)
+    assert spy.call_count == 6
+    assert np.array_equal(computed_swaps, swaps)
+
+    # The fifth overlap, stored without swapping its columns, and its couplings are replaced
+    corrected = retrieve_hdf5_data(
+        path_hdf5, [f"overlaps_{i}/mtx_sji_t0_corrected" for i in range(10)])
+    assert np.allclose(corrected, fixed)
+    assert len(paths_couplings) == len(couplings)
+    stored = retrieve_hdf5_data(path_hdf5, paths_couplings)
+    assert np.allclose(stored, couplings, atol=1e-6)
+    assert np.array_equal(retrieve_hdf5_data(path_hdf5, "swaps"), swaps)
@@ -1,7 +1,10 @@
 """Check the schemas."""
+import pytest
 from assertionlib import assertion
+from schema import SchemaError
 
 from nanoqm.workflows.input_validation import process_input
+from nanoqm.workflows.schemas import schema_hdf5_storage
 
 from .utilsTest import PATH_TEST
 
@@ -14,3 +17,14 @@ def test_input_validation():
     for s, p in zip(schemas, paths):
         d = process_input(p, s)
         assertion.isinstance(d, dict)
+
+
+def test_lossy_storage_schema():
+    """Test that only the overlaps and the couplings accept the lossy codec."""
+    policies = schema_hdf5_storage.validate(
+        {"couplings": {"error_bound": 1e-4}, "coefficients": {"compression": "gzip"}})
+    assertion.eq(policies["couplings"]["error_bound"], 1e-4)
+    assertion.eq(policies["coefficients"]["compression"], "gzip")
+    for stage in ("coefficients", "eigenvalues", "tracking"):
+        with pytest.raises(SchemaError):
+            schema_hdf5_storage.validate({stage: {"error_bound": 0.05}})
@@ -1,8 +1,12 @@
 """Test the workflows tools."""
+import shutil
+
 import numpy as np
 from qmflows.parsers import parse_string_xyz
+from threadpoolctl import threadpool_info
 
-from nanoqm.common import number_spherical_functions_per_atom
+from nanoqm.common import blas_threads, number_spherical_functions_per_atom
+from nanoqm.hdf5_store import get_store
 
 from .utilsTest import PATH_TEST
 
@@ -18,3 +22,37 @@ def test_calc_sphericals():
     expected = np.concatenate((np.repeat(25, 33), np.repeat(13, 33)))
 
     assert np.array_equal(xs, expected)
+
+
+def test_calc_sphericals_in_stage(tmp_path):
+    """Test that the basis set waiting to be written is read through the store."""
+    with open(PATH_TEST / 'Cd33Se33.xyz', 'r') as f:
+        mol = parse_string_xyz(f.read())
+    path_hdf5 = tmp_path / "Cd33Se33.hdf5"
+    shutil.copyfile(PATH_TEST / "Cd33Se33.hdf5", path_hdf5)
+    store = get_store(path_hdf5)
+    with store:
+        for symbol in ("cd", "se"):
+            node = f"cp2k/basis/{symbol}/DZVP-MOLOPT-SR-GTH/coefficients"
+            store.write(node.replace("DZVP", "COPY"), store.read(node),
+                        attrs=store.attributes(node))
+        xs = number_spherical_functions_per_atom(
+            mol, "cp2k", "COPY-MOLOPT-SR-GTH", path_hdf5)
+        assert store.in_stage
+
+    expected = np.concatenate((np.repeat(25, 33), np.repeat(13, 33)))
+    assert np.array_equal(xs, expected)
+
+
+def test_blas_threads():
+    """Test that the BLAS threads are limited only inside the context."""
+    def blas_limits():
+        return [pool["num_threads"] for pool in threadpool_info() if pool["user_api"] == "blas"]
+
+    before = blas_limits()
+    with blas_threads(1):
+        assert all(n == 1 for n in blas_limits())
+    with blas_threads(None):
+        assert blas_limits() == before
+    assert blas_limits() == before
+